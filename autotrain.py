@@ -4,9 +4,14 @@
 #       Autotrain is a script designed to help generate Tesseract training
 #       data from image/boxfile pairs.
 #
+#       Each stage is skipped if its inputs and command haven't changed since
+#       the last run (see BuildCache), so after fixing one boxfile only the
+#       stages which depend on it are run again. Use -f to rebuild everything.
+#
 #       The order of execution is:
 #           * Work out the language and a list of fonts present
-#           * Generate .tr files from each boxfile
+#           * Generate .tr files from each boxfile (use -j to run several
+#             tesseract processes at once)
 #           * Concatenate all .tr and .box files for each font into
 #             single files
 #           * Run unicharset_extractor on the boxfiles
@@ -45,22 +50,255 @@ import subprocess
 import os
 import sys
 import shutil
-import codecs
+import optparse
+import hashlib
+import json
+from itertools import izip
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import timing
+from timing import timed
+
+
+# the files which combine_tessdata can put into a traineddata file
+TESSDATA_COMPONENTS = ['config', 'unicharset', 'unicharambigs', 'inttemp',
+                       'pffmtable', 'normproto', 'punc-dawg', 'word-dawg',
+                       'number-dawg', 'freq-dawg', 'fixed-length-dawgs',
+                       'cube-unicharset', 'cube-word-dawg', 'shapetable',
+                       'bigram-dawg', 'unambig-dawg', 'params-model']
+
+
+# size of the reads and writes used to copy files
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def concatenate(filenames, outFilename):
+    """Write the contents of the files, in order, to a new file"""
+
+    outFile = open(outFilename, 'wb')
+    try:
+        for filename in filenames:
+            inFile = open(filename, 'rb')
+            try:
+                shutil.copyfileobj(inFile, outFile, COPY_BUFFER_SIZE)
+            finally:
+                inFile.close()
+    finally:
+        outFile.close()
+
+
+class StageError(Exception):
+    """A training tool failed, or didn't make what it should have"""
+
+
+def run_tool(cmd, outputs):
+    """Run a training tool which should make outputs. Any outputs left from
+    an earlier run are removed first, so that they can't be mistaken for
+    new ones. Raises StageError if the tool can't be run, fails, or leaves
+    any of outputs unmade."""
+
+    for filename in outputs:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    print 'Running command:', cmd
+
+    try:
+        returnCode = subprocess.call(cmd)
+    except OSError, e:
+        raise StageError('could not run %s: %s' % (cmd[0], e))
+
+    if returnCode != 0:
+        raise StageError('%s failed (exit status %d)' % (cmd[0], returnCode))
+
+    missing = [filename for filename in outputs if not os.path.exists(filename)]
+    if missing:
+        raise StageError('%s did not make %s' % (cmd[0], ', '.join(missing)))
+
+
+class BuildCache:
+    """Remembers what each stage of the previous runs was built from.
+
+    Files are identified by the SHA-1 of their contents. A stage is up to
+    date if it was last run with the same command on inputs with the same
+    hashes, and its outputs are still as it left them. Each hash is stored
+    with the file's size and mtime, so unchanged files aren't read again."""
+
+    def __init__(self, filename='autotrain.cache', enabled=True):
+
+        self.filename = filename
+        self.enabled = enabled # if False, nothing is up to date
+
+        self.files = {} # filename -> [size, mtime, hash]
+        self.stages = {} # stage name -> {'key': ..., 'outputs': {filename: hash}}
+
+        if os.path.exists(filename):
+            try:
+                cacheFile = open(filename, 'r')
+                try:
+                    manifest = json.load(cacheFile)
+                finally:
+                    cacheFile.close()
+
+                self.files = manifest['files']
+                self.stages = manifest['stages']
+            except (IOError, ValueError, KeyError):
+                print 'Warning: ignoring unreadable build cache %s' % filename
+
+    def file_hash(self, filename):
+        """The hash of a file's contents, or None if it doesn't exist"""
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        known = self.files.get(filename)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            return known[2]
+
+        digest = hashlib.sha1()
+        hashFile = open(filename, 'rb')
+        try:
+            while True:
+                block = hashFile.read(1 << 20)
+                if not block:
+                    break
+                digest.update(block)
+        finally:
+            hashFile.close()
+
+        self.files[filename] = [stat.st_size, stat.st_mtime, digest.hexdigest()]
+
+        return digest.hexdigest()
+
+    def stage_key(self, cmd, inputs):
+        """A hash of a command and the contents of its input files"""
+
+        description = [cmd, [(filename, self.file_hash(filename)) for filename in inputs]]
+
+        return hashlib.sha1(json.dumps(description)).hexdigest()
+
+    def is_fresh(self, stage, cmd, inputs):
+
+        if not self.enabled:
+            return False
+
+        entry = self.stages.get(stage)
+        if not entry or entry['key'] != self.stage_key(cmd, inputs):
+            return False
+
+        if not entry['outputs']: # nothing was made, so it can't be up to date
+            return False
+
+        for (filename, digest) in entry['outputs'].items():
+            if self.file_hash(filename) != digest:
+                return False
+
+        return True
+
+    def record(self, stage, cmd, inputs, outputs):
+        """Remember that a stage has just built outputs (those that exist)
+        from inputs"""
+
+        self.stages[stage] = {'key': self.stage_key(cmd, inputs),
+                              'outputs': dict((filename, self.file_hash(filename))
+                                              for filename in outputs
+                                              if os.path.exists(filename))}
+
+    def save(self):
+
+        tempFilename = self.filename + '.tmp'
+
+        cacheFile = open(tempFilename, 'w')
+        try:
+            json.dump({'files': self.files, 'stages': self.stages}, cacheFile)
+        finally:
+            cacheFile.close()
+
+        os.rename(tempFilename, self.filename)
 
 
 class AutoTrainer:
 
     def __init__(self):
         self.tessdataDirectory = '/usr/local/share/tessdata'
+        self.jobs = 1 # number of tesseract processes to run at once
+        self.cache = BuildCache()
+
+    def tr_command(self, filename):
+        return ['tesseract', '%s%s'%(filename, self.ext), filename, 'nobatch', 'box.train.stderr']
+
+    def tr_inputs(self, filename):
+        return [filename + self.ext, filename + '.box']
+
+    @timed
+    def run_tr_job(self, filename):
+        """Generate the .tr file for one image. Returns the exit status of
+        tesseract (None if it couldn't be run) and everything it printed"""
+
+        # generate the .tr files from the .tif/png + .box
+        cmd = self.tr_command(filename)
+
+        try:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError, e:
+            return (None, str(e))
+
+        (out, err) = process.communicate()
 
+        return (process.returncode, out + err)
+
+    @timed
     def generate_tr_files(self):
 
-        for filename in self.baselist:  #for every file in the directory
+        print '\nGenerating .tr files (%d at a time)' % self.jobs
+
+        self.failedList = []
+
+        staleList = [filename for filename in self.baselist
+                     if not self.cache.is_fresh('tr:' + filename,
+                                                self.tr_command(filename),
+                                                self.tr_inputs(filename))]
+
+        print '  %d of %d .tr files are up to date' % (len(self.baselist) - len(staleList), len(self.baselist))
+
+        # The jobs run in any order, but imap hands the results back in the
+        # order of staleList, so the output and the later concatenation don't
+        # depend on which job finished first.
+        pool = ThreadPool(self.jobs)
+        try:
+            results = pool.imap(self.run_tr_job, staleList)
+
+            for (filename, (returnCode, output)) in izip(staleList, results):
+
+                print '  %s%s' % (filename, self.ext)
+                if output.strip():
+                    print '    ' + output.strip().replace('\n', '\n    ')
+
+                if returnCode != 0 or not os.path.exists(filename + '.tr'):
+                    print 'Error: could not generate %s.tr (exit status %s)' % (filename, returnCode)
+                    self.failedList.append(filename)
+                else:
+                    self.cache.record('tr:' + filename, self.tr_command(filename),
+                                      self.tr_inputs(filename), [filename + '.tr'])
+        finally:
+            pool.close()
+            pool.join()
 
-            # generate the .tr files from the .tif/png + .box
-            cmd = ['tesseract', '%s%s'%(filename, self.ext), filename, 'nobatch', 'box.train.stderr']
-            subprocess.call(cmd)
+        if self.failedList:
+            print '\n%d image(s) failed and will be left out of training:' % len(self.failedList)
+            for filename in self.failedList:
+                print '  %s%s' % (filename, self.ext)
 
+            self.baselist = [filename for filename in self.baselist
+                             if filename not in self.failedList]
+
+        if not self.baselist:
+            raise StageError('no .tr files could be generated, so there is nothing to train on')
+
+    @timed
     def generate_unicharset(self):
 
         print '\nGenerating unicharset'
@@ -68,10 +306,16 @@ class AutoTrainer:
         cmd = ['unicharset_extractor']
         cmd.extend(self.catBoxFileList)
 
-        print 'Running command:', cmd
-        subprocess.call(cmd)
+        if self.cache.is_fresh('unicharset', cmd, self.catBoxFileList):
+            print 'unicharset is up to date'
+            return
+
+        run_tool(cmd, ['unicharset'])
 
+        self.cache.record('unicharset', cmd, self.catBoxFileList, ['unicharset'])
 
+
+    @timed
     def do_mftraining(self):
 
         print '\nBeginning mftraining'
@@ -80,9 +324,10 @@ class AutoTrainer:
 
         cmd.extend(self.catTrFileList)
 
-        print 'Running command:', cmd
-        subprocess.call(cmd)
+        # Microfeat isn't made by every version
+        run_tool(cmd, ['inttemp', 'pffmtable', self.lang + '.unicharset'])
 
+    @timed
     def do_cntraining(self):
 
         print '\nBeginning cntraining'
@@ -90,10 +335,9 @@ class AutoTrainer:
 
         cmd.extend(self.catTrFileList)
 
-        print 'Running command:', cmd
-        subprocess.call(cmd)
-        pass
+        run_tool(cmd, ['normproto'])
 
+    @timed
     def rename_files(self):
 
         print '\nRenaming files'
@@ -101,14 +345,45 @@ class AutoTrainer:
 
             newFilename = '%s.%s' % (self.lang, filename)
 
-            shutil.move(filename, newFilename)
+            if os.path.exists(filename): # not every version makes Microfeat
+                shutil.move(filename, newFilename)
+
+    @timed
+    def do_training(self):
+        """Run mftraining and cntraining and rename what they make, unless
+        the results of the last run are still up to date"""
+
+        cmd = ['mftraining', 'cntraining', self.lang]
+        inputs = self.catTrFileList + ['unicharset']
+        outputs = ['%s.%s' % (self.lang, filename) for filename in
+                   ['normproto', 'Microfeat', 'inttemp', 'pffmtable', 'unicharset']]
+
+        if self.cache.is_fresh('training', cmd, inputs):
+            print '\nmftraining and cntraining results are up to date'
+            return
+
+        self.do_mftraining()
+        self.do_cntraining()
+        self.rename_files()
+
+        self.cache.record('training', cmd, inputs, outputs)
 
+    @timed
     def combine_data(self):
 
         print '\nCombining data'
         cmd = ['combine_tessdata', self.lang + '.']
-        print 'Running cmd:' , cmd
-        subprocess.call(cmd)
+
+        inputs = ['%s.%s' % (self.lang, component) for component in TESSDATA_COMPONENTS]
+        inputs = [filename for filename in inputs if os.path.exists(filename)]
+
+        if self.cache.is_fresh('combine', cmd, inputs):
+            print '%s.traineddata is up to date' % self.lang
+            return
+
+        run_tool(cmd, [self.lang + '.traineddata'])
+
+        self.cache.record('combine', cmd, inputs, [self.lang + '.traineddata'])
 
     def get_language(self):
 
@@ -128,6 +403,7 @@ class AutoTrainer:
 
         print '\nFound fonts:', self.fontList
 
+    @timed
     def concatenate_files(self):
 
         print '\nConcatenating files'
@@ -135,16 +411,14 @@ class AutoTrainer:
         self.catBoxFileList = []
         self.catTrFileList = []
 
-        for font in self.fontList:
-
-            filesInFont = []
-            for filename in self.baselist:
+        # sort the files into fonts in one pass
+        fontFiles = dict((font, []) for font in self.fontList)
+        for filename in self.baselist:
+            fontFiles[filename.split('.')[1]].append(filename)
 
-                fileFont = filename.split('.')[1]
-                number = filename.split('.')[2]
+        for font in self.fontList:
 
-                if font == fileFont:
-                    filesInFont.append( filename )
+            filesInFont = fontFiles[font]
 
             catBoxFilename = '%s.%s.box' % (self.lang, font)
             catTrFilename = '%s.%s.tr' % (self.lang, font)
@@ -152,26 +426,27 @@ class AutoTrainer:
             self.catBoxFileList.append(catBoxFilename)
             self.catTrFileList.append(catTrFilename)
 
-            catBoxFile = codecs.open( catBoxFilename, 'w', 'utf-8')
-            catTrFile = codecs.open( catTrFilename, 'w', 'utf-8')
-
-            print '  Concat files:', catBoxFilename, catTrFilename
-
+            inputs = []
             for filename in filesInFont:
-                boxFilename= filename+'.box'
-                trFilename = filename+'.tr'
+                inputs.extend([filename + '.box', filename + '.tr'])
+
+            if self.cache.is_fresh('concat:' + font, ['concatenate'], inputs):
+                print '  Up to date:', catBoxFilename, catTrFilename
+                continue
 
-                boxFile = codecs.open(boxFilename, 'r', 'utf-8')
-                trFile = codecs.open(trFilename, 'r', 'utf-8')
+            print '  Concat files:', catBoxFilename, catTrFilename
 
-                for line in boxFile:
-                    catBoxFile.write(line)
+            # the files are copied as bytes: nothing needs decoding, and
+            # .tr files aren't text anyway
+            concatenate([filename + '.box' for filename in filesInFont], catBoxFilename)
+            concatenate([filename + '.tr' for filename in filesInFont], catTrFilename)
 
-                for line in trFile:
-                    catTrFile.write(line)
+            self.cache.record('concat:' + font, ['concatenate'], inputs,
+                              [catBoxFilename, catTrFilename])
 
             print 'Concatenation complete for font: %s' % font
 
+    @timed
     def copy_traineddata(self):
 
         traineddata = self.lang+'.traineddata'
@@ -183,21 +458,32 @@ class AutoTrainer:
         except IOError:
             print "Error: You don't have permisson to write to the tessdata directory."
 
+    @timed
     def generate_dawgs(self):
 
         print '\nGenerating DAWGs'
 
-        listFilename = '%s.freq_list.txt' % self.lang
-        if os.path.exists(listFilename):
-            cmd = ['wordlist2dawg', listFilename, self.lang + '.freq-dawg', self.lang +'.unicharset' ]
-            subprocess.call(cmd)
+        for (listName, dawgName) in [('freq_list', 'freq-dawg'), ('word_list', 'word-dawg')]:
+
+            listFilename = '%s.%s.txt' % (self.lang, listName)
+            dawgFilename = '%s.%s' % (self.lang, dawgName)
+
+            if os.path.exists(listFilename):
+                cmd = ['wordlist2dawg', listFilename, dawgFilename, self.lang +'.unicharset' ]
+                inputs = [listFilename, self.lang + '.unicharset']
+
+                if self.cache.is_fresh(dawgName, cmd, inputs):
+                    print '%s is up to date' % dawgFilename
+                    continue
 
-        listFilename = '%s.word_list.txt' % self.lang
-        if os.path.exists(listFilename):
-            cmd = ['wordlist2dawg', listFilename, self.lang + '.word-dawg', self.lang +'.unicharset' ]
-            subprocess.call(cmd)
+                run_tool(cmd, [dawgFilename])
 
+                self.cache.record(dawgName, cmd, inputs, [dawgFilename])
+
+    @timed
     def run(self):
+        """Build and install the traineddata. Returns 1 if a stage failed,
+        otherwise 0."""
 
         filelist = sorted(os.listdir(os.getcwd()))
 
@@ -210,19 +496,56 @@ class AutoTrainer:
         print self.baselist
 
         self.get_language()
-        self.get_font_list()
 
-        self.generate_tr_files()
-        self.concatenate_files()
-        self.generate_unicharset()
-        self.do_mftraining()
-        self.do_cntraining()
-        self.rename_files()
-        self.generate_dawgs()
-        self.combine_data()
+        # save whatever was built, even if a later stage fails
+        try:
+            self.generate_tr_files()
+            self.get_font_list() # only the fonts with images left
+            self.concatenate_files()
+            self.generate_unicharset()
+            self.do_training()
+            self.generate_dawgs()
+            self.combine_data()
+        except StageError, e:
+            print '\nError: %s' % e
+            print 'Stopping, as the later stages need what it makes.'
+            return 1
+        finally:
+            self.cache.save()
+
         self.copy_traineddata()
 
+        return 0
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [-j jobs] [-f] [-d]')
+    parser.add_option('-j', '--jobs', dest='jobs', action='store', type='int',
+                      default=1, help='Run up to JOBS tesseract processes at once when generating the .tr files. 0 uses one per CPU. Defaults to 1.')
+    parser.add_option('-f', '--force', dest='force', action='store_true', default=False,
+                      help='Rebuild everything, even if the build cache says it is up to date.')
+    parser.add_option('-d', '--debug', dest='debug', action='store_true', default=False,
+                      help='Time each stage, and each tesseract job, writing a Chrome trace to autotrain-trace.json and printing a summary.')
+    (opts, args) = parser.parse_args()
+
+    if opts.debug:
+        timing.enable('autotrain-trace.json')
 
-if __name__ == "__main__":
     at = AutoTrainer()
-    at.run()
+    at.cache.enabled = not opts.force
+
+    if opts.jobs > 0:
+        at.jobs = opts.jobs
+    else:
+        at.jobs = cpu_count()
+
+    try:
+        status = at.run()
+    finally:
+        timing.finish()
+
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
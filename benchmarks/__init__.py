@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Benchmarks for moshPyTT and its helper scripts.
+#
+#       generate.py makes synthetic boxfiles and matching images of any size,
+#       scenarios.py holds the timed scenarios and run.py runs them, storing
+#       the results of each commit so that they can be compared. Run them
+#       from the top of the source tree, e.g.
+#
+#           python -m benchmarks.run
+#           python -m benchmarks.run -c <earlier commit>
+#           python -m benchmarks.generate -p 3 -o /tmp/eng.synthetic
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
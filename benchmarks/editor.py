@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       A headless stand-in for the moshPyTT window, for benchmarking the
+#       box operations without GTK.
+#
+#       The boxes are held in a BoxDocument, as they are in the editor, and
+#       the changes it announces are handled as the editor handles them:
+#       the box grid is kept in step, and each change is recorded on the
+#       undo stack as the text buffer's signal handlers record it.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+from boxdocument import BoxDocument
+from boxgrid import BoxGrid
+from undoredo import UndoRedoStack
+
+
+class HeadlessEditor:
+    """The box operations of MoshPyTT, on a BoxDocument"""
+
+    def __init__(self, text):
+
+        self.document = BoxDocument(text)
+
+        self.boxGrid = BoxGrid()
+        self.boxGrid.set_text(text)
+
+        self.undoRedoStack = UndoRedoStack()
+        self.blockUndoRedo = False # true while undoing
+
+        self.document.connect(self.on_document_changed)
+
+        self.topLine = self.btmLine = 0
+        self.boxList = []
+
+    def on_document_changed(self, firstLine, oldLines, newLines):
+
+        self.boxGrid.replace_lines(firstLine, len(oldLines), newLines)
+
+        if self.blockUndoRedo:
+            return
+
+        (offset, oldText, newText) = self.document.text_change(firstLine, oldLines, newLines)
+
+        self.undoRedoStack.begin_group()
+
+        if oldText:
+            self.undoRedoStack.add_item({'action': 'DEL', 'text': oldText, 'offset': offset})
+        if newText:
+            self.undoRedoStack.add_item({'action': 'INS', 'text': newText, 'offset': offset})
+
+        self.undoRedoStack.end_group()
+
+    def get_text(self):
+        return self.document.get_text()
+
+    def get_lines(self, firstLine, lastLine):
+        return self.document.get_lines(firstLine, lastLine)
+
+    def select(self, topLine, btmLine):
+        """Select some lines and read their boxes, as read_current_box does"""
+
+        self.topLine = topLine
+        self.btmLine = btmLine
+        (self.boxList, invalidLines) = self.document.get_boxes(topLine, btmLine)
+
+    def select_rect(self, x1, y1, x2, y2):
+        """Select the boxes touching a rectangle of the image"""
+
+        lines = self.boxGrid.lines_in_rect(x1, y1, x2, y2)
+        if lines:
+            self.select(min(lines), max(lines))
+
+    def edit_boxes(self, operation, *args):
+        """Run a box operation of the document and select what it leaves,
+        as edit_boxes does"""
+
+        self.undoRedoStack.begin_group()
+        lines = operation(self.topLine, self.btmLine, *args)
+        self.undoRedoStack.end_group()
+
+        if lines:
+            self.select(*lines)
+
+    # BOX OPERATIONS
+
+    def move_boxes(self, direction):
+        self.edit_boxes(self.document.move_boxes, direction, 1)
+
+    def stretch_boxes(self, direction, shrink):
+        self.edit_boxes(self.document.stretch_boxes, direction, -1 if shrink else 1)
+
+    def split_boxes(self):
+        self.edit_boxes(self.document.split_boxes)
+
+    def merge_boxes(self):
+        self.edit_boxes(self.document.merge_boxes)
+
+    def delete_boxes(self):
+        self.edit_boxes(self.document.delete_boxes)
+
+    def undo(self, count=1):
+        """Undo, applying the changes to the document as apply_changes
+        applies them to the buffer. Returns False if there was nothing to
+        undo."""
+
+        move = self.undoRedoStack.undo(count)
+        if move is None:
+            return False
+
+        (text, changes) = move
+
+        self.blockUndoRedo = True
+        try:
+            if text is not None: # restored from a checkpoint
+                self.document.set_text(text)
+
+            for (action, offset, changeText) in changes:
+                if action == 'INS':
+                    self.document.replace_text(offset, 0, changeText)
+                else:
+                    self.document.replace_text(offset, len(changeText), u'')
+        finally:
+            self.blockUndoRedo = False
+
+        return True
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Generator of synthetic boxfiles and matching images for the
+#       benchmarks.
+#
+#       The boxes are laid out like a page of text: lines of words made of
+#       glyphs whose sizes depend on whether they have ascenders or
+#       descenders, with a configurable mix of bold, italic and underlined
+#       words. The image has a black rectangle where each box is. With PIL
+#       it is a (multi-page) TIFF, otherwise a PGM file, one image per page.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import codecs
+import optparse
+import random
+import sys
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+from boxfile import ATTRIBUTE_PREFIXES
+
+
+# (glyphs, width, bottom, top) of each class of glyph, in units of the
+# x-height, measured up from the baseline
+GLYPH_CLASSES = [(u'acemnorsuvwxz', 0.55, 0.0, 1.0),
+                 (u'bdfhklt', 0.55, 0.0, 1.45),
+                 (u'gpqy', 0.55, -0.45, 1.0),
+                 (u'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 0.7, 0.0, 1.4),
+                 (u'0123456789', 0.55, 0.0, 1.4),
+                 (u'il', 0.2, 0.0, 1.45),
+                 (u'j', 0.25, -0.45, 1.45),
+                 (u'.,;:', 0.2, -0.25, 0.35),
+                 (u'\'"', 0.2, 1.0, 1.45),
+                 (u'-', 0.3, 0.4, 0.55),
+                 (u'!?', 0.25, 0.0, 1.45)]
+
+# how often each class is picked inside a word
+CLASS_WEIGHTS = [60, 18, 8, 5, 3, 4, 1, 0, 0, 1, 0]
+
+# the classes which may end a word
+PUNCTUATION = GLYPH_CLASSES[7:]
+
+
+def parse_mix(string):
+    """Parse an attribute mix like "bold=0.05,italic=0.1" into a dict of
+    the fraction of words with each attribute"""
+
+    mix = {'bold': 0.0, 'italic': 0.0, 'uline': 0.0}
+
+    for term in string.split(','):
+        if not term.strip():
+            continue
+
+        (name, fraction) = term.split('=')
+        if name.strip() not in mix:
+            raise ValueError('unknown attribute %s' % name)
+        mix[name.strip()] = float(fraction)
+
+    return mix
+
+
+class BoxfileGenerator:
+    """Makes the boxes of pages of synthetic text.
+
+    Every size is in pixels: xHeight is the height of a lower case x, and
+    the rest are in proportion, so the defaults look like 12pt text scanned
+    at 300dpi."""
+
+    def __init__(self, seed=0, xHeight=24, mix=None):
+
+        self.random = random.Random(seed)
+        self.xHeight = xHeight
+        self.mix = mix or parse_mix('bold=0.03,italic=0.05,uline=0.01')
+
+        self.classes = []
+        for (weight, glyphClass) in zip(CLASS_WEIGHTS, GLYPH_CLASSES):
+            self.classes.extend([glyphClass] * weight)
+
+    def page_size(self, lines, glyphs):
+        """The (width, height) of a page of lines of about glyphs each"""
+
+        x = self.xHeight
+        return (int(2 * 4 * x + glyphs * 0.62 * x), int(2 * 5 * x + lines * 2.2 * x))
+
+    def glyph(self, glyphClass):
+
+        (glyphs, width, bottom, top) = glyphClass
+        return (self.random.choice(glyphs), width, bottom, top)
+
+    def make_page(self, page, lines, glyphs):
+        """Return the boxes of a page as (text, bold, italic, uline, left,
+        bottom, right, top, page) tuples, in reading order"""
+
+        x = self.xHeight
+        rand = self.random
+        (width, height) = self.page_size(lines, glyphs)
+
+        boxes = []
+
+        for line in xrange(lines):
+            baseline = height - int(5 * x + (line + 1) * 2.2 * x)
+            left = 4 * x + rand.randint(0, x)
+            lineEnd = width - 4 * x
+
+            while True:
+                wordLength = rand.randint(1, 9)
+                flags = [rand.random() < self.mix[name] for name in ('bold', 'italic', 'uline')]
+
+                word = [self.glyph(rand.choice(self.classes)) for i in xrange(wordLength)]
+                if rand.random() < 0.15:
+                    word.append(self.glyph(rand.choice(PUNCTUATION)))
+
+                wordWidth = sum(int(glyph[1] * x) + int(0.08 * x) for glyph in word)
+                if left + wordWidth > lineEnd:
+                    break
+
+                for (text, glyphWidth, bottom, top) in word:
+                    right = left + max(1, int(glyphWidth * x * rand.uniform(0.85, 1.15)))
+                    boxes.append((text, flags[0], flags[1], flags[2],
+                                  left, baseline + int(bottom * x) + rand.randint(-1, 1),
+                                  right, baseline + int(top * x) + rand.randint(-1, 1),
+                                  page))
+                    left = right + int(0.08 * x) + rand.randint(0, 2)
+
+                left += int(0.45 * x)
+
+        return boxes
+
+    def make_boxfile(self, pages=1, lines=40, glyphs=60):
+        """Return the boxes of several pages (see make_page)"""
+
+        boxes = []
+        for page in xrange(pages):
+            boxes.extend(self.make_page(page, lines, glyphs))
+        return boxes
+
+
+def box_lines(boxes):
+    """The lines of a boxfile holding the boxes, with newlines"""
+
+    return [u'%s%s %d %d %d %d %d\n' % (ATTRIBUTE_PREFIXES[bold | italic << 1 | uline << 2],
+                                        text, left, bottom, right, top, page)
+            for (text, bold, italic, uline, left, bottom, right, top, page) in boxes]
+
+
+def write_boxfile(boxes, filename):
+
+    boxFile = codecs.open(filename, 'w', 'utf-8')
+    try:
+        boxFile.writelines(box_lines(boxes))
+    finally:
+        boxFile.close()
+
+
+def split_pages(boxes):
+    """Return the boxes of each page, in page order"""
+
+    pages = {}
+    for box in boxes:
+        pages.setdefault(box[8], []).append(box)
+
+    return [pages[page] for page in sorted(pages)]
+
+
+def write_image(boxes, size, basename):
+    """Draw the boxes, one image per page, and return the filename. The
+    image is a TIFF if PIL is available, otherwise a PGM."""
+
+    (width, height) = size
+
+    if Image is None:
+        filename = basename + '.pgm'
+
+        imageFile = open(filename, 'wb')
+        try:
+            for pageBoxes in split_pages(boxes):
+                rows = [bytearray('\xff' * width) for row in xrange(height)]
+
+                for (text, bold, italic, uline, left, bottom, right, top, page) in pageBoxes:
+                    (left, right) = (max(0, left), min(width, right))
+                    for y in xrange(max(0, height - top), min(height, height - bottom)):
+                        rows[y][left:right] = '\x00' * (right - left)
+
+                imageFile.write('P5\n%d %d\n255\n' % (width, height))
+                for row in rows:
+                    imageFile.write(str(row))
+        finally:
+            imageFile.close()
+
+        return filename
+
+    filename = basename + '.tif'
+
+    images = []
+    for pageBoxes in split_pages(boxes):
+        image = Image.new('1', size, 1)
+        draw = ImageDraw.Draw(image)
+        for (text, bold, italic, uline, left, bottom, right, top, page) in pageBoxes:
+            draw.rectangle((left, height - top, right - 1, height - bottom - 1), fill=0)
+        images.append(image)
+
+    if len(images) > 1:
+        images[0].save(filename, save_all=True, append_images=images[1:])
+    else:
+        images[0].save(filename)
+
+    return filename
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options] -o basename')
+    parser.add_option('-o', '--output', dest='output', action='store',
+                      help='Write BASENAME.box and the image, BASENAME.tif (or .pgm without PIL).')
+    parser.add_option('-p', '--pages', dest='pages', action='store', type='int', default=1,
+                      help='Number of pages. Defaults to 1.')
+    parser.add_option('-l', '--lines', dest='lines', action='store', type='int', default=40,
+                      help='Lines of text on each page. Defaults to 40.')
+    parser.add_option('-g', '--glyphs', dest='glyphs', action='store', type='int', default=60,
+                      help='Roughly how many glyphs wide a line is. Defaults to 60.')
+    parser.add_option('-x', '--x-height', dest='xHeight', action='store', type='int', default=24,
+                      help='Height of a lower case x in pixels. Defaults to 24.')
+    parser.add_option('-a', '--attributes', dest='attributes', action='store',
+                      default='bold=0.03,italic=0.05,uline=0.01',
+                      help='Fraction of words which are bold, italic and underlined, e.g. "bold=0.1,italic=0". Defaults to %default.')
+    parser.add_option('-s', '--seed', dest='seed', action='store', type='int', default=0,
+                      help='Random seed, so the same options give the same files. Defaults to 0.')
+    parser.add_option('-n', '--no-image', dest='image', action='store_false', default=True,
+                      help='Only write the boxfile.')
+    (opts, args) = parser.parse_args()
+
+    if not opts.output:
+        parser.print_help()
+        return 1
+
+    try:
+        mix = parse_mix(opts.attributes)
+    except ValueError, e:
+        parser.error('bad --attributes: %s' % e)
+
+    generator = BoxfileGenerator(opts.seed, opts.xHeight, mix)
+    boxes = generator.make_boxfile(opts.pages, opts.lines, opts.glyphs)
+
+    write_boxfile(boxes, opts.output + '.box')
+    print 'Wrote %d boxes on %d pages to %s.box' % (len(boxes), opts.pages, opts.output)
+
+    if opts.image:
+        filename = write_image(boxes, generator.page_size(opts.lines, opts.glyphs), opts.output)
+        print 'Wrote %s' % filename
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
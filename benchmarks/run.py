@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Runs the benchmark scenarios and stores the results of each commit.
+#
+#       The results go in benchmarks/results/<commit>.json (with -dirty
+#       added if the tree has uncommitted changes), so that a later run can
+#       be compared with them using -c.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import gc
+import glob
+import json
+import optparse
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from timeit import default_timer
+
+from benchmarks.scenarios import SCENARIOS, BenchmarkData
+
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def git(*args):
+    """The output of a git command, or None if it failed"""
+
+    try:
+        process = subprocess.Popen(('git',) + args, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except OSError:
+        return None
+
+    (out, err) = process.communicate()
+    if process.returncode != 0:
+        return None
+
+    return out.strip()
+
+
+def current_commit():
+    """The commit being benchmarked, and whether the tree has changed
+    since it"""
+
+    commit = git('rev-parse', 'HEAD') or 'unknown'
+    dirty = bool(git('status', '--porcelain', '--untracked-files=no'))
+
+    return (commit, dirty)
+
+
+def time_scenario(setup, data, repeat):
+    """Time a scenario repeat times, each after a fresh setup. Returns the
+    times in seconds and the number of items."""
+
+    times = []
+
+    for i in xrange(repeat):
+        (run, items) = setup(data)
+
+        # as timeit does, so a collection doesn't land in one of the runs
+        gc.collect()
+        gc.disable()
+        try:
+            start = default_timer()
+            run()
+            times.append(default_timer() - start)
+        finally:
+            gc.enable()
+
+    return (times, items)
+
+
+def load_results(reference, directory):
+    """Load stored results given a filename, or a commit (or anything git
+    can turn into one, such as HEAD~1)"""
+
+    if os.path.isfile(reference):
+        filename = reference
+    else:
+        commit = git('rev-parse', reference) or reference
+        matches = sorted(glob.glob(os.path.join(directory, commit + '*.json')))
+
+        # prefer the results of the commit itself to those of a dirty tree
+        if not matches:
+            return None
+        filename = matches[0]
+
+    resultsFile = open(filename, 'r')
+    try:
+        return json.load(resultsFile)
+    finally:
+        resultsFile.close()
+
+
+def save_results(results, directory):
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    name = results['commit'] + ('-dirty' if results['dirty'] else '')
+    filename = os.path.join(directory, name + '.json')
+
+    tempFilename = filename + '.tmp'
+    resultsFile = open(tempFilename, 'w')
+    try:
+        json.dump(results, resultsFile, indent=2, sort_keys=True)
+    finally:
+        resultsFile.close()
+
+    os.rename(tempFilename, filename)
+
+    return filename
+
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options] [scenario name filter ...]')
+    parser.add_option('-p', '--pages', dest='pages', action='store', type='int', default=5,
+                      help='Pages in the synthetic boxfile. Defaults to 5.')
+    parser.add_option('-l', '--lines', dest='lines', action='store', type='int', default=50,
+                      help='Lines on each page. Defaults to 50.')
+    parser.add_option('-g', '--glyphs', dest='glyphs', action='store', type='int', default=70,
+                      help='Roughly how many glyphs wide a line is. Defaults to 70.')
+    parser.add_option('-r', '--repeat', dest='repeat', action='store', type='int', default=5,
+                      help='Time each scenario REPEAT times, and keep the best and the median. Defaults to 5.')
+    parser.add_option('-c', '--compare', dest='compare', action='store',
+                      help='Compare with the stored results of COMPARE: a commit, or a results file.')
+    parser.add_option('-t', '--tolerance', dest='tolerance', action='store', type='float', default=0.1,
+                      help='With -c, flag scenarios more than TOLERANCE slower (as a fraction). Defaults to 0.1.')
+    parser.add_option('-d', '--directory', dest='directory', action='store', default=RESULTS_DIRECTORY,
+                      help='Where the results are stored. Defaults to %default.')
+    parser.add_option('-n', '--no-save', dest='save', action='store_false', default=True,
+                      help="Don't store the results.")
+    (opts, args) = parser.parse_args()
+
+    scenarios = [(name, setup) for (name, setup) in SCENARIOS
+                 if not args or any(pattern in name for pattern in args)]
+
+    if not scenarios:
+        print >> sys.stderr, 'No scenarios match %s' % ' '.join(args)
+        return 1
+
+    reference = None
+    if opts.compare:
+        reference = load_results(opts.compare, opts.directory)
+        if reference is None:
+            print >> sys.stderr, 'No stored results for %s' % opts.compare
+            return 1
+
+    (commit, dirty) = current_commit()
+
+    results = {'commit': commit,
+               'dirty': dirty,
+               'date': datetime.now().isoformat(),
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'parameters': {'pages': opts.pages, 'lines': opts.lines,
+                              'glyphs': opts.glyphs, 'repeat': opts.repeat},
+               'scenarios': {}}
+
+    data = BenchmarkData(opts.pages, opts.lines, opts.glyphs)
+
+    print 'Commit %s%s, %d boxes on %d pages' % (commit[:10], ' (dirty)' if dirty else '',
+                                                  len(data.boxes), opts.pages)
+    print
+    print '%-32s %8s %10s %10s %10s' % ('scenario', 'items', 'best ms', 'median ms', 'us/item'),
+    print ' %10s' % 'vs ref' if reference else ''
+
+    slower = []
+
+    try:
+        for (name, setup) in scenarios:
+            (times, items) = time_scenario(setup, data, opts.repeat)
+            times.sort()
+
+            best = times[0]
+            median = times[len(times) // 2]
+
+            results['scenarios'][name] = {'items': items, 'best': best,
+                                          'median': median, 'times': times}
+
+            print '%-32s %8d %10.2f %10.2f %10.2f' % (name, items, best * 1000,
+                                                       median * 1000, best * 1e6 / max(items, 1)),
+
+            old = reference and reference['scenarios'].get(name)
+            if old:
+                # per item, in case the reference was run at another size
+                ratio = (best / max(items, 1)) / (old['best'] / max(old['items'], 1))
+                flag = ''
+                if ratio > 1 + opts.tolerance:
+                    flag = ' SLOWER'
+                    slower.append(name)
+                print ' %9.2fx%s' % (ratio, flag)
+            else:
+                print
+    finally:
+        data.close()
+
+    if opts.save:
+        print '\nSaved %s' % save_results(results, opts.directory)
+
+    if reference:
+        if reference['parameters'] != results['parameters']:
+            print 'Note: the reference was run with %s' % reference['parameters']
+
+        if slower:
+            print '%d scenario(s) slower than %s: %s' % (len(slower), opts.compare, ', '.join(slower))
+            return 2
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
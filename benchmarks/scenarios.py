@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       The timed scenarios of the benchmark suite.
+#
+#       Each scenario is a setup function which takes a BenchmarkData and
+#       returns (run, items): run is the function that is timed, and items
+#       is how many boxes (or lines, or edits) it handles, to give a time per
+#       item. Setup is called again before every timed run, so a scenario
+#       may change what it was given.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import random
+import sys
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from boxfile import TesseractBox, BoxTable, parse_lines, build_index
+from mergeboxes import merge_nearby_boxes
+from editboxes import EditRule, edit_page, new_stats
+from boxsplit import split_table
+from lintboxes import lint_table, read_lines
+from autotrain import AutoTrainer, BuildCache
+
+from benchmarks.generate import BoxfileGenerator, box_lines, split_pages
+from benchmarks.editor import HeadlessEditor
+
+
+# the number of edits made by the editor scenarios, at most
+EDIT_COUNT = 2000
+
+
+class BenchmarkData:
+    """Synthetic boxfiles for the scenarios, made once and shared"""
+
+    def __init__(self, pages=5, lines=50, glyphs=70, seed=0):
+
+        self.pages = pages
+        self.generator = BoxfileGenerator(seed)
+
+        self.size = self.generator.page_size(lines, glyphs)
+        self.boxes = self.generator.make_boxfile(pages, lines, glyphs)
+        self.lines = box_lines(self.boxes)
+        self.text = u''.join(self.lines).rstrip('\n')
+
+        self.directory = None
+
+    def temp_directory(self):
+        """A scratch directory, removed by close"""
+
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='moshpytt-benchmark-')
+        return self.directory
+
+    def close(self):
+
+        if self.directory is not None:
+            shutil.rmtree(self.directory)
+            self.directory = None
+
+
+# PARSING AND WRITING BOXES
+
+def parse_tesseractbox(data):
+
+    lines = data.lines
+    return (lambda: [TesseractBox(line) for line in lines], len(lines))
+
+
+def parse_parse_lines(data):
+
+    lines = data.lines
+    return (lambda: parse_lines(lines), len(lines))
+
+
+def parse_boxtable(data):
+
+    lines = data.lines
+    return (lambda: BoxTable.from_lines(lines), len(lines))
+
+
+def make_string_tesseractbox(data):
+
+    (boxes, invalidLines) = parse_lines(data.lines)
+    return (lambda: [box.make_string() for box in boxes], len(boxes))
+
+
+def make_string_boxtable(data):
+
+    table = BoxTable.from_lines(data.lines)
+    return (table.make_string, len(table))
+
+
+def write_boxfile(data, name):
+    """Write the boxfile to the scratch directory, once"""
+
+    filename = os.path.join(data.temp_directory(), name)
+
+    if not os.path.exists(filename):
+        boxFile = open(filename, 'wb')
+        boxFile.write(u''.join(data.lines).encode('utf-8'))
+        boxFile.close()
+
+    return filename
+
+
+def read_boxtable_file(data):
+
+    filename = write_boxfile(data, 'plain.box')
+    return (lambda: BoxTable.from_file(filename), len(data.lines))
+
+
+def read_boxtable_index(data):
+    """Read a boxfile through its sidecar index"""
+
+    filename = write_boxfile(data, 'indexed.box')
+    build_index(filename)
+    return (lambda: BoxTable.from_file(filename), len(data.lines))
+
+
+# HELPER SCRIPTS
+
+class MergeOptions:
+    threshold = 1
+
+
+def mergeboxes_merge_nearby_boxes(data):
+
+    (boxes, invalidLines) = parse_lines(data.lines)
+    return (lambda: merge_nearby_boxes(MergeOptions(), boxes), len(boxes))
+
+
+def editboxes_edit_page(data):
+    """Run a typical edit script over every page"""
+
+    rules = [EditRule(rule) for rule in (u'page=1 : move RIGHT 2', u'width>30 : split',
+                                         u'height<12 : delete', u'/[0-9]/ : italic')]
+    pages = [BoxTable.from_lines(box_lines(page)) for page in split_pages(data.boxes)]
+
+    def run():
+        stats = new_stats(rules)
+        for page in pages:
+            edit_page(page, rules, stats)
+
+    return (run, len(data.boxes))
+
+
+def lintboxes_lint_table(data):
+    """Run every check over the whole boxfile"""
+
+    (table, lineNumbers) = read_lines(data.lines)
+    sizes = [data.size] * data.pages
+
+    return (lambda: lint_table(table, lineNumbers, sizes), len(table))
+
+
+def autotrain_concatenate_files(data):
+    """Concatenate a boxfile and a .tr file per page, split over two
+    fonts, as autotrain does before training"""
+
+    directory = os.path.join(data.temp_directory(), 'autotrain')
+
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+
+        pageText = u''.join(data.lines).encode('utf-8')
+        for page in xrange(data.pages):
+            name = os.path.join(directory, 'eng.font%d.exp%d' % (page % 2, page))
+            for (extension, contents) in (('.box', pageText), ('.tr', os.urandom(len(pageText)))):
+                outFile = open(name + extension, 'wb')
+                outFile.write(contents)
+                outFile.close()
+
+    trainer = AutoTrainer()
+    trainer.cache = BuildCache(os.path.join(directory, 'autotrain.cache'), enabled=False)
+    trainer.lang = 'eng'
+    trainer.baselist = ['eng.font%d.exp%d' % (page % 2, page) for page in xrange(data.pages)]
+    trainer.fontList = sorted(set(name.split('.')[1] for name in trainer.baselist))
+
+    def run():
+        # autotrain works in the current directory, and prints as it goes
+        (cwd, stdout) = (os.getcwd(), sys.stdout)
+        os.chdir(directory)
+        sys.stdout = StringIO()
+        try:
+            trainer.concatenate_files()
+        finally:
+            sys.stdout = stdout
+            os.chdir(cwd)
+
+    return (run, len(data.lines) * data.pages)
+
+
+# SPLITTING BOXES
+
+class PageRaster:
+    """A grey page image with a black rectangle for each box, for
+    box_cuts, without needing PIL"""
+
+    def __init__(self, boxes, size):
+
+        (self.width, self.height) = size
+        self.pixels = bytearray('\xff' * (self.width * self.height))
+
+        for (text, bold, italic, uline, left, bottom, right, top, page) in boxes:
+            (left, right) = (max(0, left), min(self.width, right))
+            for y in xrange(max(0, self.height - top), min(self.height, self.height - bottom)):
+                self.pixels[y * self.width + left:y * self.width + right] = '\x00' * (right - left)
+
+    def read_gray(self, left, top, right, bottom):
+
+        width = self.width
+        rows = [self.pixels[y * width + left:y * width + right] for y in xrange(top, bottom)]
+        return (str(bytearray().join(rows)), right - left, bottom - top)
+
+
+def split_box_cuts(data):
+    """Split boxes made by merging neighbouring glyphs, at the gap in the
+    image between them"""
+
+    boxes = split_pages(data.boxes)[0]
+    image = PageRaster(boxes, data.size)
+
+    # the glyphs of a word are a few pixels apart
+    table = BoxTable.from_lines(box_lines(boxes))
+    pairs = [row for row in xrange(0, len(table) - 1, 2)
+             if 0 <= table.left[row + 1] - table.right[row] <= 4]
+
+    merged = table.take(pairs)
+    for (position, row) in enumerate(pairs):
+        merged.right[position] = table.right[row + 1]
+        merged.top[position] = max(table.top[row], table.top[row + 1])
+        merged.bottom[position] = min(table.bottom[row], table.bottom[row + 1])
+
+    rows = range(len(merged))
+    return (lambda: split_table(merged, rows, 2, image), len(rows))
+
+
+# THE EDITOR
+
+def editor_load(data):
+
+    text = data.text
+    return (lambda: HeadlessEditor(text), len(data.lines))
+
+
+def editor_navigate(data):
+    """Select every box in turn, as Space does"""
+
+    editor = HeadlessEditor(data.text)
+
+    def run():
+        for line in xrange(editor.document.line_count()):
+            editor.select(line, line)
+
+    return (run, editor.document.line_count())
+
+
+def editor_select_rect(data):
+    """Drag out a rectangle around each of many boxes in the image. Only
+    the first page is loaded, as the editor does with several pages."""
+
+    pageBoxes = [box for box in data.boxes if box[8] == 0]
+    editor = HeadlessEditor(u''.join(box_lines(pageBoxes)).rstrip('\n'))
+
+    height = data.size[1]
+    editor.boxGrid.imageHeight = height
+
+    boxes = pageBoxes[::max(1, len(pageBoxes) // EDIT_COUNT)]
+
+    def run():
+        for (text, bold, italic, uline, left, bottom, right, top, page) in boxes:
+            editor.select_rect(left, height - top, right, height - bottom)
+
+    return (run, len(boxes))
+
+
+def editor_move_stretch(data):
+    """Nudge and grow single boxes with the keyboard"""
+
+    editor = HeadlessEditor(data.text)
+    count = min(EDIT_COUNT, editor.document.line_count())
+
+    def run():
+        for line in xrange(count):
+            editor.select(line, line)
+            editor.move_boxes('RIGHT')
+            editor.stretch_boxes('ALL', False)
+
+    return (run, 2 * count)
+
+
+def editor_scattered_edits(data):
+    """Nudge boxes all over the file, each edit far from the last"""
+
+    editor = HeadlessEditor(data.text)
+
+    rand = random.Random(0)
+    lines = [rand.randrange(editor.document.line_count()) for i in xrange(EDIT_COUNT)]
+
+    def run():
+        for line in lines:
+            editor.select(line, line)
+            editor.move_boxes('TOP')
+
+    return (run, len(lines))
+
+
+def editor_split_merge(data):
+    """Split boxes in two and merge them back"""
+
+    editor = HeadlessEditor(data.text)
+    count = min(EDIT_COUNT, editor.document.line_count())
+
+    def run():
+        for line in xrange(count):
+            editor.select(line, line)
+            editor.split_boxes()
+            editor.select(line, line + 1)
+            editor.merge_boxes()
+
+    return (run, 2 * count)
+
+
+def editor_undo(data):
+    """Undo a run of box operations one at a time"""
+
+    editor = HeadlessEditor(data.text)
+    count = min(EDIT_COUNT, editor.document.line_count())
+
+    for line in xrange(count):
+        editor.select(line, line)
+        editor.move_boxes('LEFT')
+
+    def run():
+        while editor.undo():
+            pass
+
+    return (run, count)
+
+
+SCENARIOS = [('parse.TesseractBox', parse_tesseractbox),
+             ('parse.parse_lines', parse_parse_lines),
+             ('parse.BoxTable', parse_boxtable),
+             ('read.BoxTable', read_boxtable_file),
+             ('read.BoxTable_index', read_boxtable_index),
+             ('make_string.TesseractBox', make_string_tesseractbox),
+             ('make_string.BoxTable', make_string_boxtable),
+             ('mergeboxes.merge_nearby_boxes', mergeboxes_merge_nearby_boxes),
+             ('editboxes.edit_page', editboxes_edit_page),
+             ('lintboxes.lint_table', lintboxes_lint_table),
+             ('split.box_cuts', split_box_cuts),
+             ('autotrain.concatenate_files', autotrain_concatenate_files),
+             ('editor.load', editor_load),
+             ('editor.navigate', editor_navigate),
+             ('editor.select_rect', editor_select_rect),
+             ('editor.move_stretch', editor_move_stretch),
+             ('editor.scattered_edits', editor_scattered_edits),
+             ('editor.split_merge', editor_split_merge),
+             ('editor.undo', editor_undo)]
@@ -0,0 +1,669 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       The boxfile being edited in moshPyTT, independent of GTK.
+#
+#       A BoxDocument keeps the lines of a boxfile in a LineTree, a balanced
+#       tree of chunks of lines, so that finding a line or a character
+#       offset and replacing a run of lines take O(log n) time however long
+#       the file is. The box operations of the editor (move, stretch, split,
+#       merge, delete...) are methods of the document, and every change is
+#       passed on to the functions connected to it, which is how the text
+#       buffer, the box grid and the search results keep up.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import random
+from itertools import izip
+
+from boxfile import TesseractBox, parse_columns, make_boxes
+from boxsplit import box_cuts
+
+
+CHUNK_SIZE = 64 # lines in each chunk of a LineTree when it is built
+
+
+class Chunk(object):
+    """A node of a LineTree: a run of consecutive lines, and the totals of
+    the subtree under it"""
+
+    __slots__ = ('lines', 'entries', 'chars', 'left', 'right',
+                 'size', 'lineCount', 'charCount')
+
+    def __init__(self, lines, entries=None):
+
+        self.lines = lines
+
+        # per line: None if not parsed yet, a TesseractBox, the text of an
+        # invalid line, or '' for a blank line
+        self.entries = entries or [None] * len(lines)
+
+        # every line is followed by a newline, even the last one here
+        self.chars = sum(map(len, lines)) + len(lines)
+
+        self.left = None
+        self.right = None
+        self.update()
+
+    def update(self):
+        """Recount the totals after a child has changed"""
+
+        (left, right) = (self.left, self.right)
+
+        if left is None and right is None:
+            (self.size, self.lineCount, self.charCount) = (1, len(self.lines), self.chars)
+        elif right is None:
+            self.size = left.size + 1 # chunks
+            self.lineCount = left.lineCount + len(self.lines)
+            self.charCount = left.charCount + self.chars
+        elif left is None:
+            self.size = right.size + 1
+            self.lineCount = right.lineCount + len(self.lines)
+            self.charCount = right.charCount + self.chars
+        else:
+            self.size = left.size + right.size + 1
+            self.lineCount = left.lineCount + right.lineCount + len(self.lines)
+            self.charCount = left.charCount + right.charCount + self.chars
+
+
+def make_chunks(lines, entries=None):
+
+    return [Chunk(lines[start:start + CHUNK_SIZE],
+                  entries and entries[start:start + CHUNK_SIZE])
+            for start in xrange(0, len(lines), CHUNK_SIZE)]
+
+
+def build_tree(chunks, start=0, end=None):
+    """Join chunks[start:end] into a perfectly balanced tree"""
+
+    if end is None:
+        end = len(chunks)
+
+    if start >= end:
+        return None
+
+    middle = (start + end) // 2
+
+    node = chunks[middle]
+    node.left = build_tree(chunks, start, middle)
+    node.right = build_tree(chunks, middle + 1, end)
+    node.update()
+
+    return node
+
+
+def merge_trees(first, second):
+    """Join two trees, with the lines of first before those of second.
+
+    The root is picked at random, weighted by the number of chunks on each
+    side, which keeps the tree balanced whatever order the edits come in
+    (it is a randomised binary search tree)."""
+
+    if first is None:
+        return second
+    if second is None:
+        return first
+
+    if random.random() * (first.size + second.size) < first.size:
+        first.right = merge_trees(first.right, second)
+        first.update()
+        return first
+
+    second.left = merge_trees(first, second.left)
+    second.update()
+    return second
+
+
+def split_tree(node, count):
+    """Split a tree into (the first count lines, the rest), splitting a
+    chunk in two if need be"""
+
+    if node is None:
+        return (None, None)
+
+    leftCount = node.left.lineCount if node.left is not None else 0
+
+    if count <= leftCount:
+        (first, rest) = split_tree(node.left, count)
+        node.left = rest
+        node.update()
+        return (first, node)
+
+    count -= leftCount
+
+    if count >= len(node.lines):
+        (first, rest) = split_tree(node.right, count - len(node.lines))
+        node.right = first
+        node.update()
+        return (node, rest)
+
+    head = Chunk(node.lines[:count], node.entries[:count])
+    tail = Chunk(node.lines[count:], node.entries[count:])
+
+    return (merge_trees(node.left, head), merge_trees(tail, node.right))
+
+
+def remove_first(node):
+    """Take the first chunk off a tree. Returns (tree, chunk)."""
+
+    if node.left is None:
+        rest = node.right
+        node.right = None
+        node.update()
+        return (rest, node)
+
+    (node.left, chunk) = remove_first(node.left)
+    node.update()
+    return (node, chunk)
+
+
+def remove_last(node):
+    """Take the last chunk off a tree. Returns (tree, chunk)."""
+
+    if node.right is None:
+        rest = node.left
+        node.left = None
+        node.update()
+        return (rest, node)
+
+    (node.right, chunk) = remove_last(node.right)
+    node.update()
+    return (node, chunk)
+
+
+def collect_slices(node, first, end, slices):
+    """Append (chunk, start, stop) to slices for each run of the lines from
+    first to end - 1 (counted from the first line under node), in order"""
+
+    while node is not None and first < end:
+        leftCount = node.left.lineCount if node.left is not None else 0
+
+        if first < leftCount:
+            collect_slices(node.left, first, min(end, leftCount), slices)
+
+        chunkEnd = leftCount + len(node.lines)
+
+        if first < chunkEnd and end > leftCount:
+            slices.append((node, max(first - leftCount, 0), min(end, chunkEnd) - leftCount))
+
+        # carry on down the right, where the lines are counted from chunkEnd
+        first = max(first - chunkEnd, 0)
+        end -= chunkEnd
+        node = node.right
+
+
+class LineTree(object):
+    """The lines of a text in a balanced binary tree of chunks of lines.
+
+    Each node counts the lines and characters under it, so a line can be
+    found by number or by character offset by walking down from the root,
+    and a run of lines is replaced by splitting the tree either side of it
+    and joining it up again round the new lines."""
+
+    def __init__(self, lines):
+
+        self.root = build_tree(make_chunks(lines))
+
+    def __len__(self):
+
+        if self.root is None:
+            return 0
+        return self.root.lineCount
+
+    def slices(self, first, end, root=None):
+        """The (chunk, start, stop) runs holding the lines from first to
+        end - 1, of the whole tree or the subtree root"""
+
+        if root is None:
+            # a selection is usually inside one chunk
+            (path, start) = self.find(first)
+            if path is not None and start + end - first <= len(path[-1].lines):
+                return [(path[-1], start, start + end - first)]
+
+        slices = []
+        collect_slices(root or self.root, first, end, slices)
+        return slices
+
+    def get_lines(self, first, end):
+        """The lines from first to end - 1, as a list"""
+
+        lines = []
+        for (chunk, start, stop) in self.slices(first, end):
+            lines.extend(chunk.lines[start:stop])
+        return lines
+
+    def find(self, line):
+        """Return (path, index): the nodes from the root down to the chunk
+        holding a line, and where the line is in that chunk, or (None,
+        None) if there is no such line"""
+
+        path = []
+        node = self.root
+
+        while node is not None:
+            path.append(node)
+
+            leftCount = node.left.lineCount if node.left is not None else 0
+
+            if line < leftCount:
+                node = node.left
+                continue
+
+            line -= leftCount
+
+            if line < len(node.lines):
+                return (path, line)
+
+            line -= len(node.lines)
+            node = node.right
+
+        return (None, None)
+
+    def replace(self, first, count, lines, entries=None):
+        """Replace count lines starting at first with lines, which may be
+        empty, and entries, their parsed boxes if known. Returns the lines
+        which were replaced."""
+
+        # most edits are of a line or two: change the chunk they are in,
+        # and the totals above it, without reshaping the tree
+        (path, start) = self.find(first)
+
+        if path is not None:
+            chunk = path[-1]
+            newLength = len(chunk.lines) - count + len(lines)
+
+            if start + count <= len(chunk.lines) and 0 < newLength <= 2 * CHUNK_SIZE:
+                oldLines = chunk.lines[start:start + count]
+
+                chunk.lines[start:start + count] = lines
+                chunk.entries[start:start + count] = entries or [None] * len(lines)
+
+                lineChange = len(lines) - count
+                charChange = sum(map(len, lines)) - sum(map(len, oldLines)) + lineChange
+
+                chunk.chars += charChange
+                for node in path:
+                    node.lineCount += lineChange
+                    node.charCount += charChange
+
+                return oldLines
+
+        (before, rest) = split_tree(self.root, first)
+        (old, after) = split_tree(rest, count)
+
+        oldLines = []
+        if old is not None:
+            for (chunk, start, stop) in self.slices(0, count, old):
+                oldLines.extend(chunk.lines[start:stop])
+
+        lines = list(lines)
+        entries = list(entries) if entries else [None] * len(lines)
+
+        # edits split chunks, so take small ones either side of the new
+        # lines in with them, or the tree would fill up with tiny chunks
+        if before is not None:
+            (before, chunk) = remove_last(before)
+            if len(chunk.lines) < CHUNK_SIZE // 2:
+                lines[:0] = chunk.lines
+                entries[:0] = chunk.entries
+            else:
+                before = merge_trees(before, chunk)
+
+        if after is not None:
+            (after, chunk) = remove_first(after)
+            if len(chunk.lines) < CHUNK_SIZE // 2:
+                lines.extend(chunk.lines)
+                entries.extend(chunk.entries)
+            else:
+                after = merge_trees(chunk, after)
+
+        middle = build_tree(make_chunks(lines, entries))
+        self.root = merge_trees(merge_trees(before, middle), after)
+
+        return oldLines
+
+    def offset_of_line(self, line):
+        """The character offset of the start of a line. The line after the
+        last one starts one past the end of the text."""
+
+        node = self.root
+        offset = 0
+
+        while node is not None:
+            (leftCount, leftChars) = (0, 0)
+            if node.left is not None:
+                (leftCount, leftChars) = (node.left.lineCount, node.left.charCount)
+
+            if line < leftCount:
+                node = node.left
+                continue
+
+            line -= leftCount
+            offset += leftChars
+
+            if line < len(node.lines):
+                return offset + sum(map(len, node.lines[:line])) + line
+
+            line -= len(node.lines)
+            offset += node.chars
+            node = node.right
+
+        if line > 0:
+            raise IndexError('line out of range')
+
+        return offset
+
+    def line_at_offset(self, offset):
+        """The (line, column) of a character offset"""
+
+        node = self.root
+        line = 0
+
+        while node is not None:
+            (leftCount, leftChars) = (0, 0)
+            if node.left is not None:
+                (leftCount, leftChars) = (node.left.lineCount, node.left.charCount)
+
+            if offset < leftChars:
+                node = node.left
+                continue
+
+            offset -= leftChars
+            line += leftCount
+
+            if offset < node.chars:
+                for length in map(len, node.lines):
+                    if offset <= length:
+                        return (line, offset)
+                    offset -= length + 1
+                    line += 1
+
+            offset -= node.chars
+            line += len(node.lines)
+            node = node.right
+
+        raise IndexError('offset out of range')
+
+
+def parse_entries(lines):
+    """The entry of each line, as kept by Chunk: a TesseractBox, the text of
+    an invalid line, or '' for a blank line"""
+
+    entries = [''] * len(lines)
+
+    (attributes, numbers, lineNumbers, invalidLines) = parse_columns(lines, 0)
+
+    for (lineNumber, box) in izip(lineNumbers, make_boxes(attributes, numbers)):
+        entries[lineNumber] = box
+
+    for (lineNumber, line) in invalidLines:
+        entries[lineNumber] = line
+
+    return entries
+
+
+def copy_box(box):
+    """A copy of a TesseractBox, for the operations to change"""
+
+    newBox = TesseractBox.__new__(TesseractBox)
+
+    for name in TesseractBox.__slots__:
+        setattr(newBox, name, getattr(box, name))
+
+    return newBox
+
+
+def to_unicode(text):
+    """Text from a gtk.TextBuffer is UTF-8"""
+
+    if isinstance(text, str):
+        return text.decode('utf-8')
+    return text
+
+
+class BoxDocument(object):
+    """A boxfile being edited: its lines, their boxes, and the operations
+    on them.
+
+    Lines are counted from 0, and there is always at least one, as in a
+    text buffer. Each line is parsed the first time its boxes are asked
+    for, and kept until it is replaced. The box operations take the first
+    and last of the lines to work on, and return the (first, last) lines
+    of the boxes they leave, to be selected, or None if there were no
+    boxes to work on."""
+
+    def __init__(self, text=u''):
+
+        self.tree = LineTree(to_unicode(text).split('\n'))
+        self.listeners = []
+
+    def connect(self, callback):
+        """Call callback(firstLine, oldLines, newLines) after every change,
+        where oldLines, starting at firstLine, have been replaced with
+        newLines"""
+
+        self.listeners.append(callback)
+
+    def disconnect(self, callback):
+
+        self.listeners.remove(callback)
+
+    def line_count(self):
+
+        return len(self.tree)
+
+    def get_lines(self, firstLine, lastLine):
+        """The text of the lines from firstLine to lastLine inclusive, as a
+        list"""
+
+        return self.tree.get_lines(firstLine, lastLine + 1)
+
+    def get_text(self):
+
+        return u'\n'.join(self.tree.get_lines(0, len(self.tree)))
+
+    def offset_of_line(self, line):
+
+        return self.tree.offset_of_line(line)
+
+    def line_at_offset(self, offset):
+        """The (line, column) of a character offset"""
+
+        return self.tree.line_at_offset(offset)
+
+    def get_boxes(self, firstLine, lastLine):
+        """Return (boxes, invalidLines) for the lines from firstLine to
+        lastLine inclusive, like parse_lines"""
+
+        boxes = []
+        invalidLines = []
+
+        lineNumber = firstLine
+
+        for (chunk, start, stop) in self.tree.slices(firstLine, lastLine + 1):
+            entries = chunk.entries
+
+            if None in entries[start:stop]:
+                entries[start:stop] = parse_entries(chunk.lines[start:stop])
+
+            for entry in entries[start:stop]:
+                if isinstance(entry, TesseractBox):
+                    boxes.append(entry)
+                elif entry:
+                    invalidLines.append((lineNumber, entry))
+                lineNumber += 1
+
+        return (boxes, invalidLines)
+
+    # CHANGES
+
+    def replace_lines(self, firstLine, oldCount, newLines, boxes=None):
+        """Replace oldCount lines starting at firstLine with newLines, which
+        may be empty to delete them. boxes may give the boxes of the new
+        lines, if they are all boxes, so they needn't be parsed again."""
+
+        if not oldCount and not newLines:
+            return
+
+        if not newLines and oldCount == self.line_count():
+            newLines = [u''] # the document still has a line
+            boxes = None
+
+        oldLines = self.tree.replace(firstLine, oldCount, newLines, boxes)
+
+        for callback in self.listeners:
+            callback(firstLine, oldLines, newLines)
+
+    def replace_text(self, offset, length, text):
+        """Replace length characters at a character offset with text, as an
+        edit of a text buffer does"""
+
+        (firstLine, column) = self.line_at_offset(offset)
+        lines = self.get_lines(firstLine, firstLine)
+
+        if column + length <= len(lines[0]):
+            (lastLine, endColumn) = (firstLine, column + length)
+        else:
+            (lastLine, endColumn) = self.line_at_offset(offset + length)
+            lines = self.get_lines(firstLine, lastLine)
+
+        newText = lines[0][:column] + to_unicode(text) + lines[-1][endColumn:]
+
+        self.replace_lines(firstLine, lastLine - firstLine + 1, newText.split('\n'))
+
+    def set_text(self, text):
+
+        self.replace_lines(0, self.line_count(), to_unicode(text).split('\n'))
+
+    def text_change(self, firstLine, oldLines, newLines):
+        """The change a listener was told of, as a change to the text:
+        (offset, oldText, newText), where oldText at the character offset
+        was replaced with newText. Only right for the latest change."""
+
+        oldText = u'\n'.join(oldLines)
+        newText = u'\n'.join(newLines)
+
+        offset = self.offset_of_line(firstLine)
+
+        if oldLines and newLines:
+            return (offset, oldText, newText)
+
+        # whole lines are added or removed with a newline: the one after
+        # them, or at the end of the text, the one before them
+        if firstLine + len(newLines) < self.line_count():
+            if newLines:
+                return (offset, u'', newText + u'\n')
+            return (offset, oldText + u'\n', u'')
+
+        if newLines:
+            return (offset - 1, u'', u'\n' + newText)
+        return (offset - 1, u'\n' + oldText, u'')
+
+    # BOX OPERATIONS
+
+    def replace_boxes(self, firstLine, lastLine, boxes):
+        """Replace the lines from firstLine to lastLine with boxes"""
+
+        self.replace_lines(firstLine, lastLine - firstLine + 1,
+                           [box.make_string() for box in boxes], boxes)
+
+        return (firstLine, firstLine + max(len(boxes), 1) - 1)
+
+    def edit_boxes(self, firstLine, lastLine, edit):
+        """Call edit(box) on a copy of each box on the lines, and write them
+        back. The boxes already parsed are left alone."""
+
+        boxes = [copy_box(box) for box in self.get_boxes(firstLine, lastLine)[0]]
+
+        if not boxes:
+            return None
+
+        for box in boxes:
+            edit(box)
+
+        return self.replace_boxes(firstLine, lastLine, boxes)
+
+    def move_boxes(self, firstLine, lastLine, direction, step=1):
+
+        return self.edit_boxes(firstLine, lastLine, lambda box: box.move(direction, step))
+
+    def stretch_boxes(self, firstLine, lastLine, direction, step=1):
+        """Stretch the boxes on one side, or shrink them if step is
+        negative"""
+
+        return self.edit_boxes(firstLine, lastLine, lambda box: box.stretch(direction, step))
+
+    def set_box_text(self, firstLine, lastLine, text):
+
+        return self.edit_boxes(firstLine, lastLine, lambda box: box.set_text(text))
+
+    def set_attribute(self, firstLine, lastLine, attribute, value):
+        """Set bold, italic or uline on the boxes"""
+
+        return self.edit_boxes(firstLine, lastLine, lambda box: setattr(box, attribute, value))
+
+    def split_boxes(self, firstLine, lastLine, parts=2, image=None):
+        """Split each box into parts. With the image of the page the cuts
+        go in the gaps between the glyphs (see boxsplit), otherwise the
+        boxes are cut into equal widths."""
+
+        newBoxes = []
+
+        for box in self.get_boxes(firstLine, lastLine)[0]:
+            edges = [box.left] + box_cuts(box, parts, image) + [box.right]
+
+            for part in xrange(parts):
+                newBox = copy_box(box)
+                newBox.left = edges[part]
+                newBox.right = edges[part + 1]
+                newBoxes.append(newBox)
+
+        if not newBoxes:
+            return None
+
+        return self.replace_boxes(firstLine, lastLine, newBoxes)
+
+    def merge_boxes(self, firstLine, lastLine):
+        """Merge the boxes into the smallest box enclosing them all, with
+        their text joined together"""
+
+        boxes = self.get_boxes(firstLine, lastLine)[0]
+
+        if not boxes:
+            return None
+
+        newBox = TesseractBox()
+
+        newBox.page = min(box.page for box in boxes)
+        newBox.left = min(box.left for box in boxes)
+        newBox.right = max(box.right for box in boxes)
+        newBox.top = max(box.top for box in boxes)
+        newBox.bottom = min(box.bottom for box in boxes)
+        newBox.text = u''.join(box.text for box in boxes)
+        newBox.valid = True
+
+        newBox.check_numbers() #check for flipped l/r, t/b
+
+        return self.replace_boxes(firstLine, lastLine, [newBox])
+
+    def delete_boxes(self, firstLine, lastLine):
+        """Delete the lines, leaving the line which follows them, if any,
+        to be selected"""
+
+        self.replace_lines(firstLine, lastLine - firstLine + 1, [])
+
+        line = min(firstLine, self.line_count() - 1)
+        return (line, line)
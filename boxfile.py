@@ -0,0 +1,796 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Boxfile data structures shared by moshPyTT and the helper scripts.
+#
+#       Nothing in here depends on GTK, so the command line tools can use it
+#       on machines without a display.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+from array import array
+from itertools import chain, islice, izip, permutations
+import codecs
+import hashlib
+import os
+
+from boxindex import BoxIndex, write_index, MAX_SIZE
+
+# the attribute prefix for every combination of flags, indexed by
+# bold | italic << 1 | uline << 2
+ATTRIBUTE_PREFIXES = tuple(('@' if flags & 1 else '') +
+                           ('$' if flags & 2 else '') +
+                           ("'" if flags & 4 else '') for flags in range(8))
+
+
+# the (bold, italic, uline) flags for every valid run of attribute prefixes:
+# each of '@', '$' and "'" may appear once, in any order
+PREFIX_FLAGS = dict((''.join(prefix), ('@' in prefix, '$' in prefix, "'" in prefix))
+                    for length in (1, 2, 3) for prefix in permutations("@$'", length))
+
+
+def split_attributes(text):
+    """Strip the bold, italic and underline prefixes from the text of a box.
+
+    Returns a (text, bold, italic, uline) tuple. Each prefix may appear once,
+    only the first three characters can be prefixes, and the last character
+    is always kept as the text itself."""
+
+    for length in (3, 2, 1):
+        if length < len(text):
+            flags = PREFIX_FLAGS.get(text[:length])
+            if flags:
+                return (text[length:],) + flags
+
+    return (text, False, False, False)
+
+
+# the range of the numbers in a box, which are kept in 32-bit columns
+MIN_NUMBER = -2 ** 31
+MAX_NUMBER = 2 ** 31 - 1
+
+# number of lines parsed at a time by the bulk parsers, so that the
+# intermediate lists stay small however big the file is
+PARSE_CHUNK_SIZE = 16384
+
+
+def iter_chunks(lines, chunkSize=PARSE_CHUNK_SIZE):
+    """Split an iterable of lines into (first line number, list of lines)
+    chunks"""
+
+    lines = iter(lines)
+    firstLine = 1
+
+    while True:
+        chunk = list(islice(lines, chunkSize))
+        if not chunk:
+            return
+
+        yield (firstLine, chunk)
+        firstLine += len(chunk)
+
+
+def parse_number(field):
+    """Convert a field of a box to an int. Raises ValueError if it isn't a
+    number, or is too big for the columns of a BoxTable."""
+
+    value = int(field)
+
+    if not MIN_NUMBER <= value <= MAX_NUMBER:
+        raise ValueError('%s is out of range' % field)
+
+    return value
+
+
+def convert_numbers(fields):
+    """Convert the five numeric columns of a flat list of six-field rows to
+    lists of ints. Coordinates repeat a lot within a page, so each distinct
+    string is only converted once. Raises ValueError on a bad number."""
+
+    columns = [fields[i::6] for i in range(1, 6)]
+
+    distinct = set()
+    for column in columns:
+        distinct.update(column)
+
+    values = dict((field, parse_number(field)) for field in distinct)
+
+    return [map(values.__getitem__, column) for column in columns]
+
+
+def parse_columns(lines, firstLine=1):
+    """Parse a chunk of boxfile lines in bulk.
+
+    Every line is split once, then each numeric column is converted in one
+    go and the attribute prefixes are decoded once per distinct glyph.
+    Returns (attributes, numbers, lineNumbers, invalidLines): a (text,
+    bold, italic, uline) tuple per box, a list of ints for each of the
+    left, bottom, right, top and page columns, the line number of each box,
+    and (line number, line) pairs for the lines which are not valid boxes.
+    Lines are numbered from firstLine. Blank lines are skipped."""
+
+    rows = []
+    rowLines = [] # the line each row was split from, to report it as read
+    lineNumbers = []
+    invalidLines = []
+
+    for lineNumber, line in enumerate(lines, firstLine):
+        parts = line.split()
+
+        if len(parts) == 6:
+            rows.append(parts)
+            rowLines.append(line)
+            lineNumbers.append(lineNumber)
+        elif parts:
+            invalidLines.append((lineNumber, line.rstrip('\r\n')))
+
+    if not rows:
+        return ([], [[], [], [], [], []], [], invalidLines)
+
+    # every row has six fields, so column i is every sixth field from i
+    fields = list(chain.from_iterable(rows))
+
+    try:
+        numbers = convert_numbers(fields)
+    except ValueError:
+        # at least one line has a bad number: weed them out and go again
+        goodRows = []
+        goodLineNumbers = []
+        for lineNumber, parts, line in izip(lineNumbers, rows, rowLines):
+            try:
+                map(parse_number, parts[1:])
+                goodRows.append(parts)
+                goodLineNumbers.append(lineNumber)
+            except ValueError:
+                invalidLines.append((lineNumber, line.rstrip('\r\n')))
+
+        invalidLines.sort()
+
+        lineNumbers = goodLineNumbers
+        fields = list(chain.from_iterable(goodRows))
+        numbers = convert_numbers(fields)
+
+    # a boxfile only uses a small alphabet, so decode each glyph once
+    rawText = fields[0::6]
+    decoded = dict((text, split_attributes(text)) for text in set(rawText))
+    attributes = map(decoded.__getitem__, rawText)
+
+    return (attributes, numbers, lineNumbers, invalidLines)
+
+
+def make_boxes(attributes, numbers):
+    """Build TesseractBox objects from the columns given by parse_columns"""
+
+    boxes = []
+    new_box = TesseractBox.__new__
+
+    for ((text, bold, italic, uline), left, bottom, right, top, page) in izip(attributes, *numbers):
+        box = new_box(TesseractBox)
+
+        box.text = text
+        box.left = left
+        box.bottom = bottom
+        box.right = right
+        box.top = top
+        box.page = page
+        box.bold = bold
+        box.italic = italic
+        box.uline = uline
+        box.valid = True
+
+        boxes.append(box)
+
+    return boxes
+
+
+def parse_lines(lines):
+    """Parse boxfile lines into TesseractBox objects in a single pass.
+
+    Returns (boxes, invalidLines), where invalidLines holds a (line number,
+    line) pair for each line which is not a valid box."""
+
+    boxes = []
+    invalidLines = []
+
+    for (firstLine, chunk) in iter_chunks(lines):
+        (attributes, numbers, lineNumbers, chunkInvalidLines) = parse_columns(chunk, firstLine)
+        invalidLines.extend(chunkInvalidLines)
+
+        boxes.extend(make_boxes(attributes, numbers))
+
+    return (boxes, invalidLines)
+
+
+def load_boxfile(filename):
+    """Read a boxfile from disk with parse_lines, or from its sidecar index
+    if it has an up-to-date one"""
+
+    index = BoxIndex.open(filename)
+    if index:
+        try:
+            table = BoxTable.from_index(index)
+            attributes = izip(table.text, map(bool, table.bold),
+                              map(bool, table.italic), map(bool, table.uline))
+            numbers = (table.left, table.bottom, table.right, table.top, table.page)
+
+            return (make_boxes(attributes, numbers),
+                    index.read_lines(index.invalid_line_numbers()))
+        finally:
+            index.close()
+
+    boxFile = codecs.open(filename, 'r', 'utf-8')
+    try:
+        return parse_lines(boxFile)
+    finally:
+        boxFile.close()
+
+
+def build_index(filename):
+    """Parse a boxfile and write its sidecar index, so that it can be read
+    later without parsing. Returns the number of boxes, or None if the
+    boxfile is too big to index."""
+
+    stat = os.stat(filename)
+    if stat.st_size > MAX_SIZE:
+        return None
+
+    boxFile = open(filename, 'rb')
+    try:
+        lines = boxFile.readlines()
+    finally:
+        boxFile.close()
+
+    lineOffsets = array('I', [0])
+    offset = 0
+    for line in lines:
+        offset += len(line)
+        lineOffsets.append(offset)
+
+    table = BoxTable()
+    boxLines = array('i')
+    invalidLines = array('i')
+
+    for (firstLine, chunk) in iter_chunks(lines):
+        (attributes, numbers, lineNumbers, chunkInvalidLines) = parse_columns(
+            [line.decode('utf-8') for line in chunk], firstLine)
+
+        table.extend_columns(attributes, numbers)
+        boxLines.extend(array('i', lineNumbers))
+        invalidLines.extend(array('i', [number for (number, line) in chunkInvalidLines]))
+
+    # number the distinct glyphs, in the order they first appear
+    glyphNumbers = {}
+    glyphColumn = [glyphNumbers.setdefault(text, len(glyphNumbers)) for text in table.text]
+
+    columns = {'left': table.left, 'bottom': table.bottom, 'right': table.right,
+               'top': table.top, 'page': table.page, 'glyph': glyphColumn, 'line': boxLines,
+               'bold': table.bold, 'italic': table.italic, 'uline': table.uline}
+
+    write_index(filename, stat, hashlib.sha1(''.join(lines)).digest(), columns,
+                sorted(glyphNumbers, key=glyphNumbers.get), lineOffsets, invalidLines,
+                PageIndex.from_lines(lines).all_ranges())
+
+    return len(table)
+
+
+class BoxOperations(object):
+    """Editing operations shared by every kind of box.
+
+    Subclasses provide the text, left, bottom, right, top, page, bold, italic
+    and uline attributes."""
+
+    __slots__ = ()
+
+    def make_string(self):
+        """Constructs a box string from the box object"""
+        string = ''
+        if self.bold:
+            string += "@"
+        if self.italic:
+            string += "$"
+        if self.uline:
+            string += "'"
+
+        string +=  '%s %d %d %d %d %d' % (self.text, self.left, self.bottom, self.right, self.top, self.page)
+
+        return string
+
+    def set_text(self, string):
+        if type(string) is str or type(string) is unicode:
+            self.text = string
+        else:
+            raise TypeError("Box text must be a string. Received " + str(type(string)))
+
+    def check_numbers(self):
+        """Checks the box edges to ensure that the "left" edge is really to the
+        left of the "right" edge, and simlar for the top/bottom"""
+
+        if self.left > self.right:
+            temp = self.left
+            self.left = self.right
+            self.right = temp
+
+        if self.top < self.bottom:
+            temp = self.top
+            self.top = self.bottom
+            self.bottom = temp
+
+
+    def move(self, direction, step=1):
+        """Move the box to one side, in the direction given, by step pixels."""
+
+        if direction == 'LEFT':
+            self.left -= step
+            self.right -= step
+        elif direction == 'RIGHT':
+            self.left += step
+            self.right += step
+        elif direction == 'TOP':
+            self.top += step
+            self.bottom += step
+        elif direction == 'BOTTOM':
+            self.top -= step
+            self.bottom -= step
+
+
+    def stretch(self, direction, step=1):
+        """Stretch the "direction" side of the box by "step" pixels. Negative
+        step values produce shrinkage of the box"""
+
+        if direction == 'LEFT':
+            self.left -= step
+        elif direction == 'RIGHT':
+            self.right += step
+        elif direction == 'TOP':
+            self.top += step
+        elif direction == 'BOTTOM':
+            self.bottom -= step
+        elif direction == 'ALL':
+            self.left -= step
+            self.right += step
+            self.top += step
+            self.bottom -= step
+
+        self.check_numbers()
+
+    def __repr__(self):
+        return "TesseractBox: "+self.make_string()
+
+    def __str__(self):
+        return self.make_string()
+
+    def __unicode__(self):
+        return self.make_string()
+
+
+class TesseractBox(BoxOperations):
+
+    __slots__ = ('text', 'left', 'right', 'top', 'bottom', 'page',
+                 'italic', 'uline', 'bold', 'valid')
+
+    def __init__(self, string=None):
+
+        self.text = ''
+
+        self.left = None
+        self.right = None
+        self.top = None
+        self.bottom = None
+
+        self.page = None
+
+        self.italic = False
+        self.uline = False
+        self.bold = False
+
+        self.valid = False # if the box is valid
+
+        if not string:
+            return
+
+        parts = string.split()
+
+        if len(parts) == 6:
+            try:
+
+                left = parse_number(parts[1])
+                bottom = parse_number(parts[2])
+                right = parse_number(parts[3])
+                top = parse_number(parts[4])
+
+                page = parse_number(parts[5])
+
+            except ValueError: # if the int()s fail, ignore this box, there is something wrong with it
+                return
+
+            self.left = left
+            self.bottom = bottom
+            self.right = right
+            self.top = top
+            self.page = page
+
+            (self.text, self.bold, self.italic, self.uline) = split_attributes(parts[0])
+
+            self.valid = True
+
+
+def column_property(name):
+    """A property which reads and writes one column of a BoxRow's table"""
+
+    def get_value(self):
+        return getattr(self.table, name)[self.index]
+
+    def set_value(self, value):
+        getattr(self.table, name)[self.index] = value
+
+    return property(get_value, set_value)
+
+
+class BoxRow(BoxOperations):
+    """A lightweight view of one row of a BoxTable.
+
+    It behaves like a TesseractBox, but holds no box data of its own: reading
+    or changing an attribute goes straight to the table's columns."""
+
+    __slots__ = ('table', 'index')
+
+    valid = True # the table only holds boxes which parsed
+
+    text = column_property('text')
+    left = column_property('left')
+    bottom = column_property('bottom')
+    right = column_property('right')
+    top = column_property('top')
+    page = column_property('page')
+    bold = column_property('bold')
+    italic = column_property('italic')
+    uline = column_property('uline')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def detach(self):
+        """Return a TesseractBox holding a copy of this row"""
+
+        box = TesseractBox()
+        box.text = self.text
+        box.left = self.left
+        box.bottom = self.bottom
+        box.right = self.right
+        box.top = self.top
+        box.page = self.page
+        box.bold = bool(self.bold)
+        box.italic = bool(self.italic)
+        box.uline = bool(self.uline)
+        box.valid = True
+
+        return box
+
+    # a copy of a row must not share (or copy) the whole table
+    def __copy__(self):
+        return self.detach()
+
+    def __deepcopy__(self, memo):
+        return self.detach()
+
+
+class BoxTable(object):
+    """A boxfile held as parallel columns rather than one object per box.
+
+    The coordinates and page numbers are kept in contiguous integer arrays,
+    the glyph text in a list and the bold/italic/underline flags in byte
+    arrays. Indexing or iterating over the table gives BoxRow views, so code
+    written for lists of TesseractBox objects keeps working."""
+
+    def __init__(self):
+
+        self.text = []
+
+        self.left = array('i')
+        self.bottom = array('i')
+        self.right = array('i')
+        self.top = array('i')
+        self.page = array('i')
+
+        self.bold = array('b')
+        self.italic = array('b')
+        self.uline = array('b')
+
+        self.invalidLines = [] # (line number, line) for lines which didn't parse
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Build a table from an iterable of boxfile lines"""
+
+        table = cls()
+        table.extend_lines(lines)
+        return table
+
+    @classmethod
+    def from_file(cls, filename):
+        """Build a table from a boxfile on disk, or from its sidecar index if
+        it has an up-to-date one"""
+
+        index = BoxIndex.open(filename)
+        if index:
+            try:
+                table = cls.from_index(index)
+                table.invalidLines = index.read_lines(index.invalid_line_numbers())
+                return table
+            finally:
+                index.close()
+
+        boxFile = codecs.open(filename, 'r', 'utf-8')
+        try:
+            return cls.from_lines(boxFile)
+        finally:
+            boxFile.close()
+
+    @classmethod
+    def from_index(cls, index, start=0, end=None):
+        """Build a table from rows start:end of a BoxIndex. The columns are
+        copied out of the index as they are, without any parsing."""
+
+        table = cls()
+
+        for name in ('left', 'bottom', 'right', 'top', 'page', 'bold', 'italic', 'uline'):
+            setattr(table, name, index.column(name, start, end))
+
+        table.text = map(index.glyphs.__getitem__, index.column('glyph', start, end))
+
+        return table
+
+    def extend_lines(self, lines):
+        """Parse boxfile lines and append them to the table.
+
+        Lines that are not valid boxes are added to invalidLines, numbered
+        from 1 within the given lines."""
+
+        for (firstLine, chunk) in iter_chunks(lines):
+            (attributes, numbers, lineNumbers, invalidLines) = parse_columns(chunk, firstLine)
+
+            self.invalidLines.extend(invalidLines)
+            self.extend_columns(attributes, numbers)
+
+    def extend_columns(self, attributes, numbers):
+        """Append the columns given by parse_columns to the table"""
+
+        self.left.extend(array('i', numbers[0]))
+        self.bottom.extend(array('i', numbers[1]))
+        self.right.extend(array('i', numbers[2]))
+        self.top.extend(array('i', numbers[3]))
+        self.page.extend(array('i', numbers[4]))
+
+        self.text.extend([attribute[0] for attribute in attributes])
+        self.bold.extend(array('b', [attribute[1] for attribute in attributes]))
+        self.italic.extend(array('b', [attribute[2] for attribute in attributes]))
+        self.uline.extend(array('b', [attribute[3] for attribute in attributes]))
+
+    def append(self, box):
+        """Append a copy of any TesseractBox-like object to the table"""
+
+        self.text.append(box.text)
+        self.left.append(box.left)
+        self.bottom.append(box.bottom)
+        self.right.append(box.right)
+        self.top.append(box.top)
+        self.page.append(box.page)
+        self.bold.append(bool(box.bold))
+        self.italic.append(bool(box.italic))
+        self.uline.append(bool(box.uline))
+
+    def extend_rows(self, table, start=0, end=None):
+        """Append rows start:end of another table, a column at a time"""
+
+        if end is None:
+            end = len(table)
+
+        for name in ('left', 'bottom', 'right', 'top', 'page', 'bold', 'italic', 'uline'):
+            getattr(self, name).extend(getattr(table, name)[start:end])
+
+        self.text.extend(table.text[start:end])
+
+    def take(self, rows):
+        """Return a new table of the given rows, in the order given. A row
+        may be given more than once."""
+
+        table = BoxTable()
+
+        for name in ('left', 'bottom', 'right', 'top', 'page', 'bold', 'italic', 'uline'):
+            column = getattr(self, name)
+            setattr(table, name, array(column.typecode, map(column.__getitem__, rows)))
+
+        table.text = map(self.text.__getitem__, rows)
+
+        return table
+
+    def make_strings(self):
+        """Return an iterator over the box strings of every row"""
+
+        prefixes = [ATTRIBUTE_PREFIXES[bold | italic << 1 | uline << 2]
+                    for (bold, italic, uline) in izip(self.bold, self.italic, self.uline)]
+
+        return ('%s%s %d %d %d %d %d' % row for row in izip(prefixes, self.text,
+                    self.left, self.bottom, self.right, self.top, self.page))
+
+    def make_string(self):
+        """Constructs the text of a whole boxfile from the table"""
+
+        return ''.join(string + '\n' for string in self.make_strings())
+
+    def write(self, outFile):
+        """Write the table to an open file, one box per line"""
+
+        outFile.writelines(string + '\n' for string in self.make_strings())
+
+    def __len__(self):
+        return len(self.text)
+
+    def __iter__(self):
+        return (BoxRow(self, index) for index in xrange(len(self.text)))
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return [BoxRow(self, i) for i in xrange(*index.indices(len(self.text)))]
+
+        if index < 0:
+            index += len(self.text)
+
+        if index < 0 or index >= len(self.text):
+            raise IndexError('box index out of range')
+
+        return BoxRow(self, index)
+
+
+class PageIndex(object):
+    """Where the lines of each page are in a boxfile, as byte ranges.
+
+    The index is built in one pass over the file, without parsing the
+    boxes, so that a single page of a large multi-page boxfile can be read
+    without reading the rest. Lines which aren't valid boxes belong to the
+    page of the lines around them."""
+
+    def __init__(self):
+
+        self.pages = [] # in the order they first appear in the file
+        self.ranges = {} # page -> list of (start, end) byte offsets
+
+    @classmethod
+    def from_file(cls, filename):
+        """Build the index of a boxfile on disk, from its sidecar index if it
+        has an up-to-date one"""
+
+        boxIndex = BoxIndex.open(filename)
+        if boxIndex:
+            try:
+                return cls.from_ranges(boxIndex.page_ranges())
+            finally:
+                boxIndex.close()
+
+        boxFile = open(filename, 'rb')
+        try:
+            return cls.from_lines(boxFile)
+        finally:
+            boxFile.close()
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Build the index of a boxfile from its lines, as byte strings"""
+
+        index = cls()
+
+        offset = 0
+        runPage = None # the page of the current run of lines
+        runStart = 0
+
+        for line in lines:
+            parts = line.split()
+
+            if len(parts) == 6:
+                try:
+                    page = int(parts[5])
+                except ValueError:
+                    page = runPage
+            else:
+                page = runPage
+
+            if page != runPage:
+                if runPage is not None or offset > runStart:
+                    index.add_range(runPage or 0, runStart, offset)
+                (runPage, runStart) = (page, offset)
+
+            offset += len(line)
+
+        if offset > runStart:
+            index.add_range(runPage or 0, runStart, offset)
+
+        return index
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Build an index from (page, start, end) byte ranges, as given by
+        all_ranges"""
+
+        index = cls()
+        for (page, start, end) in ranges:
+            index.add_range(page, start, end)
+        return index
+
+    def all_ranges(self):
+        """Return every (page, start, end) byte range, page by page"""
+
+        return [(page, start, end) for page in self.pages
+                for (start, end) in self.ranges[page]]
+
+    def add_range(self, page, start, end):
+
+        if page not in self.ranges:
+            self.pages.append(page)
+            self.ranges[page] = []
+
+        ranges = self.ranges[page]
+
+        if ranges and ranges[-1][1] == start: # join onto the last range
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    def read_page(self, boxFile, page):
+        """Return the text of a page from an open boxfile, as unicode"""
+
+        chunks = []
+        for (start, end) in self.ranges.get(page, []):
+            boxFile.seek(start)
+            chunks.append(boxFile.read(end - start))
+
+        return ''.join(chunks).decode('utf-8')
+
+    def write(self, boxFile, outFile, pageTexts):
+        """Write a whole boxfile to outFile: the pages in pageTexts (page ->
+        unicode text) are replaced, the others are copied from the open
+        boxfile this index describes. The lines of each page are written
+        together, where the page first appeared, and new pages go at the
+        end.
+
+        Returns the PageIndex of the file written."""
+
+        newIndex = PageIndex()
+        offset = 0
+
+        pages = self.pages + sorted(page for page in pageTexts if page not in self.ranges)
+
+        for page in pages:
+            start = offset
+
+            if page in pageTexts:
+                text = pageTexts[page]
+                if isinstance(text, unicode):
+                    text = text.encode('utf-8')
+                if text and not text.endswith('\n'):
+                    text += '\n'
+                outFile.write(text)
+                offset += len(text)
+            else:
+                for (rangeStart, rangeEnd) in self.ranges[page]:
+                    boxFile.seek(rangeStart)
+                    outFile.write(boxFile.read(rangeEnd - rangeStart))
+                    offset += rangeEnd - rangeStart
+
+            newIndex.add_range(page, start, offset)
+
+        return newIndex
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       A uniform grid spatial index over the boxes of a boxfile, used by
+#       moshPyTT to find the boxes under the mouse, which also indexes the
+#       boxes by glyph for searching.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+from itertools import izip
+
+from boxfile import parse_columns
+
+# a box touching more cells than this, which is usually a mistake, is kept
+# in a list of its own and checked against every query instead
+MAX_GRID_CELLS = 64
+
+
+class BoxGrid:
+    """Index of the boxes in a boxfile by position.
+
+    Every line of the boxfile gets an id, and each valid box is filed under
+    every grid cell it touches. Editing a few lines only refiles those
+    lines: the lines after them just shift in the line -> id list, and the
+    id -> line map is brought up to date the next time a query needs it.
+
+    Boxes are stored in Tesseract coordinates, with the origin at the bottom
+    left. Queries take image coordinates, with the origin at the top left,
+    and are flipped using imageHeight, as redraw_drawing_area does."""
+
+    def __init__(self, cellSize=64):
+
+        self.cellSize = cellSize
+        self.imageHeight = 0
+
+        self.lineIds = [0] # the id of each line; an empty buffer has one line
+        self.idLines = {0: 0} # the line of each id, up to date before renumberFrom
+        self.renumberFrom = 1
+        self.nextId = 1
+
+        self.boxes = {} # id -> (left, bottom, right, top) of each valid box
+        self.cells = {} # (column, row) -> set of ids of the boxes touching that cell
+        self.oversized = set() # ids of the boxes touching more than MAX_GRID_CELLS cells
+
+        self.glyphs = {} # id -> (text, bold, italic, uline, page) of each valid box
+        self.glyphIds = {} # text -> set of ids of the boxes with that glyph
+
+    def cell_range(self, left, bottom, right, top):
+        """The grid cells covered by a rectangle in Tesseract coordinates"""
+
+        size = self.cellSize
+        return [(column, row)
+                for column in xrange(left // size, right // size + 1)
+                for row in xrange(bottom // size, top // size + 1)]
+
+    def cell_count(self, left, bottom, right, top):
+        """The number of cells cell_range would return"""
+
+        size = self.cellSize
+        return (right // size - left // size + 1) * (top // size - bottom // size + 1)
+
+    def add_box(self, boxId, left, bottom, right, top):
+
+        # a hand-edited box may have its edges the wrong way round
+        (left, right) = (min(left, right), max(left, right))
+        (bottom, top) = (min(bottom, top), max(bottom, top))
+
+        self.boxes[boxId] = (left, bottom, right, top)
+
+        if self.cell_count(left, bottom, right, top) > MAX_GRID_CELLS:
+            self.oversized.add(boxId)
+            return
+
+        for cell in self.cell_range(left, bottom, right, top):
+            ids = self.cells.get(cell)
+            if ids is None:
+                ids = self.cells[cell] = set()
+            ids.add(boxId)
+
+    def add_glyph(self, boxId, text, bold, italic, uline, page):
+
+        self.glyphs[boxId] = (text, bold, italic, uline, page)
+
+        ids = self.glyphIds.get(text)
+        if ids is None:
+            ids = self.glyphIds[text] = set()
+        ids.add(boxId)
+
+    def remove_box(self, boxId):
+
+        edges = self.boxes.pop(boxId, None)
+        if edges is None:
+            return
+
+        text = self.glyphs.pop(boxId)[0]
+        ids = self.glyphIds[text]
+        ids.discard(boxId)
+        if not ids:
+            del self.glyphIds[text]
+
+        if boxId in self.oversized:
+            self.oversized.discard(boxId)
+            return
+
+        for cell in self.cell_range(*edges):
+            ids = self.cells[cell]
+            ids.discard(boxId)
+            if not ids:
+                del self.cells[cell]
+
+    def replace_lines(self, firstLine, oldCount, lines):
+        """Replace oldCount lines starting at firstLine (counting from 0) with
+        the given new lines of boxfile text"""
+
+        for boxId in self.lineIds[firstLine:firstLine + oldCount]:
+            self.remove_box(boxId)
+            self.idLines.pop(boxId, None)
+
+        newIds = range(self.nextId, self.nextId + len(lines))
+        self.nextId += len(lines)
+
+        self.lineIds[firstLine:firstLine + oldCount] = newIds
+
+        if len(lines) == oldCount:
+            self.idLines.update(izip(newIds, xrange(firstLine, firstLine + len(lines))))
+        else:
+            # every line after this one has moved
+            self.renumberFrom = min(self.renumberFrom, firstLine)
+
+        (attributes, numbers, lineNumbers, invalidLines) = parse_columns(lines, 0)
+
+        for (lineNumber, (text, bold, italic, uline), left, bottom, right, top, page) \
+                in izip(lineNumbers, attributes, *numbers):
+            self.add_box(newIds[lineNumber], left, bottom, right, top)
+            self.add_glyph(newIds[lineNumber], text, bold, italic, uline, page)
+
+    def set_text(self, text):
+        """Index the whole text of a boxfile from scratch"""
+
+        self.boxes = {}
+        self.cells = {}
+        self.oversized = set()
+        self.glyphs = {}
+        self.glyphIds = {}
+        self.lineIds = []
+        self.idLines = {}
+        self.renumberFrom = 0
+
+        self.replace_lines(0, 0, text.split('\n'))
+
+    def line_of(self, boxId):
+        """The current line of the box with the given id"""
+
+        if self.renumberFrom < len(self.lineIds):
+            start = self.renumberFrom
+            self.idLines.update(izip(self.lineIds[start:], xrange(start, len(self.lineIds))))
+            self.renumberFrom = len(self.lineIds)
+
+        return self.idLines[boxId]
+
+    def lines_in_rect(self, x1, y1, x2, y2):
+        """Return the sorted line numbers of the boxes which overlap a
+        rectangle given by two corners in image coordinates"""
+
+        left = min(x1, x2)
+        right = max(x1, x2)
+        bottom = self.imageHeight - max(y1, y2)
+        top = self.imageHeight - min(y1, y2)
+
+        found = set()
+        for cell in self.cell_range(left, bottom, right, top):
+            ids = self.cells.get(cell)
+            if ids:
+                found.update(ids)
+
+        found.update(self.oversized) # there are only ever a few
+
+        boxes = self.boxes
+        hits = [boxId for boxId in found
+                if boxes[boxId][0] <= right and boxes[boxId][2] >= left
+                and boxes[boxId][1] <= top and boxes[boxId][3] >= bottom]
+
+        return sorted(self.line_of(boxId) for boxId in hits)
+
+    def lines_at(self, x, y):
+        """Return the sorted line numbers of the boxes under a point in image
+        coordinates"""
+
+        return self.lines_in_rect(x, y, x, y)
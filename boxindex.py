@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       A binary sidecar index for boxfiles, so that a big boxfile can be
+#       opened without parsing it.
+#
+#       The index of foo.box is kept in foo.boxidx. Everything in it is
+#       little-endian, and each section starts on a 4-byte boundary:
+#
+#           header      magic, version, the size, mtime and SHA-1 of the
+#                       boxfile, then the size of each section
+#           glyphs      the offset of each distinct glyph in the heap, and
+#                       one past the last, then the UTF-8 heap itself
+#           boxes       columns of 32-bit ints for the left, bottom, right,
+#                       top, page, glyph number and line number of each box,
+#                       then columns of bytes for bold, italic and uline
+#           lines       the byte offset of each line, and of the end
+#           invalid     the numbers of the lines which aren't valid boxes
+#           pages       the (page, start, end) byte ranges of a PageIndex
+#
+#       The columns are read straight out of an mmap of the index, so only
+#       the rows asked for are touched. An index is only used while it
+#       still describes its boxfile: the size and mtime have to match, and
+#       if only the mtime has changed (a copy or a checkout) the SHA-1 of
+#       the boxfile is checked instead.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+from array import array
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+INDEX_EXTENSION = '.boxidx'
+
+MAGIC = 'MPTTBIDX'
+VERSION = 1
+
+# magic, version, size, mtime and SHA-1 of the boxfile, then the number of
+# boxes, lines, glyphs, invalid lines and page ranges, and the heap size
+HEADER = struct.Struct('<8sIQd20sIIIIII')
+
+INT_COLUMNS = ('left', 'bottom', 'right', 'top', 'page', 'glyph', 'line')
+FLAG_COLUMNS = ('bold', 'italic', 'uline')
+
+# byte offsets are stored as unsigned 32-bit ints
+MAX_SIZE = 2 ** 32 - 1
+
+# the columns are read and written as arrays, so their items must be the
+# size the index stores
+INDEXABLE = array('i').itemsize == 4 and array('I').itemsize == 4
+
+
+def index_filename(boxFilename):
+    """The name of the sidecar index of a boxfile"""
+
+    return os.path.splitext(boxFilename)[0] + INDEX_EXTENSION
+
+
+def file_hash(filename):
+    """The SHA-1 digest of a file, read a block at a time"""
+
+    digest = hashlib.sha1()
+
+    hashFile = open(filename, 'rb')
+    try:
+        while True:
+            block = hashFile.read(1 << 20)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        hashFile.close()
+
+    return digest.digest()
+
+
+def to_bytes(values, typecode):
+    """Pack a sequence of numbers as little-endian array items"""
+
+    column = array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tostring()
+
+
+def from_bytes(data, typecode):
+    """Unpack little-endian array items"""
+
+    column = array(typecode)
+    column.fromstring(data)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def layout(boxCount, lineCount, glyphCount, invalidCount, rangeCount, heapSize):
+    """Return ({section: (offset, size)}, total size) for an index with
+    the given counts"""
+
+    sizes = [('glyphOffsets', 4 * (glyphCount + 1)), ('heap', heapSize)]
+    sizes.extend((name, 4 * boxCount) for name in INT_COLUMNS)
+    sizes.extend((name, boxCount) for name in FLAG_COLUMNS)
+    sizes.extend([('lineOffsets', 4 * (lineCount + 1)), ('invalid', 4 * invalidCount),
+                  ('rangePages', 4 * rangeCount), ('rangeStarts', 4 * rangeCount),
+                  ('rangeEnds', 4 * rangeCount)])
+
+    sections = {}
+    offset = HEADER.size
+    for (name, size) in sizes:
+        sections[name] = (offset, size)
+        offset += (size + 3) & ~3
+
+    return (sections, offset)
+
+
+def write_index(boxFilename, stat, digest, columns, glyphs, lineOffsets, invalidLines, ranges):
+    """Write the sidecar index of a boxfile.
+
+    stat and digest are the os.stat() and SHA-1 of the boxfile as it was
+    read. columns maps each of INT_COLUMNS and FLAG_COLUMNS to a sequence
+    with a value per box, glyphs is the list of distinct glyphs the glyph
+    column numbers, lineOffsets has the byte offset of every line and of
+    the end of the file, invalidLines the numbers of the lines which
+    aren't boxes, and ranges is a list of (page, start, end)."""
+
+    heap = [glyph.encode('utf-8') for glyph in glyphs]
+    glyphOffsets = [0]
+    for text in heap:
+        glyphOffsets.append(glyphOffsets[-1] + len(text))
+
+    data = {'glyphOffsets': to_bytes(glyphOffsets, 'I'),
+            'heap': ''.join(heap),
+            'lineOffsets': to_bytes(lineOffsets, 'I'),
+            'invalid': to_bytes(invalidLines, 'i'),
+            'rangePages': to_bytes([page for (page, start, end) in ranges], 'i'),
+            'rangeStarts': to_bytes([start for (page, start, end) in ranges], 'I'),
+            'rangeEnds': to_bytes([end for (page, start, end) in ranges], 'I')}
+
+    for name in INT_COLUMNS:
+        data[name] = to_bytes(columns[name], 'i')
+    for name in FLAG_COLUMNS:
+        data[name] = to_bytes(columns[name], 'b')
+
+    boxCount = len(columns['line'])
+
+    (sections, size) = layout(boxCount, len(lineOffsets) - 1, len(glyphs),
+                              len(invalidLines), len(ranges), glyphOffsets[-1])
+
+    header = HEADER.pack(MAGIC, VERSION, stat.st_size, stat.st_mtime, digest,
+                         boxCount, len(lineOffsets) - 1, len(glyphs),
+                         len(invalidLines), len(ranges), glyphOffsets[-1])
+
+    filename = index_filename(boxFilename)
+    tempFilename = '%s.%d.tmp' % (filename, os.getpid())
+
+    indexFile = open(tempFilename, 'wb')
+    try:
+        indexFile.write(header)
+        for (name, (offset, length)) in sorted(sections.items(), key=lambda item: item[1]):
+            indexFile.seek(offset)
+            indexFile.write(data[name])
+        indexFile.truncate(size)
+    finally:
+        indexFile.close()
+
+    os.rename(tempFilename, filename)
+
+
+class BoxIndex(object):
+    """A read-only view of the sidecar index of a boxfile, through mmap"""
+
+    def __init__(self, boxFilename, data):
+        """Read the header of a mapped index. Raises ValueError if it isn't
+        an index this version can read."""
+
+        if len(data) < HEADER.size:
+            raise ValueError('truncated header')
+
+        (magic, version, self.size, self.mtime, self.digest, self.boxCount,
+         self.lineCount, glyphCount, invalidCount, rangeCount,
+         heapSize) = HEADER.unpack(data[:HEADER.size])
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a version %d boxfile index' % VERSION)
+
+        (self.sections, size) = layout(self.boxCount, self.lineCount, glyphCount,
+                                       invalidCount, rangeCount, heapSize)
+        if len(data) < size:
+            raise ValueError('truncated index')
+
+        self.boxFilename = boxFilename
+        self.data = data
+
+        # the alphabet is small, so decode it all now
+        glyphOffsets = self.read('glyphOffsets', 'I')
+        heap = self.read('heap')
+        self.glyphs = [heap[start:end].decode('utf-8')
+                       for (start, end) in zip(glyphOffsets, glyphOffsets[1:])]
+
+    @classmethod
+    def open(cls, boxFilename, verify=False):
+        """Open the index of a boxfile. Returns None if there isn't one, or
+        it no longer matches the boxfile. With verify, the SHA-1 of the
+        boxfile is always checked."""
+
+        if not boxFilename or not INDEXABLE:
+            return None
+
+        try:
+            indexFile = open(index_filename(boxFilename), 'rb')
+        except IOError:
+            return None
+
+        try:
+            try:
+                data = mmap.mmap(indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError): # empty
+                return None
+        finally:
+            indexFile.close() # the map keeps the file open itself
+
+        try:
+            index = cls(boxFilename, data)
+            if index.is_current(verify):
+                return index
+        except (ValueError, UnicodeError, OSError):
+            pass
+
+        data.close()
+        return None
+
+    def is_current(self, verify=False):
+        """If the index still describes its boxfile"""
+
+        stat = os.stat(self.boxFilename)
+
+        if stat.st_size != self.size:
+            return False
+
+        if stat.st_mtime == self.mtime and not verify:
+            return True
+
+        return file_hash(self.boxFilename) == self.digest
+
+    def read(self, section, typecode=None, start=0, end=None):
+        """Return items start:end of a section, as an array of typecode, or
+        as bytes if typecode is None"""
+
+        (offset, size) = self.sections[section]
+        itemSize = array(typecode).itemsize if typecode else 1
+
+        if end is None:
+            end = size // itemSize
+
+        data = self.data[offset + start * itemSize:offset + end * itemSize]
+
+        if typecode is None:
+            return data
+        return from_bytes(data, typecode)
+
+    def column(self, name, start=0, end=None):
+        """Return rows start:end of one of the box columns as an array"""
+
+        if name in FLAG_COLUMNS:
+            return self.read(name, 'b', start, end)
+        return self.read(name, 'i', start, end)
+
+    def line_offsets(self):
+        return self.read('lineOffsets', 'I')
+
+    def invalid_line_numbers(self):
+        return self.read('invalid', 'i')
+
+    def page_ranges(self):
+        """The (page, start, end) byte ranges of every page, in PageIndex
+        order"""
+
+        return zip(self.read('rangePages', 'i'), self.read('rangeStarts', 'I'),
+                   self.read('rangeEnds', 'I'))
+
+    def read_lines(self, lineNumbers):
+        """Return (line number, line) for some lines of the boxfile, read
+        from the boxfile itself"""
+
+        if not lineNumbers:
+            return []
+
+        offsets = self.line_offsets()
+        lines = []
+
+        boxFile = open(self.boxFilename, 'rb')
+        try:
+            for number in lineNumbers:
+                boxFile.seek(offsets[number - 1])
+                line = boxFile.read(offsets[number] - offsets[number - 1])
+                lines.append((number, line.decode('utf-8').rstrip('\r\n')))
+        finally:
+            boxFile.close()
+
+        return lines
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return self.boxCount
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Search queries over the boxes of a boxfile, answered from the glyph
+#       and geometry index kept by BoxGrid rather than by scanning the text.
+#
+#       A query is a list of terms, all of which must match:
+#
+#           a           the glyph is exactly "a"
+#           /[0-9]/     the glyph matches a regular expression
+#           bold        the box is bold (also italic, uline); !bold if not
+#           width>30    a comparison of width, height, left, right, top,
+#                       bottom or page with a number, using <, <=, >, >=,
+#                       = or !=
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import re
+import operator
+
+COMPARISON = re.compile(r'^(width|height|left|right|top|bottom|page)(<=|>=|!=|<|>|=)(-?\d+)$')
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt,
+             '>=': operator.ge, '=': operator.eq, '!=': operator.ne}
+
+FLAGS = {'bold': 1, 'italic': 2, 'uline': 3} # index in BoxGrid.glyphs
+
+FLAG_COLUMNS = {1: 'bold', 2: 'italic', 3: 'uline'} # the BoxTable column of each flag
+
+
+# the value of each field, from the BoxGrid edges and glyph of a box
+FIELDS = {'left': lambda edges, glyph: edges[0],
+          'bottom': lambda edges, glyph: edges[1],
+          'right': lambda edges, glyph: edges[2],
+          'top': lambda edges, glyph: edges[3],
+          'width': lambda edges, glyph: edges[2] - edges[0],
+          'height': lambda edges, glyph: edges[3] - edges[1],
+          'page': lambda edges, glyph: glyph[4]}
+
+
+# the values of each field for every row of a BoxTable. The edges are put
+# the right way round, as BoxGrid does
+COLUMNS = {'left': lambda table: map(min, table.left, table.right),
+           'bottom': lambda table: map(min, table.bottom, table.top),
+           'right': lambda table: map(max, table.left, table.right),
+           'top': lambda table: map(max, table.bottom, table.top),
+           'width': lambda table: map(abs, map(operator.sub, table.right, table.left)),
+           'height': lambda table: map(abs, map(operator.sub, table.top, table.bottom)),
+           'page': lambda table: table.page}
+
+
+class BoxQuery:
+    """A parsed search query"""
+
+    def __init__(self, string):
+        """Parse a query string, as unicode or UTF-8. Raises ValueError if it
+        isn't valid."""
+
+        # glyphs are unicode, and \w and the like only match non-ASCII
+        # letters in a unicode pattern
+        if isinstance(string, str):
+            try:
+                string = string.decode('utf-8')
+            except UnicodeDecodeError, e:
+                raise ValueError('the search is not UTF-8: %s' % e)
+
+        self.glyph = None
+        self.patterns = [] # compiled regular expressions
+        self.flags = [] # (index in the glyph tuple, wanted value)
+        self.comparisons = [] # (field name, operator function, number)
+
+        for term in string.split():
+
+            if len(term) > 2 and term.startswith('/') and term.endswith('/'):
+                try:
+                    self.patterns.append(re.compile(term[1:-1], re.UNICODE))
+                except re.error, e:
+                    raise ValueError('bad regular expression %s: %s' % (term, e))
+                continue
+
+            if term.lstrip('!') in FLAGS:
+                self.flags.append((FLAGS[term.lstrip('!')], not term.startswith('!')))
+                continue
+
+            match = COMPARISON.match(term)
+            if match:
+                (field, op, number) = match.groups()
+                self.comparisons.append((field, OPERATORS[op], int(number)))
+                continue
+
+            if self.glyph is not None and self.glyph != term:
+                raise ValueError('a box only has one glyph')
+            self.glyph = term
+
+    def is_empty(self):
+
+        return not (self.glyph or self.patterns or self.flags or self.comparisons)
+
+    def find_ids(self, grid):
+        """Return the ids of the boxes in a BoxGrid which match"""
+
+        # narrow down by glyph first: a boxfile only has a small alphabet
+        if self.glyph is not None or self.patterns:
+            if self.glyph is not None:
+                texts = [self.glyph]
+            else:
+                texts = grid.glyphIds.keys()
+
+            ids = []
+            for text in texts:
+                if all(pattern.search(text) for pattern in self.patterns):
+                    ids.extend(grid.glyphIds.get(text, ()))
+        else:
+            ids = grid.glyphs.keys()
+
+        glyphs = grid.glyphs
+        for (index, value) in self.flags:
+            ids = [boxId for boxId in ids if bool(glyphs[boxId][index]) == value]
+
+        boxes = grid.boxes
+        for (field, compare, number) in self.comparisons:
+            value = FIELDS[field]
+            ids = [boxId for boxId in ids
+                   if compare(value(boxes[boxId], glyphs[boxId]), number)]
+
+        return ids
+
+    def find_rows(self, table):
+        """Return the row numbers of the boxes in a BoxTable which match,
+        in order"""
+
+        text = table.text
+
+        if self.glyph is not None:
+            rows = [row for (row, glyph) in enumerate(text) if glyph == self.glyph]
+        else:
+            rows = range(len(table))
+
+        if self.patterns:
+            # test each glyph once, not every box
+            matching = set(glyph for glyph in set(text)
+                           if all(pattern.search(glyph) for pattern in self.patterns))
+            rows = [row for row in rows if text[row] in matching]
+
+        for (index, value) in self.flags:
+            column = getattr(table, FLAG_COLUMNS[index])
+            rows = [row for row in rows if bool(column[row]) == value]
+
+        for (field, compare, number) in self.comparisons:
+            column = COLUMNS[field](table)
+            rows = [row for row in rows if compare(column[row], number)]
+
+        return rows
+
+    def find_lines(self, grid):
+        """Return the sorted line numbers of the boxes in a BoxGrid which
+        match"""
+
+        return sorted(grid.line_of(boxId) for boxId in self.find_ids(grid))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Splits boxes where the ink under them is thinnest, instead of
+#       straight down the middle.
+#
+#       The image under a box is read as 8-bit grey and the ink in each
+#       column is added up, giving the projection profile of the box.
+#       Glyphs which touch, or nearly do, leave a valley in the profile
+#       where they meet, so the cuts go in the deepest valleys, keeping each
+#       part at least a third of its fair share wide. If there are too few
+#       valleys the widest parts are cut in the middle. A box with no
+#       valleys at all, or no image, is cut into equal widths, as it always
+#       was.
+#
+#       Nothing here depends on GTK. An image is anything with a width, a
+#       height and a read_gray(left, top, right, bottom) method returning
+#       the grey pixels of a region as (bytes, width, height): the editor
+#       passes its TiledImage, and the command line tools use ImagePages,
+#       which reads image files with PIL a page at a time.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# looked for next to a boxfile, in this order
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.pbm', '.pgm', '.bmp')
+
+
+def equal_cuts(left, right, parts):
+    """The x positions which cut left:right into parts of equal width"""
+
+    return [left + (right - left) * part // parts for part in xrange(1, parts)]
+
+
+def column_ink(data, width, height):
+    """The projection profile of a region of 8-bit grey pixels, stored a
+    row at a time: the ink in each column, 0 for a white one"""
+
+    pixels = bytearray(data)
+    white = 255 * height
+
+    # each column is every width'th pixel, so it is summed in one go
+    return [white - sum(pixels[x::width]) for x in xrange(width)]
+
+
+def find_valleys(ink):
+    """Return (ink, -run width, cut) for every valley of a profile: a run
+    of columns with the same ink, less than the columns either side. The
+    cut is in the middle of the run. Runs touching the edges are margins,
+    not gaps, and are left out."""
+
+    valleys = []
+    width = len(ink)
+
+    start = 1
+    while start < width - 1:
+        level = ink[start]
+
+        end = start + 1
+        while end < width and ink[end] == level:
+            end += 1
+
+        if end < width and ink[start - 1] > level < ink[end]:
+            valleys.append((level, start - end, (start + end) // 2))
+
+        start = end
+
+    return valleys
+
+
+def find_cuts(ink, parts, minWidth=None):
+    """Choose where to cut a profile into parts: in its deepest valleys,
+    then down the middle of the widest parts if there aren't enough, or at
+    equal widths if there are none at all. A cut at x falls between
+    columns x - 1 and x. No part is narrower than minWidth, by default a
+    third of an equal share, unless it has to be. Returns the parts - 1
+    cuts, in order."""
+
+    width = len(ink)
+
+    if minWidth is None:
+        minWidth = max(1, width // (3 * parts))
+
+    cuts = []
+
+    for (level, runWidth, cut) in sorted(find_valleys(ink)):
+        if len(cuts) == parts - 1:
+            break
+
+        if minWidth <= cut <= width - minWidth and \
+           all(abs(cut - other) >= minWidth for other in cuts):
+            cuts.append(cut)
+
+    if not cuts: # solid ink, or blank
+        return equal_cuts(0, width, parts)
+
+    cuts.sort()
+
+    while len(cuts) < parts - 1:
+        edges = [0] + cuts + [width]
+        (partWidth, left) = max((right - left, left) for (left, right) in zip(edges, edges[1:]))
+        cuts.append(left + partWidth // 2)
+        cuts.sort()
+
+    return cuts
+
+
+def box_cuts(box, parts, image=None):
+    """The x positions at which to cut a box into parts: in the valleys of
+    its profile in image, or at equal widths without one"""
+
+    (left, right) = (box.left, box.right)
+
+    if image is None or right - left < parts:
+        return equal_cuts(left, right, parts)
+
+    # boxes count up from the bottom of the image, rows down from the top
+    x1 = max(left, 0)
+    x2 = min(right, image.width)
+    y1 = max(image.height - box.top, 0)
+    y2 = min(image.height - box.bottom, image.height)
+
+    if x2 - x1 < parts or y2 <= y1: # mostly off the image
+        return equal_cuts(left, right, parts)
+
+    (data, width, height) = image.read_gray(x1, y1, x2, y2)
+
+    return [x1 + cut for cut in find_cuts(column_ink(data, width, height), parts)]
+
+
+def find_image(boxFilename):
+    """The image next to a boxfile, with the same name, or None"""
+
+    name = os.path.splitext(boxFilename)[0]
+
+    for extension in IMAGE_EXTENSIONS:
+        for candidate in (name + extension, name + extension.upper()):
+            if os.path.isfile(candidate):
+                return candidate
+
+    return None
+
+
+class GrayImage:
+    """A PIL image held as 8-bit grey, for box_cuts"""
+
+    def __init__(self, image):
+
+        self.image = image.convert('L')
+        (self.width, self.height) = self.image.size
+
+    def read_gray(self, left, top, right, bottom):
+
+        region = self.image.crop((left, top, right, bottom))
+
+        if hasattr(region, 'tobytes'):
+            data = region.tobytes()
+        else: # older versions of PIL
+            data = region.tostring()
+
+        return (data, right - left, bottom - top)
+
+
+class ImagePages:
+    """The pages of an image file, for splitting the boxes of a boxfile a
+    page at a time. Each frame is decoded when its page is first asked
+    for, and only the last one is kept."""
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.page = None
+        self.image = None
+
+    def get_page(self, page):
+        """The GrayImage of a page, or None if there is no such frame or PIL
+        can't read it"""
+
+        if page != self.page:
+            self.page = page
+            self.image = None
+
+            if Image is not None and page >= 0:
+                try:
+                    image = Image.open(self.filename)
+                    if page:
+                        image.seek(page)
+                    self.image = GrayImage(image)
+                except (IOError, EOFError):
+                    pass
+
+        return self.image
+
+
+def split_table(table, rows, parts, image=None):
+    """Split some rows of a BoxTable, all on one page, into parts each, cut
+    by box_cuts. Returns the new table and the rows of the new boxes, as
+    the editboxes operations do."""
+
+    selected = set(rows)
+
+    order = []
+    newRows = []
+
+    for row in xrange(len(table)):
+        if row in selected:
+            newRows.extend(xrange(len(order), len(order) + parts))
+            order.extend([row] * parts)
+        else:
+            order.append(row)
+
+    split = table.take(order)
+
+    (lefts, rights) = (split.left, split.right)
+
+    for start in xrange(0, len(newRows), parts):
+        first = newRows[start]
+
+        edges = [lefts[first]] + box_cuts(split[first], parts, image) + [rights[first]]
+
+        for part in xrange(parts):
+            lefts[first + part] = edges[part]
+            rights[first + part] = edges[part + 1]
+
+    return (split, newRows)
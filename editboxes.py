@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Applies the box operations of moshPyTT to whole boxfiles, or to many
+#       at once, following an edit script.
+#
+#       An edit script has one rule per line:
+#
+#           SELECTOR : OPERATION [OPERATION ...]
+#
+#       The selector is a search query, as typed in the editor's find box
+#       (see boxquery.py). A rule with no selector applies to every box. The
+#       operations are:
+#
+#           move DIRECTION [STEP]     move the boxes LEFT, RIGHT, TOP or
+#                                     BOTTOM by STEP pixels (default 1)
+#           stretch SIDE [STEP]       stretch the LEFT, RIGHT, TOP or BOTTOM
+#                                     side, or ALL of them, by STEP pixels
+#                                     (default 1); a negative STEP shrinks
+#           split [PARTS]             split each box into PARTS boxes
+#                                     (default 2), at the gaps in the ink
+#                                     of the boxfile's image if it has one,
+#                                     otherwise into equal widths
+#           merge                     merge each run of selected boxes which
+#                                     follow each other in the file into one
+#           delete                    delete the boxes
+#           text GLYPH                set the glyph
+#           bold, italic, uline       set an attribute; !bold... clears it
+#
+#       For example:
+#
+#           page=3 : move RIGHT 2
+#           width>80 : split
+#           height<2 : delete
+#           /[0-9]/ italic : !italic
+#
+#       The image of a boxfile is the one next to it with the same name, as
+#       moshPyTT opens them together; see boxsplit.py for how the cuts are
+#       found. Give -n to split into equal widths even so.
+#
+#       Blank lines and lines starting with # are ignored. The boxfile is
+#       edited a page at a time, and the rules are applied to each page in
+#       order, so each rule sees the boxes as the rules before it left them.
+#       The operations after split or merge apply to the boxes they made.
+#       As with mergeboxes.py, lines which are not valid boxes are dropped.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+from itertools import imap, izip
+from multiprocessing import Pool, cpu_count
+import codecs
+import optparse
+import os
+import sys
+
+from boxquery import BoxQuery
+from boxsplit import ImagePages, find_image, split_table
+from mergeboxes import read_pages, find_boxfiles, rewrite_boxfile, write_report
+
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog (-e rule | -f script) ... [-n] [-o outfile] boxfile\n"
+                                         "       %prog (-e rule | -f script) ... [-n] (-i | -d outdir) [-j jobs] [-r report] boxfile|directory|glob ...")
+    parser.add_option('-e', '--edit', dest='rules', action='append', default=[],
+                      help='An edit rule, like "width>80 : split". May be given more than once.')
+
+    parser.add_option('-f', '--script', dest='scripts', action='append', default=[],
+                      help='Read edit rules from SCRIPT, one per line. May be given more than once.')
+
+    parser.add_option('-o', '--output', dest='output', action='store',
+                      help='Write the edited boxfile to OUTPUT instead of standard output.')
+
+    parser.add_option('-n', '--equal-split', dest='equalSplit', action='store_true', default=False,
+                      help="Split boxes into equal widths, rather than at the gaps in the boxfile's image.")
+
+    parser.add_option('-i', '--in-place', dest='inPlace', action='store_true', default=False,
+                      help='Batch mode: replace each boxfile with its edited version.')
+
+    parser.add_option('-d', '--output-dir', dest='outputDir', action='store',
+                      help='Batch mode: write the edited boxfiles to OUTPUTDIR, keeping their paths relative to the directories they were found in.')
+
+    parser.add_option('-j', '--jobs', dest='jobs', action='store', type='int',
+                      default=1, help='Batch mode: edit up to JOBS boxfiles at once in separate processes. 0 uses one per CPU. Defaults to 1.')
+
+    parser.add_option('-r', '--report', dest='report', action='store',
+                      help='Batch mode: write the statistics of every boxfile, and the totals, to REPORT as JSON.')
+
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+                      help="Also print how many boxes each rule selected (to standard error)")
+    (opts, args) = parser.parse_args()
+
+    try:
+        ruleLines = read_rule_lines(opts.rules, opts.scripts)
+        rules = parse_rules(ruleLines)
+    except (IOError, ValueError), e:
+        parser.error(str(e))
+
+    if not rules:
+        parser.error('no edit rules: give them with -e or -f')
+
+    if opts.inPlace or opts.outputDir:
+        if opts.inPlace and opts.outputDir:
+            parser.error('use only one of -i and -d')
+        if opts.output:
+            parser.error('-o only works with a single boxfile; use -d in batch mode')
+        return edit_batch(opts, args, ruleLines)
+
+    if len(args) != 1:
+        parser.print_help()
+        return 0
+
+    # Like mergeboxes, the boxfile is streamed a page at a time. Use "-" to
+    # read stdin.
+    if args[0] == '-':
+        inFile = codecs.getreader('utf-8')(sys.stdin)
+    else:
+        inFile = codecs.open(args[0], mode='r', encoding='utf-8')
+
+    if opts.output:
+        outFile = codecs.open(opts.output, mode='w', encoding='utf-8')
+    else:
+        outFile = codecs.getwriter('utf-8')(sys.stdout)
+
+    if args[0] == '-' or opts.equalSplit:
+        imageFilename = None
+    else:
+        imageFilename = find_image(args[0])
+
+    stats = new_stats(rules)
+    try:
+        edit_file(inFile, outFile, rules, stats, imageFilename)
+    finally:
+        inFile.close()
+        if opts.output:
+            outFile.close()
+
+    if opts.verbose:
+        print_stats(rules, stats)
+
+    return 0
+
+# OPERATIONS
+#
+# Each takes a BoxTable of a page, the sorted row numbers of the boxes a
+# rule selected and the image of the page (see boxsplit.py), or None, and
+# returns the table and the rows of the boxes which are now selected. They
+# may change the table they are given.
+
+def move_rows(table, rows, image, direction, step):
+    """Move the boxes, as TesseractBox.move does"""
+
+    for row in rows:
+        table[row].move(direction, step)
+
+    return (table, rows)
+
+def stretch_rows(table, rows, image, direction, step):
+    """Stretch the boxes, as TesseractBox.stretch does"""
+
+    for row in rows:
+        table[row].stretch(direction, step)
+
+    return (table, rows)
+
+def set_text_rows(table, rows, image, text):
+
+    for row in rows:
+        table[row].set_text(text)
+
+    return (table, rows)
+
+def set_flag_rows(table, rows, image, name, value):
+
+    column = getattr(table, name)
+    for row in rows:
+        column[row] = value
+
+    return (table, rows)
+
+def delete_rows(table, rows, image):
+
+    selected = set(rows)
+    return (table.take([row for row in xrange(len(table)) if row not in selected]), [])
+
+def split_rows(table, rows, image, parts):
+    """Split each box into parts, with boxsplit.split_table"""
+
+    return split_table(table, rows, parts, image)
+
+def merge_rows(table, rows, image):
+    """Merge each run of consecutive rows into the smallest box enclosing
+    them, with their glyphs joined together and no attributes, as the
+    editor's merge does"""
+
+    runs = []
+    for row in rows:
+        if runs and runs[-1][-1] == row - 1:
+            runs[-1].append(row)
+        else:
+            runs.append([row])
+
+    merged = set()
+
+    for run in runs:
+        if len(run) < 2:
+            continue
+
+        box = table[run[0]]
+
+        box.left = min(table.left[row] for row in run)
+        box.right = max(table.right[row] for row in run)
+        box.top = max(table.top[row] for row in run)
+        box.bottom = min(table.bottom[row] for row in run)
+        box.text = u''.join(table.text[row] for row in run)
+        box.bold = box.italic = box.uline = False
+
+        box.check_numbers() #check for flipped l/r, t/b
+
+        merged.update(run[1:])
+
+    if not merged:
+        return (table, rows)
+
+    order = [row for row in xrange(len(table)) if row not in merged]
+
+    # where each of the rows kept ends up
+    newRow = dict((row, position) for (position, row) in enumerate(order))
+
+    return (table.take(order), [newRow[run[0]] for run in runs])
+
+# RULES
+
+MOVE_DIRECTIONS = ('LEFT', 'RIGHT', 'TOP', 'BOTTOM')
+STRETCH_SIDES = MOVE_DIRECTIONS + ('ALL',)
+FLAG_NAMES = ('bold', 'italic', 'uline')
+
+def parse_int(tokens, default):
+    """Take an optional number off the front of tokens"""
+
+    if tokens:
+        try:
+            value = int(tokens[0])
+        except ValueError:
+            return default
+        tokens.pop(0)
+        return value
+
+    return default
+
+def parse_operations(tokens):
+    """Parse the operations of a rule into (function, arguments) pairs"""
+
+    operations = []
+    tokens = list(tokens)
+
+    while tokens:
+        name = tokens.pop(0)
+
+        if name.lower() in ('move', 'stretch'):
+            allowed = MOVE_DIRECTIONS if name.lower() == 'move' else STRETCH_SIDES
+            if not tokens or tokens[0].upper() not in allowed:
+                raise ValueError('%s needs one of %s' % (name, ', '.join(allowed)))
+
+            direction = tokens.pop(0).upper()
+            step = parse_int(tokens, 1)
+
+            function = move_rows if name.lower() == 'move' else stretch_rows
+            operations.append((function, (direction, step)))
+
+        elif name.lower() == 'split':
+            parts = parse_int(tokens, 2)
+            if parts < 2:
+                raise ValueError('split needs at least 2 parts')
+            operations.append((split_rows, (parts,)))
+
+        elif name.lower() == 'merge':
+            operations.append((merge_rows, ()))
+
+        elif name.lower() == 'delete':
+            operations.append((delete_rows, ()))
+
+        elif name.lower() == 'text':
+            if not tokens:
+                raise ValueError('text needs a glyph')
+            operations.append((set_text_rows, (tokens.pop(0),)))
+
+        elif name.lstrip('!') in FLAG_NAMES:
+            operations.append((set_flag_rows, (name.lstrip('!'), not name.startswith('!'))))
+
+        else:
+            raise ValueError('unknown operation %s' % name)
+
+    return operations
+
+class EditRule:
+    """A selector and the operations to apply to the boxes it selects"""
+
+    def __init__(self, string):
+        """Parse a rule. Raises ValueError if it isn't valid."""
+
+        tokens = string.split()
+
+        if ':' not in tokens:
+            raise ValueError('a rule needs " : " between the selector and the operations')
+
+        colon = tokens.index(':')
+
+        self.source = string.strip()
+        self.query = BoxQuery(' '.join(tokens[:colon]))
+        self.operations = parse_operations(tokens[colon + 1:])
+
+        if not self.operations:
+            raise ValueError('a rule needs at least one operation')
+
+    def apply(self, table, image=None):
+        """Apply the rule to a BoxTable of a page, and the image of the page
+        if there is one. Returns the edited table and the number of boxes
+        selected."""
+
+        rows = self.query.find_rows(table)
+        count = len(rows)
+
+        for (function, arguments) in self.operations:
+            if not rows:
+                break
+            (table, rows) = function(table, rows, image, *arguments)
+
+        return (table, count)
+
+def read_rule_lines(rules, scripts):
+    """The rules given on the command line and in script files, as a list
+    of (where it came from, rule) pairs"""
+
+    ruleLines = [('-e %d' % number, rule) for (number, rule) in enumerate(rules, 1)]
+
+    for filename in scripts:
+        scriptFile = codecs.open(filename, 'r', 'utf-8')
+        try:
+            for (number, line) in enumerate(scriptFile, 1):
+                ruleLines.append(('%s:%d' % (filename, number), line))
+        finally:
+            scriptFile.close()
+
+    return ruleLines
+
+def parse_rules(ruleLines):
+    """Parse (where it came from, rule) pairs into EditRules, skipping
+    blank lines and comments"""
+
+    rules = []
+
+    for (where, line) in ruleLines:
+        if isinstance(line, str):
+            line = line.decode('utf-8')
+
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+
+        try:
+            rules.append(EditRule(line))
+        except ValueError, e:
+            raise ValueError('%s: %s' % (where, e))
+
+    return rules
+
+# EDITING FILES
+
+def new_stats(rules):
+    return {"total_in": 0, "total_out": 0, "selected": [0] * len(rules)}
+
+def edit_page(table, rules, stats, image=None):
+    """Apply the rules in turn to a BoxTable of a page, updating the stats
+    (see new_stats). Returns the edited table."""
+
+    stats["total_in"] += len(table)
+
+    for (number, rule) in enumerate(rules):
+        (table, count) = rule.apply(table, image)
+        stats["selected"][number] += count
+
+    stats["total_out"] += len(table)
+
+    return table
+
+def edit_file(inFile, outFile, rules, stats, imageFilename=None):
+    """Edit an open boxfile into another, a page at a time, splitting at
+    the gaps in the pages of imageFilename if there is one"""
+
+    images = ImagePages(imageFilename) if imageFilename else None
+
+    for page in read_pages(inFile):
+        image = images.get_page(page.page[0]) if images else None
+        edit_page(page, rules, stats, image).write(outFile)
+
+def print_stats(rules, stats, name=None):
+
+    print >> sys.stderr, "%sRead %d boxes, wrote %d." % (name + ': ' if name else '', stats["total_in"], stats["total_out"])
+
+    for (rule, count) in izip(rules, stats["selected"]):
+        print >> sys.stderr, "  %8d  %s" % (count, rule.source)
+
+# BATCH MODE
+
+def edit_job(job):
+    """Edit one boxfile into outFilename in a worker process. Returns
+    (stats, error)."""
+
+    (inFilename, outFilename, ruleLines, equalSplit) = job
+
+    # rules are parsed again in each process rather than pickled
+    rules = parse_rules(ruleLines)
+    stats = new_stats(rules)
+
+    imageFilename = None if equalSplit else find_image(inFilename)
+
+    def edit(inFile, outFile):
+        edit_file(inFile, outFile, rules, stats, imageFilename)
+
+    return (stats, rewrite_boxfile(inFilename, outFilename, edit))
+
+def edit_batch(opts, args, ruleLines):
+    """Edit many boxfiles, each in one go, across a pool of processes.
+    Returns the exit status: 1 if any boxfile failed."""
+
+    rules = parse_rules(ruleLines)
+    boxfiles = find_boxfiles(args)
+
+    if not boxfiles:
+        print >> sys.stderr, "No boxfiles to edit"
+        return 1
+
+    jobs = []
+    for (inFilename, relativePath) in boxfiles:
+        if opts.inPlace:
+            outFilename = inFilename
+        else:
+            outFilename = os.path.join(opts.outputDir, relativePath)
+
+        jobs.append((inFilename, outFilename, ruleLines, opts.equalSplit))
+
+    processes = opts.jobs if opts.jobs > 0 else cpu_count()
+
+    report = {'rules': [rule.source for rule in rules], 'files': {}, 'totals': new_stats(rules)}
+    totals = report['totals']
+    failed = 0
+
+    # the pool only pays for itself with several boxfiles
+    if processes > 1 and len(jobs) > 1:
+        pool = Pool(min(processes, len(jobs)))
+        results = pool.imap(edit_job, jobs)
+    else:
+        pool = None
+        results = imap(edit_job, jobs)
+
+    try:
+        # imap hands the results back in the order of the jobs
+        for ((inFilename, relativePath), (stats, error)) in izip(boxfiles, results):
+
+            if error:
+                print >> sys.stderr, "Could not edit %s: %s" % (inFilename, error)
+                report['files'][inFilename] = {'error': error}
+                failed += 1
+                continue
+
+            report['files'][inFilename] = stats
+            totals["total_in"] += stats["total_in"]
+            totals["total_out"] += stats["total_out"]
+            totals["selected"] = map(sum, izip(totals["selected"], stats["selected"]))
+
+            if opts.verbose:
+                print_stats(rules, stats, inFilename)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if opts.verbose:
+        print_stats(rules, totals, '%d boxfiles' % (len(boxfiles) - failed))
+
+    if opts.report:
+        write_report(report, opts.report)
+
+    return 1 if failed else 0
+
+# If program is run directly
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Writes the .boxidx sidecar index of boxfiles, so that moshPyTT,
+#       mergeboxes.py and editboxes.py can read them without parsing.
+#
+#       An index is only used while its boxfile is unchanged, so run this
+#       again after editing a boxfile. mergeboxes.py and editboxes.py write
+#       a new index themselves when the boxfile they read had one. With -c
+#       nothing is written: the boxfiles whose index is missing or out of
+#       date are listed instead. With --compare nothing is written either:
+#       each boxfile with an up-to-date index is read both with and without
+#       it, and the ones whose pages differ are listed.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import codecs
+from itertools import imap, izip, izip_longest
+from multiprocessing import Pool, cpu_count
+import optparse
+import sys
+
+from boxfile import build_index
+from boxindex import BoxIndex
+from mergeboxes import find_boxfiles, read_pages
+
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [-c | --compare] [-f] [-j jobs] boxfile|directory|glob ...")
+    parser.add_option('-c', '--check', dest='check', action='store_true', default=False,
+                      help='Only list the boxfiles whose index is missing or out of date. Exits with 1 if there are any.')
+
+    parser.add_option('--compare', dest='compare', action='store_true', default=False,
+                      help='Check that reading each boxfile through its index gives the same pages as parsing it. Lists the boxfiles which differ, and exits with 1 if there are any.')
+
+    parser.add_option('-f', '--force', dest='force', action='store_true', default=False,
+                      help='Index every boxfile again, even if its index is up to date.')
+
+    parser.add_option('-j', '--jobs', dest='jobs', action='store', type='int',
+                      default=1, help='Index up to JOBS boxfiles at once in separate processes. 0 uses one per CPU. Defaults to 1.')
+
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+                      help="Also print the number of boxes indexed in each boxfile (to standard error)")
+    (opts, args) = parser.parse_args()
+
+    if not args:
+        parser.print_help()
+        return 0
+
+    boxfiles = [filename for (filename, relativePath) in find_boxfiles(args)]
+
+    if not boxfiles:
+        print >> sys.stderr, "No boxfiles to index"
+        return 1
+
+    if opts.compare:
+        job = compare_job
+    else:
+        job = index_job
+
+        if not opts.force:
+            boxfiles = [filename for filename in boxfiles if not is_indexed(filename)]
+
+    if opts.check:
+        for filename in boxfiles:
+            print filename
+        return 1 if boxfiles else 0
+
+    processes = opts.jobs if opts.jobs > 0 else cpu_count()
+
+    # the pool only pays for itself with several boxfiles
+    if processes > 1 and len(boxfiles) > 1:
+        pool = Pool(min(processes, len(boxfiles)))
+        results = pool.imap(job, boxfiles)
+    else:
+        pool = None
+        results = imap(job, boxfiles)
+
+    failed = 0
+    try:
+        for (filename, (count, error)) in izip(boxfiles, results):
+
+            if opts.compare and error:
+                print "%s: %s" % (filename, error)
+                failed += 1
+            elif error:
+                print >> sys.stderr, "Could not index %s: %s" % (filename, error)
+                failed += 1
+            elif opts.verbose:
+                print >> sys.stderr, "%s: %s %d boxes." % (filename, 'compared' if opts.compare else 'indexed', count)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return 1 if failed else 0
+
+def is_indexed(filename):
+    """If a boxfile has an up-to-date index"""
+
+    index = BoxIndex.open(filename)
+    if index:
+        index.close()
+        return True
+
+    return False
+
+def index_job(filename):
+    """Index one boxfile in a worker process. Returns (number of boxes,
+    error)."""
+
+    try:
+        count = build_index(filename)
+    except (IOError, OSError, UnicodeError), e:
+        return (0, str(e))
+
+    if count is None:
+        return (0, 'too big to index')
+
+    return (count, None)
+
+def compare_job(filename):
+    """Read a boxfile page by page with and without its index, in a worker
+    process. Returns (number of boxes, the first difference or None)."""
+
+    if not is_indexed(filename):
+        return (0, 'no up-to-date index')
+
+    try:
+        parsedFile = codecs.open(filename, 'r', 'utf-8')
+        indexedFile = open(filename, 'rb')
+        try:
+            count = 0
+            for (parsed, indexed) in izip_longest(read_pages(parsedFile, useIndex=False),
+                                                  read_pages(indexedFile)):
+                if parsed is None or indexed is None:
+                    return (count, 'the index has %s pages' % ('more' if parsed is None else 'fewer'))
+
+                if list(parsed.make_strings()) != list(indexed.make_strings()):
+                    return (count, 'the pages differ from box %d on' % (count + 1))
+
+                count += len(parsed)
+        finally:
+            parsedFile.close()
+            indexedFile.close()
+    except (IOError, OSError, UnicodeError), e:
+        return (0, str(e))
+
+    return (count, None)
+
+# If program is run directly
+if __name__ == "__main__":
+    sys.exit(main())
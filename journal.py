@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       An append-only journal of the edits made to a boxfile in moshPyTT,
+#       written from a background thread, with crash recovery.
+#
+#       Every insertion and deletion is appended to <boxfile>.journal as a
+#       line of JSON, in the same form as the undo stack items. From time to
+#       time the whole text is written to <boxfile>.autosave and the journal
+#       starts again from that snapshot. On opening a boxfile, the snapshot
+#       (or the boxfile itself) is replayed with the journal to get back
+#       what hadn't been saved. When the pages of a multi-page boxfile are
+#       edited one at a time, each page has its own journal and autosave.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import codecs
+import hashlib
+import json
+import threading
+import Queue
+
+
+def page_filename(filename, page):
+
+    if page is None:
+        return filename
+    return '%s.page%d' % (filename, page)
+
+
+def journal_filename(filename, page=None):
+    return page_filename(filename, page) + '.journal'
+
+
+def autosave_filename(filename, page=None):
+    return page_filename(filename, page) + '.autosave'
+
+
+def file_stamp(filename):
+    """The size and modification time of a file, to tell if it has changed"""
+
+    info = os.stat(filename)
+    return [info.st_size, info.st_mtime]
+
+
+def remove_file(filename):
+
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def replace_file(filename, data):
+    """Write data to a file by writing a temporary file and renaming it
+    over the old one, so a crash leaves either the old or the new file"""
+
+    tmpFilename = filename + '.tmp'
+
+    tmpFile = open(tmpFilename, 'wb')
+    try:
+        tmpFile.write(data)
+        tmpFile.flush()
+        os.fsync(tmpFile.fileno())
+    finally:
+        tmpFile.close()
+
+    os.rename(tmpFilename, filename)
+
+
+def apply_record(text, record):
+    """Apply an INS or DEL record to a unicode string"""
+
+    offset = record['offset']
+
+    if record['action'] == 'INS':
+        return text[:offset] + record['text'] + text[offset:]
+    else:
+        return text[:offset] + text[offset + len(record['text']):]
+
+
+def recover_text(filename, page=None, baseText=None):
+    """Return the text of a boxfile with any unsaved edits from an earlier
+    session replayed onto it, or None if there is nothing to recover.
+
+    For a single page of a boxfile, give the page number and the text of
+    the page in the boxfile as baseText."""
+
+    journalFilename = journal_filename(filename, page)
+    autosaveFilename = autosave_filename(filename, page)
+
+    snapshot = None
+    if os.path.exists(autosaveFilename):
+        snapshotFile = open(autosaveFilename, 'rb')
+        snapshot = snapshotFile.read()
+        snapshotFile.close()
+
+    if not os.path.exists(journalFilename):
+        if snapshot is None:
+            return None
+        return snapshot.decode('utf-8')
+
+    journalFile = open(journalFilename, 'rb')
+    lines = journalFile.read().split('\n')
+    journalFile.close()
+
+    try:
+        header = json.loads(lines[0])
+    except ValueError: # the session crashed before the header was written
+        header = {'base': None}
+
+    if snapshot is not None:
+        if header.get('md5') != hashlib.md5(snapshot).hexdigest():
+            # the snapshot was written after every edit in this journal
+            return snapshot.decode('utf-8')
+
+        text = snapshot.decode('utf-8')
+
+    elif header['base'] == 'boxfile' and os.path.exists(filename) \
+            and file_stamp(filename) == header['stamp']:
+        if baseText is not None:
+            text = baseText
+        else:
+            boxFile = codecs.open(filename, 'r', 'utf-8')
+            text = boxFile.read()
+            boxFile.close()
+
+    else: # the edits were made to a version of the boxfile we don't have
+        print 'Ignoring journal %s: its boxfile has changed' % journalFilename
+        return None
+
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except ValueError: # a blank or half-written last line
+            break
+
+        text = apply_record(text, record)
+
+    return text
+
+
+class EditJournal:
+    """Journal of the edits to a boxfile, written by a background thread.
+
+    The methods only queue work for the writer thread, so the caller never
+    waits for the disk. The writer handles the queue in order, so a snapshot
+    holds every edit recorded before it."""
+
+    def __init__(self, filename, page=None):
+
+        self.filename = filename
+        self.page = page # None unless the pages are journalled separately
+        self.journalFile = None # opened on the first edit
+
+        self.queue = Queue.Queue()
+
+        self.writer = threading.Thread(target=self.run)
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def record(self, change):
+        """Journal an undo stack item. It is serialised straight away,
+        because the undo stack changes its items in place."""
+
+        self.queue.put(('record', json.dumps(change)))
+
+    def snapshot(self, text):
+        """Write the whole text as the new autosave file, and start the
+        journal again from it"""
+
+        self.queue.put(('snapshot', text))
+
+    def discard(self, filename=None, page=None):
+        """Remove the journal and autosave files of filename and page (by
+        default the current ones), e.g. once the boxfile has been saved"""
+
+        self.queue.put(('discard', (filename, page)))
+
+    def set_filename(self, filename, page=None):
+        """Journal later edits for a different boxfile or page"""
+
+        self.queue.put(('filename', (filename, page)))
+
+    def close(self):
+        """Finish writing everything that is queued"""
+
+        self.queue.put(None)
+        self.writer.join()
+
+    # THE WRITER THREAD
+
+    def run(self):
+
+        handlers = {'record': self.write_record,
+                    'snapshot': self.write_snapshot,
+                    'discard': self.remove_files,
+                    'filename': self.change_filename}
+
+        while True:
+            message = self.queue.get()
+
+            if message is None:
+                break
+
+            try:
+                handlers[message[0]](message[1])
+            except (IOError, OSError), e:
+                print 'Autosave failed: %s' % e
+
+        self.close_journal()
+
+    def close_journal(self):
+
+        if self.journalFile:
+            self.journalFile.close()
+            self.journalFile = None
+
+    def start_journal(self, header):
+
+        self.close_journal()
+
+        journalFilename = journal_filename(self.filename, self.page)
+        replace_file(journalFilename, json.dumps(header) + '\n')
+
+        self.journalFile = open(journalFilename, 'ab')
+
+    def write_record(self, line):
+
+        if not self.journalFile:
+            self.start_journal({'base': 'boxfile', 'stamp': file_stamp(self.filename)})
+
+        self.journalFile.write(line + '\n')
+        self.journalFile.flush()
+
+    def write_snapshot(self, text):
+
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+
+        replace_file(autosave_filename(self.filename, self.page), text)
+        self.start_journal({'base': 'autosave', 'md5': hashlib.md5(text).hexdigest()})
+
+    def remove_files(self, target):
+
+        (filename, page) = target
+
+        if filename is None:
+            (filename, page) = (self.filename, self.page)
+
+        if (filename, page) == (self.filename, self.page):
+            self.close_journal()
+
+        remove_file(journal_filename(filename, page))
+        remove_file(autosave_filename(filename, page))
+
+    def change_filename(self, target):
+
+        self.close_journal()
+        (self.filename, self.page) = target
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Checks boxfiles for boxes which are wrong in ways that only show up
+#       later, as a failed or poor training run. The checks are:
+#
+#           invalid     the line isn't a box at all
+#           empty       the box has zero or negative width or height
+#           duplicate   the box overlaps an earlier box on the same page by
+#                       at least the overlap threshold (the area they share
+#                       over the area they cover), so one is likely a copy
+#           bounds      the box reaches outside the image of its page
+#           page        a negative page, a page the image doesn't have, or
+#                       a page which comes after a later one
+#           size        the box is many times wider or taller than is usual
+#                       on its page
+#
+#       Each finding is printed as a line, so that editors can jump to it:
+#
+#           boxfile:line: check: message
+#
+#       or with --json as a JSON object per line. moshPyTT lists the
+#       findings for the page being edited with Edit > Check Boxes.
+#
+#       The image of a boxfile is the one next to it with the same name, as
+#       moshPyTT opens them together. Only its header is read, for the size
+#       of each page. Without PIL or an image the bounds check is skipped,
+#       and so is checking the pages against the image.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+from array import array
+from itertools import imap, izip
+from multiprocessing import Pool, cpu_count
+import codecs
+import json
+import operator
+import optparse
+import sys
+
+from boxfile import BoxTable, iter_chunks, parse_columns
+from boxgrid import MAX_GRID_CELLS
+from boxindex import BoxIndex
+from boxsplit import find_image
+from mergeboxes import find_boxfiles
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+CHECKS = ('invalid', 'empty', 'duplicate', 'bounds', 'page', 'size')
+
+# a page with fewer boxes than this doesn't say what size is usual
+MIN_SIZE_SAMPLE = 10
+
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [options] boxfile|directory|glob ...")
+    parser.add_option('-t', '--overlap', dest='overlap', action='store', type='float',
+                      default=0.5, help='Boxes on the same page are duplicates if the area they share is at least OVERLAP of the area they cover. Defaults to 0.5.')
+
+    parser.add_option('-s', '--size-factor', dest='sizeFactor', action='store', type='float',
+                      default=5.0, help='A box is an outlier if it is more than SIZEFACTOR times the median width or height of the boxes on its page. Defaults to 5.')
+
+    parser.add_option('-x', '--ignore', dest='ignore', action='append', default=[],
+                      help='Skip a check: one of %s. May be given more than once.' % ', '.join(CHECKS))
+
+    parser.add_option('-n', '--no-image', dest='noImage', action='store_true', default=False,
+                      help="Don't read the boxfiles' images, skipping the bounds check.")
+
+    parser.add_option('-j', '--jobs', dest='jobs', action='store', type='int',
+                      default=1, help='Check up to JOBS boxfiles at once in separate processes. 0 uses one per CPU. Defaults to 1.')
+
+    parser.add_option('--json', dest='json', action='store_true', default=False,
+                      help='Print each finding as a JSON object, one per line.')
+
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+                      help="Also print the number of findings of each check (to standard error)")
+    (opts, args) = parser.parse_args()
+
+    if not args:
+        parser.print_help()
+        return 0
+
+    for check in opts.ignore:
+        if check not in CHECKS:
+            parser.error('no such check: %s' % check)
+
+    checks = tuple(check for check in CHECKS if check not in opts.ignore)
+
+    boxfiles = [filename for (filename, relativePath) in find_boxfiles(args)]
+
+    if not boxfiles:
+        print >> sys.stderr, "No boxfiles to check"
+        return 1
+
+    jobs = [(filename, opts.noImage, checks, opts.overlap, opts.sizeFactor)
+            for filename in boxfiles]
+
+    processes = opts.jobs if opts.jobs > 0 else cpu_count()
+
+    # the pool only pays for itself with several boxfiles
+    if processes > 1 and len(jobs) > 1:
+        pool = Pool(min(processes, len(jobs)))
+        results = pool.imap(lint_job, jobs)
+    else:
+        pool = None
+        results = imap(lint_job, jobs)
+
+    out = codecs.getwriter('utf-8')(sys.stdout)
+    totals = dict((check, 0) for check in checks)
+    failed = 0
+
+    try:
+        # imap hands the results back in the order of the jobs
+        for (filename, (findings, error)) in izip(boxfiles, results):
+
+            if error:
+                print >> sys.stderr, "Could not check %s: %s" % (filename, error)
+                failed += 1
+                continue
+
+            for (line, check, message) in findings:
+                if opts.json:
+                    out.write(json.dumps({'file': filename, 'line': line, 'check': check,
+                                          'message': message}, sort_keys=True) + '\n')
+                else:
+                    out.write(u'%s:%d: %s: %s\n' % (filename.decode('utf-8', 'replace'), line, check, message))
+
+                totals[check] += 1
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if opts.verbose:
+        print >> sys.stderr, "Checked %d boxfiles: %s" % (len(boxfiles) - failed,
+                ', '.join('%d %s' % (totals[check], check) for check in checks))
+
+    return 1 if failed or sum(totals.values()) else 0
+
+# READING
+
+def read_lines(lines):
+    """Parse boxfile lines into a BoxTable, with its invalidLines, and an
+    array of the line number of each box"""
+
+    table = BoxTable()
+    lineNumbers = array('i')
+
+    for (firstLine, chunk) in iter_chunks(lines):
+        (attributes, numbers, chunkLineNumbers, invalidLines) = parse_columns(chunk, firstLine)
+
+        table.invalidLines.extend(invalidLines)
+        table.extend_columns(attributes, numbers)
+        lineNumbers.extend(array('i', chunkLineNumbers))
+
+    return (table, lineNumbers)
+
+def read_boxfile(filename):
+    """Read a whole boxfile as read_lines does, from its sidecar index if
+    it has an up-to-date one"""
+
+    index = BoxIndex.open(filename)
+    if index:
+        try:
+            table = BoxTable.from_index(index)
+            table.invalidLines = index.read_lines(index.invalid_line_numbers())
+            return (table, index.column('line'))
+        finally:
+            index.close()
+
+    boxFile = codecs.open(filename, 'r', 'utf-8')
+    try:
+        return read_lines(boxFile)
+    finally:
+        boxFile.close()
+
+def image_sizes(imageFilename):
+    """The (width, height) of each page of an image, reading only the
+    headers, or None if it can't be read"""
+
+    if Image is None or not imageFilename:
+        return None
+
+    try:
+        image = Image.open(imageFilename)
+    except IOError:
+        return None
+
+    sizes = []
+    while True:
+        sizes.append(image.size)
+        try:
+            image.seek(len(sizes))
+        except EOFError:
+            return sizes
+
+# CHECKS
+
+def median(values):
+
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def shares_area(table, first, second, overlap):
+    """If two boxes share at least overlap of the area they cover"""
+
+    (l1, b1, r1, t1) = (table.left[first], table.bottom[first], table.right[first], table.top[first])
+    (l2, b2, r2, t2) = (table.left[second], table.bottom[second], table.right[second], table.top[second])
+
+    if l2 >= r1 or r2 <= l1 or b2 >= t1 or t2 <= b1:
+        return False
+
+    shared = (min(r1, r2) - max(l1, l2)) * (min(t1, t2) - max(b1, b2))
+    covered = (r1 - l1) * (t1 - b1) + (r2 - l2) * (t2 - b2) - shared
+
+    return shared >= overlap * covered
+
+def find_duplicates(rows, table, overlap, cellSize):
+    """Find the boxes among rows, all on one page and with some area, which
+    share at least overlap of the area they cover with an earlier box.
+    Returns (earlier row, later row) pairs, with the first box each later
+    one duplicates.
+
+    Like BoxGrid, the boxes are filed under every cell of a uniform grid
+    they touch, so only boxes sharing a cell are compared. A pair is only
+    compared in the cell holding the bottom left corner of the area they
+    share, so it is never counted twice. Boxes spanning more than
+    MAX_GRID_CELLS cells, which are usually garbage, are left out of the
+    grid and compared with every box instead."""
+
+    (left, bottom, right, top) = (table.left, table.bottom, table.right, table.top)
+
+    cells = {}
+    oversized = []
+
+    for row in rows:
+        columns = xrange(left[row] // cellSize, (right[row] - 1) // cellSize + 1)
+        cellRows = xrange(bottom[row] // cellSize, (top[row] - 1) // cellSize + 1)
+
+        if len(columns) * len(cellRows) > MAX_GRID_CELLS:
+            oversized.append(row)
+            continue
+
+        for column in columns:
+            for cellRow in cellRows:
+                cell = cells.get((column, cellRow))
+                if cell is None:
+                    cells[(column, cellRow)] = [row]
+                else:
+                    cell.append(row)
+
+    earliest = {} # each later row -> the first row it duplicates
+
+    for ((column, cellRow), cell) in cells.iteritems():
+        if len(cell) < 2:
+            continue
+
+        for (position, first) in enumerate(cell):
+            (l1, b1, r1, t1) = (left[first], bottom[first], right[first], top[first])
+
+            for second in cell[position + 1:]:
+                (l2, b2, r2, t2) = (left[second], bottom[second], right[second], top[second])
+
+                # most boxes sharing a cell are neighbours which don't overlap
+                if l2 >= r1 or r2 <= l1 or b2 >= t1 or t2 <= b1:
+                    continue
+
+                l = l1 if l1 > l2 else l2
+                b = b1 if b1 > b2 else b2
+                r = r1 if r1 < r2 else r2
+                t = t1 if t1 < t2 else t2
+
+                if l // cellSize != column or b // cellSize != cellRow:
+                    continue
+
+                shared = (r - l) * (t - b)
+                covered = (r1 - l1) * (t1 - b1) + (r2 - l2) * (t2 - b2) - shared
+
+                if shared >= overlap * covered:
+                    (earlier, later) = (min(first, second), max(first, second))
+                    if earliest.get(later, later) > earlier:
+                        earliest[later] = earlier
+
+    # each pair with an oversized box once, two oversized boxes included
+    for (position, first) in enumerate(oversized):
+        others = set(oversized[:position + 1])
+
+        for second in rows:
+            if second not in others and shares_area(table, first, second, overlap):
+                (earlier, later) = (min(first, second), max(first, second))
+                if earliest.get(later, later) > earlier:
+                    earliest[later] = earlier
+
+    return sorted((earlier, later) for (later, earlier) in earliest.iteritems())
+
+def page_runs(pages):
+    """Split a page column into (page, first row, end row) runs"""
+
+    runs = []
+    start = 0
+
+    for (row, (before, after)) in enumerate(izip(pages, pages[1:]), 1):
+        if after != before:
+            runs.append((pages[start], start, row))
+            start = row
+
+    if len(pages):
+        runs.append((pages[start], start, len(pages)))
+
+    return runs
+
+def lint_table(table, lineNumbers, sizes=None, overlap=0.5, sizeFactor=5.0, checks=CHECKS):
+    """Check the boxes of a BoxTable, with the line number of each box and
+    the (width, height) of each page of the image (None where it isn't
+    known), or None without an image. Returns a sorted list of (line
+    number, check, message)."""
+
+    findings = []
+
+    if 'invalid' in checks:
+        findings.extend((number, 'invalid', u'not a box: %s' % line)
+                        for (number, line) in table.invalidLines)
+
+    (left, bottom, right, top) = (table.left, table.bottom, table.right, table.top)
+
+    widths = map(operator.sub, right, left)
+    heights = map(operator.sub, top, bottom)
+
+    hasArea = [width > 0 and height > 0 for (width, height) in izip(widths, heights)]
+
+    if 'empty' in checks:
+        findings.extend((lineNumbers[row], 'empty', u'has no area: %d x %d' % (widths[row], heights[row]))
+                        for row in xrange(len(table)) if not hasArea[row])
+
+    runs = page_runs(table.page)
+
+    if 'page' in checks:
+        highest = None
+        for (page, start, end) in runs:
+            if page < 0:
+                message = u'negative page %d' % page
+            elif sizes is not None and page >= len(sizes):
+                message = u'page %d, but the image has %d pages' % (page, len(sizes))
+            elif highest is not None and page < highest:
+                message = u'page %d comes after page %d' % (page, highest)
+            else:
+                message = None
+
+            if message:
+                findings.append((lineNumbers[start], 'page', u'%s, for %d box%s from here'
+                                 % (message, end - start, '' if end - start == 1 else 'es')))
+
+            highest = page if highest is None else max(highest, page)
+
+    pageRows = {}
+    for (page, start, end) in runs:
+        pageRows.setdefault(page, []).extend(xrange(start, end))
+
+    for (page, rows) in pageRows.iteritems():
+
+        if 'bounds' in checks and sizes and 0 <= page < len(sizes) and sizes[page]:
+            (width, height) = sizes[page]
+            findings.extend((lineNumbers[row], 'bounds', u'outside the %d x %d image' % (width, height))
+                            for row in rows if left[row] < 0 or bottom[row] < 0 or
+                            right[row] > width or top[row] > height)
+
+        rows = [row for row in rows if hasArea[row]]
+        if not rows:
+            continue
+
+        usualWidth = median(widths[row] for row in rows)
+        usualHeight = median(heights[row] for row in rows)
+
+        if 'size' in checks and len(rows) >= MIN_SIZE_SAMPLE:
+            findings.extend((lineNumbers[row], 'size', u'%d x %d, but most boxes on page %d are about %d x %d'
+                             % (widths[row], heights[row], page, usualWidth, usualHeight))
+                            for row in rows if widths[row] > sizeFactor * usualWidth or
+                            heights[row] > sizeFactor * usualHeight)
+
+        if 'duplicate' in checks:
+            # cells a couple of boxes across, so most boxes touch a few
+            cellSize = max(2 * max(usualWidth, usualHeight), 8)
+            findings.extend((lineNumbers[second], 'duplicate', u'overlaps the box on line %d' % lineNumbers[first])
+                            for (first, second) in find_duplicates(rows, table, overlap, cellSize))
+
+    findings.sort()
+
+    return findings
+
+def lint_lines(lines, sizes=None, overlap=0.5, sizeFactor=5.0, checks=CHECKS):
+    """Check boxfile lines with lint_table"""
+
+    (table, lineNumbers) = read_lines(lines)
+    return lint_table(table, lineNumbers, sizes, overlap, sizeFactor, checks)
+
+def lint_job(job):
+    """Check one boxfile in a worker process. Returns (findings, error)."""
+
+    (filename, noImage, checks, overlap, sizeFactor) = job
+
+    try:
+        (table, lineNumbers) = read_boxfile(filename)
+        sizes = None if noImage else image_sizes(find_image(filename))
+    except (IOError, OSError, UnicodeError), e:
+        return ([], str(e))
+
+    return (lint_table(table, lineNumbers, sizes, overlap, sizeFactor, checks), None)
+
+# If program is run directly
+if __name__ == "__main__":
+    sys.exit(main())
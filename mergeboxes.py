@@ -1,78 +1,469 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from moshpytt import TesseractBox
+from boxfile import TesseractBox, BoxTable, build_index
+from boxindex import BoxIndex, index_filename
+from itertools import islice, izip, imap
+from array import array
+from multiprocessing import Pool, cpu_count
 import codecs
+import glob
+import json
+import operator
 import optparse
+import os
+import sys
 
 def main():
-    parser = optparse.OptionParser(usage="Usage: %prog [-t threshold] boxfile")
+    parser = optparse.OptionParser(usage="Usage: %prog [-t threshold] [-y threshold] [-o outfile] boxfile\n"
+                                         "       %prog (-i | -d outdir) [-j jobs] [-r report] boxfile|directory|glob ...")
     parser.add_option('-t', '--threshold', dest='threshold', action='store',
-                      type='int', default=1, help='Adjacent boxes separated horizontally by THRESHOLD or fewer pixels will be merged. Horizontal separation is ignored. Note that this means that boxes located on different lines might be merged in certain (rare) circumstances. Defaults to 1 (boxes are adjacent).')
+                      type='int', default=1, help='Boxes on the same text line separated horizontally by THRESHOLD or fewer pixels will be merged. Overlapping boxes are always close enough. Defaults to 1 (boxes are adjacent).')
+
+    parser.add_option('-y', '--vertical-threshold', dest='verticalThreshold', action='store',
+                      type='int', default=None, help='Only merge boxes separated vertically by VERTICALTHRESHOLD or fewer pixels, e.g. 0 to leave the dots of i and j alone. By default the vertical separation is ignored.')
+
+    parser.add_option('-l', '--line-overlap', dest='lineOverlap', action='store',
+                      type='float', default=0.5, help='A box is on a text line if it overlaps it vertically by at least this fraction of the smaller height of the two. Defaults to 0.5.')
+
+    parser.add_option('-o', '--output', dest='output', action='store',
+                      help='Write the merged boxfile to OUTPUT instead of standard output.')
+
+    parser.add_option('-i', '--in-place', dest='inPlace', action='store_true', default=False,
+                      help='Batch mode: replace each boxfile with its merged version.')
+
+    parser.add_option('-d', '--output-dir', dest='outputDir', action='store',
+                      help='Batch mode: write the merged boxfiles to OUTPUTDIR, keeping their paths relative to the directories they were found in.')
+
+    parser.add_option('-j', '--jobs', dest='jobs', action='store', type='int',
+                      default=1, help='Batch mode: merge up to JOBS boxfiles at once in separate processes. 0 uses one per CPU. Defaults to 1.')
+
+    parser.add_option('-r', '--report', dest='report', action='store',
+                      help='Batch mode: write the statistics of every boxfile, and the totals, to REPORT as JSON.')
 
     parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
-                      help="Also print statistics about number of boxes merged")
+                      help="Also print statistics about number of boxes merged (to standard error)")
     (opts, args) = parser.parse_args()
 
+    if opts.inPlace or opts.outputDir:
+        if opts.inPlace and opts.outputDir:
+            parser.error('use only one of -i and -d')
+        if opts.output:
+            parser.error('-o only works with a single boxfile; use -d in batch mode')
+        return merge_batch(opts, args)
+
     if len(args) != 1:
         parser.print_help()
         return 0
 
-    boxes = parse_boxfile(args)
-    (merged,stats) = merge_nearby_boxes(opts,boxes)
+    # The boxfile is read, merged and written one page at a time, so memory
+    # use only depends on the size of a page. Use "-" to read stdin.
+    if args[0] == '-':
+        inFile = codecs.getreader('utf-8')(sys.stdin)
+    else:
+        inFile = codecs.open(args[0], mode='r', encoding='utf-8')
+
+    if opts.output:
+        outFile = codecs.open(opts.output, mode='w', encoding='utf-8')
+    else:
+        outFile = codecs.getwriter('utf-8')(sys.stdout)
 
-    # Print new box file; user can redirect to file
-    for box in merged:
-        print box
+    stats = new_stats()
+    try:
+        merge_file(inFile, outFile, opts.threshold, opts.verticalThreshold,
+                   opts.lineOverlap, stats)
+    finally:
+        inFile.close()
+        if opts.output:
+            outFile.close()
 
     if opts.verbose:
-        print "Merged %d out of %d boxes. Outputting %d boxes." %(stats["num_merged"], stats["total_in"], stats["total_out"])
+        print >> sys.stderr, "Merged %d out of %d boxes. Outputting %d boxes." %(stats["num_merged"], stats["total_in"], stats["total_out"])
+
+def merge_file(inFile, outFile, threshold, verticalThreshold=None, lineOverlap=0.5, stats=None):
+    """Merge an open boxfile into another, a page at a time"""
+
+    for page in read_pages(inFile):
+        merge_page(page, threshold, verticalThreshold, lineOverlap, stats).write(outFile)
+
+# BATCH MODE
+
+def find_boxfiles(args):
+    """Expand boxfiles, directories (searched for .box files) and glob
+    patterns into a sorted list of (boxfile, path relative to where it was
+    found) pairs"""
+
+    found = {}
+
+    for arg in args:
+        if os.path.isdir(arg):
+            for (directory, subdirectories, filenames) in os.walk(arg):
+                for filename in filenames:
+                    if filename.endswith('.box'):
+                        path = os.path.join(directory, filename)
+                        found[path] = os.path.relpath(path, arg)
+        else:
+            matches = glob.glob(arg)
+            if not matches:
+                print >> sys.stderr, "No boxfiles match %s" % arg
+            for path in matches:
+                if os.path.isfile(path):
+                    found[path] = os.path.basename(path)
+
+    return sorted(found.items())
+
+def rewrite_boxfile(inFilename, outFilename, process):
+    """Call process(inFile, outFile) to write a new version of a boxfile to
+    outFilename, making its directory if need be. The result is written to
+    a temporary file which is renamed over outFilename, so nothing ever
+    sees a half-written boxfile. Returns an error message, or None."""
+
+    tempFilename = '%s.%d.tmp' % (outFilename, os.getpid())
+
+    try:
+        directory = os.path.dirname(outFilename)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError: # another worker made it first
+                if not os.path.isdir(directory):
+                    raise
+
+        inFile = codecs.open(inFilename, mode='r', encoding='utf-8')
+        try:
+            outFile = codecs.open(tempFilename, mode='w', encoding='utf-8')
+            try:
+                process(inFile, outFile)
+            finally:
+                outFile.close()
+        finally:
+            inFile.close()
+
+        os.rename(tempFilename, outFilename)
+
+        # keep the output as quick to open as the input was
+        if os.path.exists(index_filename(inFilename)):
+            build_index(outFilename)
+
+    except (IOError, OSError, UnicodeError), e:
+        if os.path.exists(tempFilename):
+            os.remove(tempFilename)
+        return str(e)
+
+    return None
+
+def merge_job(job):
+    """Merge one boxfile into outFilename in a worker process. Returns
+    (stats, error)."""
+
+    (inFilename, outFilename, threshold, verticalThreshold, lineOverlap) = job
+
+    stats = new_stats()
+
+    def merge(inFile, outFile):
+        merge_file(inFile, outFile, threshold, verticalThreshold, lineOverlap, stats)
+
+    return (stats, rewrite_boxfile(inFilename, outFilename, merge))
+
+def merge_batch(opts, args):
+    """Merge many boxfiles, each in one go, across a pool of processes.
+    Returns the exit status: 1 if any boxfile failed."""
+
+    boxfiles = find_boxfiles(args)
+
+    if not boxfiles:
+        print >> sys.stderr, "No boxfiles to merge"
+        return 1
+
+    jobs = []
+    for (inFilename, relativePath) in boxfiles:
+        if opts.inPlace:
+            outFilename = inFilename
+        else:
+            outFilename = os.path.join(opts.outputDir, relativePath)
+
+        jobs.append((inFilename, outFilename, opts.threshold,
+                     opts.verticalThreshold, opts.lineOverlap))
+
+    processes = opts.jobs if opts.jobs > 0 else cpu_count()
+
+    report = {'files': {}, 'totals': new_stats()}
+    totals = report['totals']
+    failed = 0
+
+    # the pool only pays for itself with several boxfiles
+    if processes > 1 and len(jobs) > 1:
+        pool = Pool(min(processes, len(jobs)))
+        results = pool.imap(merge_job, jobs)
+    else:
+        pool = None
+        results = imap(merge_job, jobs)
+
+    try:
+        # imap hands the results back in the order of the jobs
+        for ((inFilename, relativePath), (stats, error)) in izip(boxfiles, results):
+
+            if error:
+                print >> sys.stderr, "Could not merge %s: %s" % (inFilename, error)
+                report['files'][inFilename] = {'error': error}
+                failed += 1
+                continue
+
+            report['files'][inFilename] = stats
+            for key in totals:
+                totals[key] += stats[key]
+
+            if opts.verbose:
+                print >> sys.stderr, "%s: merged %d out of %d boxes. Outputting %d boxes." % (inFilename, stats["num_merged"], stats["total_in"], stats["total_out"])
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if opts.verbose:
+        print >> sys.stderr, "Merged %d out of %d boxes in %d boxfiles. Outputting %d boxes." % (totals["num_merged"], totals["total_in"], len(boxfiles) - failed, totals["total_out"])
+
+    if opts.report:
+        write_report(report, opts.report)
+
+    return 1 if failed else 0
+
+def write_report(report, filename):
+    """Write the JSON report, through a temporary file, or to standard
+    output if filename is "-"."""
+
+    if filename == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+        return
+
+    tempFilename = filename + '.tmp'
+
+    reportFile = open(tempFilename, 'w')
+    try:
+        json.dump(report, reportFile, indent=2, sort_keys=True)
+    finally:
+        reportFile.close()
+
+    os.rename(tempFilename, filename)
 
 def parse_boxfile(args):
-    """Read in a boxfile, return an array of TesseractBox objects"""
+    """Read in a boxfile, return a BoxTable of its boxes"""
 
-    ifile = codecs.open(args[0],mode='r',encoding='utf-8')
-    boxes = list()
+    return BoxTable.from_file(args[0])
 
-    for line in ifile:
-        boxes.append(TesseractBox(line))
+def new_stats():
+    return {"total_in": 0,"total_out": 0, "num_merged": 0}
 
-    return boxes
+def read_pages(boxFile, chunkSize=4096, useIndex=True):
+    """Lazily read an open boxfile as a BoxTable for each run of boxes on
+    the same page. Blank and invalid lines are skipped. If the boxfile has
+    an up-to-date sidecar index, and useIndex is set, the pages are read
+    from that instead."""
 
-def merge_nearby_boxes(opts,boxes):
-    """Merge boxes in the passed array of boxes which are both adjacent and
-    separated by fewer pixels than the threshold given in opts.threshold.
-    Outputs other boxes unchanged."""
+    index = useIndex and BoxIndex.open(getattr(boxFile, 'name', None))
+    if index:
+        try:
+            for page in read_index_pages(index):
+                yield page
+        finally:
+            index.close()
+        return
 
-    stats = {"total_in": 0,"total_out": 0, "num_merged": 0}
+    page = BoxTable()
 
-    stats["total_in"] = len(boxes)
-    
+    while True:
+        lines = list(islice(boxFile, chunkSize))
+        if not lines:
+            break
+
+        chunk = BoxTable.from_lines(lines)
+        pages = chunk.page
+
+        # split the chunk where the page number changes
+        start = 0
+        while start < len(chunk):
+            end = start
+            while end < len(chunk) and pages[end] == pages[start]:
+                end += 1
+
+            if len(page) and page.page[-1] != pages[start]:
+                yield page
+                page = BoxTable()
+
+            page.extend_rows(chunk, start, end)
+            start = end
+
+    if len(page):
+        yield page
+
+def read_index_pages(index):
+    """Read the pages of a boxfile from its BoxIndex, as read_pages does:
+    a page ends where the page number of the boxes changes. The page
+    ranges of the index aren't used, as invalid lines can split them."""
+
+    pages = index.column('page')
+
+    start = 0
+    while start < len(pages):
+        end = start
+        while end < len(pages) and pages[end] == pages[start]:
+            end += 1
+
+        yield BoxTable.from_index(index, start, end)
+        start = end
+
+def find_lines(table, lineOverlap=0.5):
+    """Cluster the boxes of a table, all on one page, into text lines.
+
+    The boxes are swept in order of their vertical centre. A line spans
+    the average bottom and top of its boxes, rather than all of them, so
+    that a few tall boxes don't join it to the lines above and below. A
+    box joins the current line if they overlap vertically by at least
+    lineOverlap of the smaller of their heights, and otherwise starts a
+    new line. Returns a list of lines, each a list of row numbers sorted
+    left to right."""
+
+    centres = map(operator.add, table.bottom, table.top) # twice the centre, to stay in integers
+    order = sorted(xrange(len(table)), key=centres.__getitem__)
+
+    bottoms = map(table.bottom.__getitem__, order)
+    tops = map(table.top.__getitem__, order)
+
+    lineOf = [0] * len(table) # the line number of each row
+    lineCount = 0
+
+    # the sums of the bottoms and tops of the boxes in the current line, and
+    # how many there are. The overlap test is scaled up by size to keep it
+    # in integers
+    (bottomSum, topSum, size) = (0, 0, 0)
+
+    for (index, bottom, top) in izip(order, bottoms, tops):
+        overlap = min(top * size, topSum) - max(bottom * size, bottomSum)
+        if overlap >= 0 and size and \
+                overlap >= lineOverlap * min((top - bottom) * size, topSum - bottomSum):
+            bottomSum += bottom
+            topSum += top
+            size += 1
+        else:
+            lineCount += 1
+            (bottomSum, topSum, size) = (bottom, top, 1)
+
+        lineOf[index] = lineCount - 1
+
+    # one sort by x for the whole page, then share the rows out in order
+    lines = [[] for line in xrange(lineCount)]
+    for index in sorted(xrange(len(table)), key=table.left.__getitem__):
+        lines[lineOf[index]].append(index)
 
-    output = list()
-    newbox = None
-    while(len(boxes) > 0):
-        pivot = boxes.pop(0)
-
-        # Newbox is the result of all previous merge operations
-        # In most cases, this is simply the previous pivot box.
-        if newbox is not None:
-            #Check horizontal separation
-            if separation_x(newbox,pivot) <= opts.threshold:
-                newbox = merge_two_boxes(newbox,pivot)
-                stats["num_merged"] += 1
-            #No merge, onto output list.
-            else:
-                output.append(newbox)
-                newbox = pivot
+    return lines
+
+def merge_line(table, line, threshold, verticalThreshold=None):
+    """Sweep along a text line from left to right, merging each box into
+    the group before it if the gap between them is at most threshold
+    pixels (and at most verticalThreshold pixels vertically, if given).
+    Returns a list of groups of row numbers."""
+
+    lefts = table.left
+    bottoms = table.bottom
+    rights = table.right
+    tops = table.top
+
+    groups = []
+    group = None
+    groupBottom = groupRight = groupTop = 0
+
+    for index in line:
+        if group is not None and lefts[index] - groupRight <= threshold and \
+                (verticalThreshold is None or
+                 max(bottoms[index], groupBottom) - min(tops[index], groupTop) <= verticalThreshold):
+            group.append(index)
+            groupBottom = min(groupBottom, bottoms[index])
+            groupRight = max(groupRight, rights[index])
+            groupTop = max(groupTop, tops[index])
         else:
-            newbox = pivot
+            group = [index]
+            groups.append(group)
+            (groupBottom, groupRight, groupTop) = (bottoms[index], rights[index], tops[index])
+
+    return groups
+
+def merge_page(table, threshold, verticalThreshold=None, lineOverlap=0.5, stats=None):
+    """Merge the boxes of a BoxTable, all on one page, which are on the same
+    text line and close enough (see find_lines and merge_line). Returns a
+    new BoxTable, in which each box is where the first of the boxes it was
+    merged from was. The text of a merged box is read left to right, and
+    it is not bold, italic or underlined.
+
+    This takes O(n log n) time for n boxes. If a stats dict (see new_stats)
+    is given, it is updated."""
+
+    if stats is None:
+        stats = new_stats()
+
+    groups = []
+    for line in find_lines(table, lineOverlap):
+        groups.extend(merge_line(table, line, threshold, verticalThreshold))
+
+    # keep the boxes in the order of the file: each group goes where its
+    # first row in the file was
+    byFirstRow = [None] * len(table)
+    for group in groups:
+        byFirstRow[min(group) if len(group) > 1 else group[0]] = group
+    groups = [group for group in byFirstRow if group is not None]
+
+    # build the result a column at a time, taking every column from the
+    # first box of each group, then fix up the few groups of several boxes.
+    # A group is sorted left to right, so its first box is the leftmost
+    firsts = [group[0] for group in groups]
+    multiples = [(position, group) for (position, group) in enumerate(groups) if len(group) > 1]
+
+    def combine(column, reduce):
+        values = map(column.__getitem__, firsts)
+        for (position, group) in multiples:
+            values[position] = reduce(map(column.__getitem__, group))
+        return values
+
+    merged = BoxTable()
+
+    merged.text = combine(table.text, u''.join)
+    merged.left = array('i', map(table.left.__getitem__, firsts))
+    merged.bottom = array('i', combine(table.bottom, min))
+    merged.right = array('i', combine(table.right, max))
+    merged.top = array('i', combine(table.top, max))
+    merged.page = array('i', map(table.page.__getitem__, firsts))
+
+    #Ignore italic, uline, and bold -- they are meaningless to merged
+    #boxes, so leave them false.
+    merged.bold = array('b', combine(table.bold, lambda flags: 0))
+    merged.italic = array('b', combine(table.italic, lambda flags: 0))
+    merged.uline = array('b', combine(table.uline, lambda flags: 0))
+
+    stats["total_in"] += len(table)
+    stats["total_out"] += len(merged)
+    stats["num_merged"] += len(table) - len(merged)
+
+    return merged
+
+def merge_nearby_boxes(opts,boxes):
+    """Merge boxes in the passed array of boxes which are on the same text
+    line and separated by fewer pixels than the threshold given in
+    opts.threshold. Outputs other boxes unchanged."""
+
+    stats = new_stats()
+    output = []
+
+    page = BoxTable()
+    for box in list(boxes) + [None]:
+        if len(page) and (box is None or box.page != page.page[-1]):
+            output.extend(merge_page(page, opts.threshold,
+                                     getattr(opts, 'verticalThreshold', None),
+                                     getattr(opts, 'lineOverlap', 0.5), stats))
+            page = BoxTable()
 
-    #Loop cleanup: push the final box onto the output
-    if newbox is not None:
-        output.append(newbox)
+        if box is not None:
+            page.append(box)
 
-    stats["total_out"] = len(output)
     return (output,stats)
 
 def merge_two_boxes(box1,box2):
@@ -112,4 +503,4 @@ def separation_y(box1,box2):
 
 # If program is run directly
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
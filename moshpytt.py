@@ -25,14 +25,25 @@ import pygtk
 pygtk.require('2.0')
 
 import gtk
+import gobject
 import pango
-import codecs
 import sys
 import os
 import shutil
-import copy
 from datetime import datetime
 import optparse
+import bisect
+
+from boxfile import PageIndex
+from boxdocument import BoxDocument
+from boxgrid import BoxGrid
+from tiledimage import TiledImage, count_frames
+from journal import EditJournal, recover_text
+from undoredo import UndoRedoStack, char_length
+from boxquery import BoxQuery
+from lintboxes import lint_lines
+import timing
+from timing import timed
 
 #CONVERT A DIRECTORY OF IMAGES TO A DJVU FILE
 
@@ -43,10 +54,20 @@ def main():
     parser.add_option('-i', dest='imageFile', action='store',
                              help='an image with a corresponding boxfile')
     parser.add_option('-d', dest='debug', action='store_true', default=False,
-                             help='show debugging information')
+                             help='show debugging information, and time the hot paths')
+    parser.add_option('--trace', dest='traceFile', action='store',
+                             default='moshpytt-trace.json',
+                             help='with -d, where to write the timings as a Chrome trace (default %default)')
+    parser.add_option('-p', '--save-pyramid', dest='savePyramid', action='store_true', default=False,
+                             help='keep the zoomed out copies of the image in a .pyramid directory next to it, so that zooming out is quick next time')
 
     (opts, args) = parser.parse_args()
 
+    if opts.debug:
+        timing.enable(opts.traceFile)
+
+    gobject.threads_init() # let the autosave thread run alongside the GUI
+
     MoshPyTT(opts)
 
 # parameters
@@ -65,9 +86,21 @@ MENU = \
     <menu action="Edit">
       <menuitem action="Undo"/>
       <menuitem action="Redo"/>
+      <menuitem action="UndoMany"/>
+      <menuitem action="RedoMany"/>
       <menuitem action="MergeBoxes"/>
       <menuitem action="SplitBoxes"/>
       <menuitem action="DeleteBoxes"/>
+      <menuitem action="CheckBoxes"/>
+    </menu>
+    <menu action="View">
+      <menuitem action="ZoomIn"/>
+      <menuitem action="ZoomOut"/>
+      <menuitem action="ZoomNormal"/>
+    </menu>
+    <menu action="Page">
+      <menuitem action="PreviousPage"/>
+      <menuitem action="NextPage"/>
     </menu>
     <menu action="Help">
       <menuitem action="About"/>
@@ -76,197 +109,37 @@ MENU = \
   </menubar>
 </ui>'''
 
-class TesseractBox:
-
-    text = ''
-
-    left = None
-    right = None
-    top = None
-    bottom = None
-
-    page = None
-
-    italic = False
-    uline = False
-    bold = False
-
-    valid = False # if the box is valid
-
-
-    def make_string(self):
-        """Constructs a box string from the box object"""
-        string = ''
-        if self.bold:
-            string += "@"
-        if self.italic:
-            string += "$"
-        if self.uline:
-            string += "'"
-
-        string +=  '%s %d %d %d %d %d' % (self.text, self.left, self.bottom, self.right, self.top, self.page)
-
-        return string
-
-    def set_text(self, string):
-        if type(string) is str or type(string) is unicode:
-            self.text = string
-        else:
-            raise TypeError("Box text must be a string. Received " + str(type(string)))
-
-    def check_numbers(self):
-        """Checks the box edges to ensure that the "left" edge is really to the
-        left of the "right" edge, and simlar for the top/bottom"""
-
-        if self.left > self.right:
-            temp = self.left
-            self.left = self.right
-            self.right = temp
-
-        if self.top < self.bottom:
-            temp = self.top
-            self.top = self.bottom
-            self.bottom = temp
-
-
-    def move(self, direction, step=1):
-        """Move the box to one side, in the direction given, by step pixels."""
-
-        if direction == 'LEFT':
-            self.left -= step
-            self.right -= step
-        elif direction == 'RIGHT':
-            self.left += step
-            self.right += step
-        elif direction == 'TOP':
-            self.top += step
-            self.bottom += step
-        elif direction == 'BOTTOM':
-            self.top -= step
-            self.bottom -= step
-
-
-    def stretch(self, direction, step=1):
-        """Stretch the "direction" side of the box by "step" pixels. Negative
-        step values produce shrinkage of the box"""
-
-        if direction == 'LEFT':
-            self.left -= step
-        elif direction == 'RIGHT':
-            self.right += step
-        elif direction == 'TOP':
-            self.top += step
-        elif direction == 'BOTTOM':
-            self.bottom -= step
-        elif direction == 'ALL':
-            self.left -= step
-            self.right += step
-            self.top += step
-            self.bottom -= step
-
-        self.check_numbers()
-
-
-    def __init__(self, string=None):
-
-
-        if not string:
-            return
-
-        parts = string.split()
-
-        if len(parts) == 6:
-            try:
-
-                self.left = int(parts[1])
-                self.bottom = int(parts[2])
-                self.right = int(parts[3])
-                self.top = int(parts[4])
-
-                self.page = int(parts[5])
-
-                self.text = parts[0]
-
-                self.valid = True
-
-            except ValueError: # if the int()s fail, ignore this box, there is something wrong with it
-                return
-
-            attributeCounter = 0
-
-            while True:
-                #don't add attributes we already have, don't add last char
-                if self.text[attributeCounter] == '$' and not self.italic and attributeCounter +1 < len(self.text):
-                    attributeCounter += 1
-                    self.italic = True
-                elif self.text[attributeCounter] == '@' and not self.bold and attributeCounter +1 < len(self.text):
-                    attributeCounter += 1
-                    self.bold = True
-                elif self.text[attributeCounter] == "'" and not self.uline and attributeCounter +1 < len(self.text):
-                    attributeCounter += 1
-                    self.uline = True
-
-                #only the first 3 chars can be attrs, or maybe less
-                if attributeCounter > 2 or attributeCounter+1 >= len(self.text) or self.text[attributeCounter] not in ['@', '$', "'"]:
-                    break
-
-            self.text = self.text[attributeCounter:]
-        
-    def __repr__(self):
-        return "TesseractBox: "+self.make_string()
-
-    def __str__(self):
-        return self.make_string()
-
-    def __unicode__(self):
-        return self.make_string()
-
-class UndoRedoStack:
-
-    def __init__(self):
-
-        self.undoStack = []
-        self.redoStack = []
-
-
-    def undo(self):
-        """Grab an item off the stack, if there is one, but leave it in place"""
-
-        if len(self.undoStack) > 0:
-            item = self.undoStack.pop() # pop off the undo stack
-            self.redoStack.append(item) # and onto the redo stack
-            return item
-        else: #there is nothing to undo
-            return None
-
-
-    def redo(self):
-
-        if len(self.redoStack) > 0:
-            item = self.redoStack.pop() # pop off the redo stack
-            self.undoStack.append(item) # and onto the redo stack
-            return item
-        else: #there is nothing to redo
-            return None
-
-
-    def add_item(self, item):
-        self.undoStack.append(item) # add the item to the undo stack
-        self.redoStack = [] #invalidate the redo stack
-
-
 class MoshPyTT:
 
-    pixbuf = None
-    newBoxList = None # a temporary list of boxes produced after a merge. If != None, then there are newBoxes to deal with
-    deleteBoxes = False
+    image = None # the TiledImage being displayed
     boxList = [] # a list of boxes that are selected
+    topLine = 0 #first line of the selection
+    btmLine = 0 #last line of the selection
     blockUndoRedo = False #do not add the next action to the undo/redo stack
     userScrolled = False #true if the user overrides the automatic scrolling
     userSetAttributes = True #true if a toggling of the attribute button means the box needs to be updated
     boxfileChangedSinceSave = False #true if there are unsaved changes
     blockUpdates = False #true to prevent update callback firing
     changeCounter = 0 #counter of changes to the boxfile
+    documentSync = False #true while a change is being copied between the document and the text buffer
+    dragStart = None #drawing area coordinates where the mouse button went down
+    dragEnd = None #drawing area coordinates the rubber band is drawn to
+    selectionAreas = [] #drawing areas painted with the outlines and labels of the selected boxes
+    zoomLevel = 0 #the image is shown at 1/2**zoomLevel of its size
+    imageFilledIn = False #true once the first view of the image has been decoded, for the startup timing
+    penColour = None #the colour the drawing GC is set to
+    journal = None #the EditJournal recording changes to the boxfile
+    autosavePending = False #true if an autosave snapshot is waiting for the GUI to be idle
+    findLines = [] #line numbers of the boxes matching the search
+    findUpdatePending = False #true if the search results need updating once the GUI is idle
+    checkingBoxes = False #true if the results list shows the findings of Check Boxes, not a search
+    currentPage = 0 #the page of the image and boxfile being shown
+    imageFrameCount = 1 #number of pages in the image
+    pageIndex = None #the PageIndex of the loaded boxfile
+    pageTexts = {} #page -> text of the pages which were edited and left, until they are saved
+    pageUndoStacks = {} #page -> UndoRedoStack of the pages which were left
+    pageChanged = False #true if the page being shown has changed since it was loaded
+    imageSelection = False #true while the selection is being set from the image
 
     def error_dialog(self, labelText, parent):
         dialog = gtk.Dialog('Error', parent, gtk.DIALOG_NO_SEPARATOR
@@ -281,7 +154,7 @@ class MoshPyTT:
 
     # CALLBACKS
     def on_redraw(self, drawingArea, event):
-        self.redraw_drawing_area()
+        self.redraw_drawing_area(event.area)
 
 
     def on_mark_set(self, textBuffer, iter, textMark):
@@ -314,26 +187,81 @@ class MoshPyTT:
 
     def on_insert_text(self, textBuffer, startIter, insertedText, length):
 
+        offset = startIter.get_offset()
+
+        # change the document now: the buffer emits 'changed', which reads
+        # the current box, before the text-inserted handlers run
+        self.sync_document(offset, 0, insertedText)
+
+        undoStackItem = {'action':'INS', 'text':insertedText, 'offset':offset}
+
+        if self.journal:
+            self.journal.record(undoStackItem)
+
         allowUndo = self.on_change()
 
         if allowUndo:
-            offset = startIter.get_offset()
-            undoStackItem = {'action':'INS', 'text':insertedText, 'offset':offset}
-
             self.undoRedoStack.add_item( undoStackItem )
 
 
     def on_delete_range(self, textBuffer, startIter, endIter):
 
+        offset = startIter.get_offset()
+        self.sync_document(offset, endIter.get_offset() - offset, u'')
+
+        deletedText = self.textBuffer.get_text(startIter, endIter)
+        undoStackItem = {'action':'DEL', 'text':deletedText, 'offset':offset}
+
+        if self.journal:
+            self.journal.record(undoStackItem)
+
         allowUndo = self.on_change()
 
         if allowUndo:
-            deletedText = self.textBuffer.get_text(startIter, endIter)
-            offset = startIter.get_offset()
-            undoStackItem = {'action':'DEL', 'text':deletedText, 'offset':offset}
             self.undoRedoStack.add_item( undoStackItem )
 
 
+    def sync_document(self, offset, length, text):
+        """Make an edit of the text buffer in the document too, unless it
+        came from the document"""
+
+        if self.documentSync:
+            return
+
+        self.documentSync = True
+        try:
+            self.document.replace_text(offset, length, text)
+        finally:
+            self.documentSync = False
+
+
+    def on_document_changed(self, firstLine, oldLines, newLines):
+        """Lines of the document have been replaced: refile them in the box
+        grid, and make the change in the text buffer if it didn't come from
+        there"""
+
+        self.boxGrid.replace_lines(firstLine, len(oldLines), newLines)
+        self.queue_find_update()
+
+        if self.documentSync:
+            return
+
+        (offset, oldText, newText) = self.document.text_change(firstLine, oldLines, newLines)
+
+        self.documentSync = True
+        try:
+            startIter = self.textBuffer.get_iter_at_offset(offset)
+
+            if oldText:
+                endIter = self.textBuffer.get_iter_at_offset(offset + len(oldText))
+                self.textBuffer.delete(startIter, endIter) # revalidates startIter
+
+            if newText:
+                self.textBuffer.insert(startIter, newText)
+        finally:
+            self.documentSync = False
+
+
     def on_change(self):
         """Process actions on a change.
         Return false if the action should NOT be added to the undo/redo stack
@@ -341,10 +269,14 @@ class MoshPyTT:
         """
 
         self.boxfileChangedSinceSave = True
+        self.pageChanged = True
         self.changeCounter += 1
 
-        if self.changeCounter >= self.autosaveChangeLimit:
-            self.autosave_boxfile()
+        if self.changeCounter >= self.autosaveChangeLimit and not self.autosavePending:
+            # every change is already in the journal, so the snapshot can
+            # wait until the user stops typing
+            self.autosavePending = True
+            gobject.idle_add(self.autosave_boxfile)
             self.changeCounter = 0
 
         if self.blockUndoRedo: #if the action was blocked
@@ -358,6 +290,106 @@ class MoshPyTT:
         self.userScrolled = True # the user overrides the image scrolling
 
 
+    def on_image_button_press(self, drawingArea, event):
+
+        if event.button != 1:
+            return False
+
+        self.dragStart = (int(event.x), int(event.y))
+        self.dragEnd = None
+        self.userScrolled = True # don't move the image out from under the mouse
+
+        return True
+
+
+    def on_image_motion(self, drawingArea, event):
+
+        if not self.dragStart:
+            return False
+
+        # repaint where the rubber band was and where it is now
+        region = self.rubber_band_region()
+        self.dragEnd = (int(event.x), int(event.y))
+        region.union(self.rubber_band_region())
+
+        self.drawingArea.window.invalidate_region(region, False)
+
+        return True
+
+
+    def on_image_button_release(self, drawingArea, event):
+        """Select the box under a click, or all the boxes touching the
+        rectangle dragged out with the mouse"""
+
+        if event.button != 1 or not self.dragStart:
+            return False
+
+        (startX, startY) = self.dragStart
+        (endX, endY) = (int(event.x), int(event.y))
+
+        # clear the rubber band
+        self.drawingArea.window.invalidate_region(self.rubber_band_region(), False)
+        self.dragStart = self.dragEnd = None
+
+        if abs(endX - startX) <= self.clickTolerance and abs(endY - startY) <= self.clickTolerance:
+            lines = self.boxGrid.lines_at(self.to_image(startX), self.to_image(startY))
+        else:
+            lines = self.boxGrid.lines_in_rect(self.to_image(startX), self.to_image(startY),
+                                               self.to_image(endX), self.to_image(endY))
+
+        if lines:
+            self.imageSelection = True
+            self.select_lines(lines[0], lines[-1])
+            self.imageSelection = False
+
+        return True
+
+
+    def on_image_scroll(self, drawingArea, event):
+        """Zoom around the mouse with Ctrl and the scroll wheel"""
+
+        if not event.state & gtk.gdk.CONTROL_MASK:
+            return False
+
+        if event.direction == gtk.gdk.SCROLL_UP:
+            self.set_zoom(self.zoomLevel - 1, event.x, event.y)
+        elif event.direction == gtk.gdk.SCROLL_DOWN:
+            self.set_zoom(self.zoomLevel + 1, event.x, event.y)
+
+        return True
+
+
+    def on_tile_ready(self, level, x, y, width, height):
+        """A tile of the image has been decoded: draw it if it is shown"""
+
+        if level == self.zoomLevel and self.drawingArea.window:
+            self.drawingArea.window.invalidate_rect(gtk.gdk.Rectangle(x, y, width, height), False)
+
+        if not (self.imageFilledIn or self.image.pending):
+            self.imageFilledIn = True
+            timing.milestone('image filled in')
+
+
+    def on_first_expose(self, window, event):
+        """The window has been drawn for the first time"""
+
+        self.window.disconnect(self.firstExposeHandlerID)
+        gobject.idle_add(self.on_started)
+        return False
+
+
+    def on_started(self):
+        """Everything queued at startup has been done, so moshPyTT is
+        waiting for the user"""
+
+        timing.milestone('first interaction')
+
+        if self.DEBUG:
+            print datetime.now(), 'Ready for input.'
+
+        return False
+
+
     def on_checkbutton_toggled(self, widget, attribute):
         """An attribute checkbutton was toggled"""
 
@@ -366,56 +398,51 @@ class MoshPyTT:
 
         value = widget.get_active()
 
-        self.newBoxList = self.boxList #copy the boxlist to prevent a callback messing with it before we use it
-
-        for box in self.newBoxList:
-            if attribute == 'BOLD':
-                box.bold = value
-            elif attribute == 'ITALIC':
-                box.italic = value
-            elif attribute == 'ULINE':
-                box.uline = value
-
-        self.update_boxes()
+        self.edit_boxes(self.document.set_attribute, attribute.lower(), value)
 
 
     def on_find_clicked(self, button, forward=True):
         """One of the find buttons was clicked
 
-        If forward is true, find the next example of the given text, otherwise
-        find the previous one
+        If forward is true, move to the next box matching the search,
+        otherwise the previous one
         """
 
-        searchString = self.findEntry.get_text()
         iterAtCursor = self.textBuffer.get_iter_at_mark(self.textBuffer.get_insert())
+        cursorLine = iterAtCursor.get_line()
 
-        while True:
-            try:
-                if forward:
-                    startIter, endIter = iterAtCursor.forward_search(searchString, gtk.TEXT_SEARCH_TEXT_ONLY)
-                else:
-                    startIter, endIter = iterAtCursor.backward_search(searchString, gtk.TEXT_SEARCH_TEXT_ONLY)
-            except TypeError:
-                break
+        if forward:
+            index = bisect.bisect_right(self.findLines, cursorLine)
+        else:
+            index = bisect.bisect_left(self.findLines, cursorLine) - 1
 
-            if startIter: #if we found anything
+        if 0 <= index < len(self.findLines):
+            self.select_lines(self.findLines[index], self.findLines[index])
 
-                #if the text is previously selected by this function, move to
-                #end of selection and start again
-                if startIter.get_offset() == iterAtCursor.get_offset():
-                    iterAtCursor = endIter
-                    continue
 
-                self.textBuffer.place_cursor(startIter)
-                self.textBuffer.move_mark_by_name('selection_bound', endIter)
+    def on_find_changed(self, entry):
+        """The search has been edited: list the boxes which match it"""
 
-                break
-            else:
-                break
+        self.checkingBoxes = False
+        self.update_find_results()
+
+
+    def on_find_result_selected(self, selection):
+        """Jump to the box picked in the list of search results"""
+
+        (model, treeIter) = selection.get_selected()
+
+        if treeIter:
+            line = model.get_value(treeIter, 0) - 1
+            self.select_lines(line, line)
 
 
     def on_entry_key_press(self, entry, event):
 
+        # let the search widgets have their keys
+        if self.window.get_focus() in (self.findEntry, self.findResults):
+            return False
+
         control = event.state & gtk.gdk.CONTROL_MASK
         shift = event.state & gtk.gdk.SHIFT_MASK
         alt = event.state & gtk.gdk.MOD1_MASK
@@ -505,21 +532,12 @@ class MoshPyTT:
         else:
             step = 1
 
-        for box in self.boxList:
-            box.stretch(direction, step)
-
-        self.newBoxList = self.boxList
-
-        self.update_boxes()
+        self.edit_boxes(self.document.stretch_boxes, direction, step)
 
 
     def move_boxes(self, direction):
         step = 1
-        for box in self.boxList:
-            box.move(direction, step)
-
-        self.newBoxList = self.boxList
-        self.update_boxes()
+        self.edit_boxes(self.document.move_boxes, direction, step)
 
     def change_char_in_boxes(self, keyval):
         """Changes the character in the selected boxes"""
@@ -527,12 +545,9 @@ class MoshPyTT:
 
         if pt != 0: # No suitable unicode found, don't change
             char = unichr(pt)
-            for box in self.boxList:
-                box.set_text(char)
-
-            self.newBoxList = self.boxList
-            self.update_boxes()
+            self.edit_boxes(self.document.set_box_text, char)
 
+    @timed
     def get_current_box(self):
         """If there is a selection, updates the lines which are selected.
         Otherwise, updates the line which contains the cursor"""
@@ -561,28 +576,184 @@ class MoshPyTT:
         self.read_current_box()
 
 
+    @timed
     def read_current_box(self):
         """Reads the currently selected text into memory, ready for display"""
 
-        strings = self.textBuffer.get_text(self.topIter, self.btmIter).split('\n')
-        self.boxList = []
+        topLine = self.topIter.get_line()
+        btmLine = self.btmIter.get_line()
 
-        for i in range(len(strings)):
-            string = strings[i]
+        # btmIter is normally at the start of the line below the selection
+        if btmLine > topLine and self.btmIter.starts_line():
+            btmLine -= 1
 
-            if string == '': #skip blank lines
-                continue
+        self.topLine = topLine
+        self.btmLine = btmLine
 
-            box = TesseractBox(string)
+        # only lines which have changed since they were last read are parsed
+        (boxes, invalidLines) = self.document.get_boxes(topLine, btmLine)
 
-            if box.valid:
-                self.boxList.append(box)
-            else:
-                print 'Invalid line: %s' % string
-                #TODO highlight line
+        for (lineNumber, string) in invalidLines:
+            print 'Invalid line: %s' % string
+            #TODO highlight line
+
+        self.boxList = boxes
+
+        if not self.imageSelection:
+            self.userScrolled = False # regain control of the image scrolling
+
+        if self.boxList:
+            #set checkboxes based on the first box
+            self.set_checkbox_values(self.boxList[0])
+
+            if not self.userScrolled:
+                self.scroll_to_box(self.boxList[0])
+
+        self.invalidate_selection()
+
+
+    def scroll_to_box(self, box):
+        """Centre the image on a box, unless it is nearly there already.
+        Done when the selection moves, rather than when it is drawn, as a
+        box which is off the screen is never drawn."""
+
+        if not self.image:
+            return
+
+        (width, height) = self.image.level_size(self.zoomLevel)
+
+        x = box.left >> self.zoomLevel
+        y = (self.image.height - box.top) >> self.zoomLevel
+
+        for (adj, point, size) in [(self.scrolledWindow.get_hadjustment(), x, width),
+                                   (self.scrolledWindow.get_vadjustment(), y, height)]:
+            value = max(0, min(point - adj.page_size / 2.0, size - adj.page_size))
+
+            #only move the window if it is a "significant" move
+            if abs(adj.value - value) > 100:
+                adj.upper = size # in case the drawing area hasn't been resized yet
+                adj.value = value
+
+
+    def update_find_results(self):
+        """Run the search against the box index and list the matches"""
+
+        self.findUpdatePending = False
+
+        if self.checkingBoxes:
+            return self.update_check_results()
+
+        try:
+            query = BoxQuery(self.findEntry.get_text())
+        except ValueError, e:
+            self.show_find_error(unicode(e))
+            return False
+
+        self.show_find_error(None)
+
+        if query.is_empty():
+            self.findLines = []
+            self.findScroll.hide()
+            return False
+
+        self.findLines = query.find_lines(self.boxGrid)
+
+        # fill the list while it is detached from the view, which is much faster
+        self.findResults.set_model(None)
+        self.findStore.clear()
+
+        for line in self.findLines[:self.findResultLimit]:
+            self.findStore.append((line + 1, self.get_lines(line, line)[0]))
+
+        self.findResults.set_model(self.findStore)
+
+        if len(self.findLines) > self.findResultLimit:
+            self.findBoxColumn.set_title('%d matches, the first %d shown' %
+                                         (len(self.findLines), self.findResultLimit))
+        else:
+            self.findBoxColumn.set_title('%d matches' % len(self.findLines))
+
+        self.findScroll.show()
+
+        return False # when called when idle, don't call again
+
+
+    def show_find_error(self, message):
+        """Show why the search can't be run next to the search entry, or
+        clear it with None"""
+
+        if message is None:
+            self.findErrorLabel.hide()
+            return
+
+        self.findErrorLabel.set_markup('<span foreground="red">%s</span>'
+                                       % gobject.markup_escape_text(message.encode('utf-8')))
+        self.findErrorLabel.set_tooltip_text(message.encode('utf-8'))
+        self.findErrorLabel.show()
+
+
+    @timed
+    def update_check_results(self):
+        """Check the boxes being edited and list the problems, with the
+        lines they are on"""
+
+        lines = self.document.get_lines(0, self.document.line_count() - 1)
+
+        # only the size of the page being shown is known
+        sizes = [None] * self.imageFrameCount
+        if self.image:
+            sizes[min(self.currentPage, self.imageFrameCount - 1)] = (self.image.width, self.image.height)
+
+        findings = lint_lines(lines, sizes)
+
+        self.findLines = sorted(set(line - 1 for (line, check, message) in findings))
+
+        self.findResults.set_model(None)
+        self.findStore.clear()
+
+        for (line, check, message) in findings[:self.findResultLimit]:
+            self.findStore.append((line, '%s: %s' % (check, message)))
+
+        self.findResults.set_model(self.findStore)
+
+        if len(findings) > self.findResultLimit:
+            self.findBoxColumn.set_title('%d problems, the first %d shown' %
+                                         (len(findings), self.findResultLimit))
+        else:
+            self.findBoxColumn.set_title('%d problems' % len(findings))
+
+        return False # when called when idle, don't call again
+
+
+    def queue_find_update(self):
+        """Update the search results, which are shown, once the GUI is idle"""
+
+        if self.findScroll.get_property('visible') and not self.findUpdatePending:
+            self.findUpdatePending = True
+            gobject.idle_add(self.update_find_results)
+
+
+    def select_lines(self, firstLine, lastLine):
+        """Select the whole of the given lines in the text buffer"""
+
+        startIter = self.textBuffer.get_iter_at_line(firstLine)
+
+        if firstLine == lastLine:
+            self.textBuffer.place_cursor(startIter)
+            return
+
+        endIter = self.textBuffer.get_iter_at_line(lastLine)
+        if not endIter.ends_line():
+            endIter.forward_to_line_end()
+
+        self.textBuffer.select_range(startIter, endIter)
+
+
+    def get_lines(self, firstLine, lastLine):
+        """Return the text of the given lines, as a list"""
+
+        return self.document.get_lines(firstLine, lastLine)
 
-        self.userScrolled = False # regain control of the image scrolling
-        self.redraw_drawing_area()
 
     def next_box(self):
         """Moves to the next box in the boxfile (by moving the TextBuffer down one line).
@@ -631,36 +802,200 @@ class MoshPyTT:
         self.userSetAttributes = True
 
 
-    def set_text_attributes(self, box):
+    def set_text_attributes(self, box, attrList):
         """Set the text attributes baed on box"""
 
         if box.italic:
-            self.pangoAttrList.change(pango.AttrStyle(pango.STYLE_ITALIC, 0, -1))
+            attrList.change(pango.AttrStyle(pango.STYLE_ITALIC, 0, -1))
         else:
-            self.pangoAttrList.change(pango.AttrStyle(pango.STYLE_NORMAL, 0, -1))
+            attrList.change(pango.AttrStyle(pango.STYLE_NORMAL, 0, -1))
 
         if box.bold:
-            self.pangoAttrList.change(pango.AttrWeight(pango.WEIGHT_BOLD, 0, -1))
+            attrList.change(pango.AttrWeight(pango.WEIGHT_BOLD, 0, -1))
         else:
-            self.pangoAttrList.change(pango.AttrWeight(pango.WEIGHT_NORMAL, 0, -1))
+            attrList.change(pango.AttrWeight(pango.WEIGHT_NORMAL, 0, -1))
 
         if box.uline:
-            self.pangoAttrList.change(pango.AttrUnderline(pango.UNDERLINE_SINGLE, 0, -1))
+            attrList.change(pango.AttrUnderline(pango.UNDERLINE_SINGLE, 0, -1))
         else:
-            self.pangoAttrList.change(pango.AttrUnderline(pango.UNDERLINE_NONE, 0, -1))
+            attrList.change(pango.AttrUnderline(pango.UNDERLINE_NONE, 0, -1))
+
+
+    def get_label(self, box):
+        """Return (layout, width, extents) for the label of a box, where
+        extents is the (x, y, width, height) of the ink and logical
+        rectangles of the layout together. Layouts are cached by text and
+        attributes."""
+
+        key = (box.text, box.bold, box.italic, box.uline)
+
+        label = self.labelCache.get(key)
+        if label is None:
+
+            if len(self.labelCache) >= self.labelCacheSize:
+                self.labelCache.clear()
+
+            layout = pango.Layout(self.pangoContext)
+            layout.set_font_description(self.boxLabelFontDesc)
+
+            attrList = pango.AttrList()
+            self.set_text_attributes(box, attrList)
+            layout.set_attributes(attrList)
+
+            layout.set_text(box.text)
+
+            (ink, logical) = layout.get_pixel_extents()
+            left = min(ink[0], logical[0])
+            top = min(ink[1], logical[1])
+            right = max(ink[0] + ink[2], logical[0] + logical[2])
+            bottom = max(ink[1] + ink[3], logical[1] + logical[3])
+
+            label = (layout, logical[2], (left, top, right - left, bottom - top))
+            self.labelCache[key] = label
+
+        return label
+
+
+    def to_image(self, value):
+        """Convert a drawing area coordinate to the image coordinate at the
+        middle of the pixel it shows"""
+
+        return (value << self.zoomLevel) + ((1 << self.zoomLevel) >> 1)
+
+
+    def box_areas(self, box):
+        """Return the outline of a box, the position of its label and the
+        areas they cover in the drawing area, as (x, y, width, height), at
+        the current zoom. Labels stay the same size."""
+
+        imageHeight = self.image.height
+        zoom = self.zoomLevel
+
+        left = box.left >> zoom
+        right = box.right >> zoom
+        top = (imageHeight - box.top) >> zoom
+        bottom = (imageHeight - box.bottom) >> zoom
+
+        outline = [(left, top), (right, top), (right, bottom), (left, bottom), (left, top)]
+
+        (layout, width, extents) = self.get_label(box)
+        textPosX = int((left + right - width) /2.0)
+        textPosY = int(bottom + self.boxLabelOffset)
+
+        # one extra pixel for the width of the lines
+        outlineArea = (min(left, right), min(top, bottom),
+                       abs(right - left) + 1, abs(bottom - top) + 1)
+        labelArea = (textPosX + extents[0], textPosY + extents[1], extents[2], extents[3])
+
+        return (outline, layout, textPosX, textPosY, outlineArea, labelArea)
+
+
+    def invalidate_selection(self):
+        """Queue a repaint of the parts of the image covered by the boxes
+        that were selected and the boxes that are selected now"""
+
+        if not (self.image and self.drawingArea.window):
+            return
+
+        region = gtk.gdk.Region()
+        for area in self.selectionAreas:
+            region.union_with_rect(gtk.gdk.Rectangle(*area))
+
+        self.selectionAreas = []
+        for box in self.boxList:
+            (outline, layout, textPosX, textPosY, outlineArea, labelArea) = self.box_areas(box)
+            self.selectionAreas.append(outlineArea)
+            self.selectionAreas.append(labelArea)
+            region.union_with_rect(gtk.gdk.Rectangle(*outlineArea))
+            region.union_with_rect(gtk.gdk.Rectangle(*labelArea))
+
+        self.drawingArea.window.invalidate_region(region, False)
 
 
     def set_pen_colour(self, colour):
         """Set the drawing area pen colour"""
 
+        if colour == self.penColour:
+            return
+
         parsedColour = gtk.gdk.color_parse(colour)
         self.drawingGC.set_rgb_fg_color(parsedColour)  # color of rectangle
+        self.penColour = colour
+
+
+    def rubber_band_region(self):
+        """The region covered by the edges of the rubber band"""
+
+        region = gtk.gdk.Region()
+
+        if self.dragStart and self.dragEnd:
+            x = min(self.dragStart[0], self.dragEnd[0])
+            y = min(self.dragStart[1], self.dragEnd[1])
+            width = abs(self.dragEnd[0] - self.dragStart[0]) + 1
+            height = abs(self.dragEnd[1] - self.dragStart[1]) + 1
+
+            for edge in [(x, y, width, 1), (x, y + height - 1, width, 1),
+                         (x, y, 1, height), (x + width - 1, y, 1, height)]:
+                region.union_with_rect(gtk.gdk.Rectangle(*edge))
+
+        return region
 
 
-    def redraw_drawing_area(self):
-        '''redraw area of selected symbol + add rectangle'''
+    def draw_rubber_band(self, start, end):
+        """Draw the outline of a mouse selection rectangle"""
 
-        if self.pixbuf and self.drawingArea.window:
+        self.set_pen_colour(self.rubberBandColour)
+
+        self.drawingArea.window.draw_rectangle(self.drawingGC, False,
+                        min(start[0], end[0]), min(start[1], end[1]),
+                        abs(end[0] - start[0]), abs(end[1] - start[1]))
+
+
+    @timed
+    def set_zoom(self, level, x=None, y=None):
+        """Show the image at 1/2**level of its size, keeping the point x, y
+        of the drawing area (by default the middle of the view) where it is
+        on the screen"""
+
+        if not self.image:
+            return
+
+        level = max(0, min(level, self.image.levelCount - 1))
+        if level == self.zoomLevel:
+            return
+
+        hAdj = self.scrolledWindow.get_hadjustment()
+        vAdj = self.scrolledWindow.get_vadjustment()
+
+        if x is None:
+            x = hAdj.value + hAdj.page_size / 2.0
+            y = vAdj.value + vAdj.page_size / 2.0
+
+        scale = 2.0 ** (self.zoomLevel - level)
+
+        self.zoomLevel = level
+        self.dragStart = self.dragEnd = None
+        self.userScrolled = True # stay where the user zoomed
+
+        (width, height) = self.image.level_size(level)
+        self.drawingArea.set_size_request(width, height)
+
+        for (adj, point, size) in [(hAdj, x, width), (vAdj, y, height)]:
+            # the drawing area is resized later, so set the scroll range now
+            adj.upper = size
+            value = point * scale - (point - adj.value)
+            adj.value = max(0, min(value, size - adj.page_size))
+
+        self.invalidate_selection() # the selection is now drawn somewhere else
+        self.drawingArea.queue_draw()
+
+
+    @timed
+    def redraw_drawing_area(self, area=None):
+        '''redraw the given area (by default everything visible) of the image,
+        with the outlines and labels of the selected boxes in it'''
+
+        if self.image and self.drawingArea.window:
 
             vertOffset = int( self.scrolledWindow.get_vadjustment().value )
             visibleHeight = int( self.scrolledWindow.get_vadjustment().page_size )
@@ -668,37 +1003,23 @@ class MoshPyTT:
             horzOffset = int( self.scrolledWindow.get_hadjustment().value )
             visibleWidth = int( self.scrolledWindow.get_hadjustment().page_size )
 
-            self.drawingArea.window.draw_pixbuf(self.drawingGC, self.pixbuf,
-                            horzOffset, vertOffset,
-                            horzOffset, vertOffset,
-                            width=int(visibleWidth), height=int(visibleHeight))
+            if area is None:
+                area = gtk.gdk.Rectangle(horzOffset, vertOffset, visibleWidth, visibleHeight)
 
-            if self.boxList:
+            with timing.span('draw image', width=area.width, height=area.height, level=self.zoomLevel):
+                self.image.draw(self.drawingArea.window, self.drawingGC,
+                                area.x, area.y, area.width, area.height, self.zoomLevel)
 
-                if not self.userScrolled:
-                    #centre on the first box
-                    hAdj = self.scrolledWindow.get_hadjustment()
-                    newHAdjValue = self.boxList[0].left - visibleWidth/2.0
-                    newHAdjValue = max(0, newHAdjValue)
-                    newHAdjValue = min(hAdj.upper - visibleWidth, newHAdjValue)
-
-                    #only move the window if it is a "significant" move
-                    if abs(hAdj.value - newHAdjValue) > 100:
-                        hAdj.value = newHAdjValue
-
-                    vAdj = self.scrolledWindow.get_vadjustment()
-                    newVAdjValue = self.pixbuf.get_height() - self.boxList[0].top - visibleWidth/2.0
-                    newVAdjValue = max(0, newVAdjValue)
-                    newVAdjValue = min(vAdj.upper - visibleHeight, newVAdjValue)
+            if self.boxList:
 
-                    if abs(vAdj.value - newVAdjValue) > 100:
-                        vAdj.value = newVAdjValue
+                # draw the selected boxes which are in the area
+                for box in self.boxList:
 
-                #set checkboxes based on the first box
-                self.set_checkbox_values(self.boxList[0])
+                    (outline, layout, textPosX, textPosY, outlineArea, labelArea) = self.box_areas(box)
 
-                # draw all selected boxes
-                for box in self.boxList:
+                    if not (area.intersect(gtk.gdk.Rectangle(*outlineArea)).width
+                            or area.intersect(gtk.gdk.Rectangle(*labelArea)).width):
+                        continue
 
                     if box.text.isupper():
                         self.set_pen_colour(self.uppercaseColour)
@@ -706,27 +1027,13 @@ class MoshPyTT:
                         self.set_pen_colour(self.lowercaseColour)
 
                     # draw the rectange described by self.box
-                    segments = [(box.left, self.pixbuf.get_height() - box.top),
-                                (box.right, self.pixbuf.get_height() - box.top),
-                                (box.right, self.pixbuf.get_height() - box.bottom),
-                                (box.left, self.pixbuf.get_height() - box.bottom),
-                                (box.left, self.pixbuf.get_height() - box.top)]
-
-                    self.drawingArea.window.draw_lines(self.drawingGC, segments)
-
-
-                    #set the text attributes
-                    self.set_text_attributes(box)
-
-                    #set the text
-                    self.pangoLayout.set_text(box.text)
-                    (width, height) = self.pangoLayout.get_pixel_size()
-
-                    textPosX = (box.left + box.right - width) /2.0
-                    textPosY = self.pixbuf.get_height() - box.bottom + self.boxLabelOffset
+                    self.drawingArea.window.draw_lines(self.drawingGC, outline)
 
                     #draw the text
-                    self.drawingArea.window.draw_layout(self.drawingGC, int(textPosX), int(textPosY), self.pangoLayout)
+                    self.drawingArea.window.draw_layout(self.drawingGC, textPosX, textPosY, layout)
+
+            if self.dragStart and self.dragEnd:
+                self.draw_rubber_band(self.dragStart, self.dragEnd)
 
 
     def check_files(self):
@@ -832,48 +1139,78 @@ class MoshPyTT:
             self.update_filename()
         chooser.destroy()
 
+    @timed
     def autosave_boxfile(self):
-        """Save an autosave file"""
+        """Hand a snapshot of the boxfile to the journal, which writes it to
+        the autosave file in the background. Called when the GUI is idle."""
+
+        self.autosavePending = False
+
+        text = self.get_all_text()
+
+        if self.journal:
+            self.journal.snapshot(text)
 
-        string = self.get_all_text()
+        # lets long undos start from here rather than replay every change
+        self.undoRedoStack.add_checkpoint(text)
+
+        return False # don't call again
 
-        saveFile = open(self.loadedBoxFilename+'.autosave', 'w')
-        saveFile.write(string)
-        saveFile.close()
 
     def remove_autosave_file(self, filename=None):
-        """Remove the autosave file, if it exists"""
+        """Remove the autosave and journal files of filename (by default
+        the loaded boxfile), if they exist, for the page being shown and
+        any others changed since the last save"""
 
-        if filename:
-            autosaveFilename = filename
-        else:
-            autosaveFilename = self.loadedBoxFilename
+        filename = filename or self.loadedBoxFilename
 
-        autosaveFilename += '.autosave'
+        if self.DEBUG:
+            print 'Removing autosave files of: %s' % filename
 
-        if os.path.exists(autosaveFilename):
-            if self.DEBUG:
-                print 'Removing autosave file: %s' % autosaveFilename
-            os.remove(autosaveFilename)
+        if self.journal:
+            for page in set(self.pageTexts) | set([self.journal_page()]):
+                self.journal.discard(filename, page)
 
+    @timed
     def save_boxfile(self, oldFilename=None):
         """Saves the current boxfile to the current filename
         The autosave file corresponding to oldfilename, if it exists,
         otherwise self.loadedBoxFilename, will be removed
         """
 
-        string = self.get_all_text()
+        page = self.journal_page()
 
-        saveFile = open(self.loadedBoxFilename, 'w')
-        saveFile.write(string)
-        saveFile.close()
+        if page is None:
+            saveFile = open(self.loadedBoxFilename, 'w')
+            saveFile.write(self.get_all_text())
+            saveFile.close()
+        else:
+            # put the changed pages together with the rest of the old file
+            if self.pageChanged:
+                self.pageTexts[page] = self.get_all_text()
+
+            boxFile = open(oldFilename or self.loadedBoxFilename, 'rb')
+            saveFile = open(self.loadedBoxFilename + '.tmp', 'wb')
+            newIndex = self.pageIndex.write(boxFile, saveFile, self.pageTexts)
+            saveFile.close()
+            boxFile.close()
+
+            os.rename(self.loadedBoxFilename + '.tmp', self.loadedBoxFilename)
 
         if self.DEBUG:
             print 'Saved file: %s' % self.loadedBoxFilename
 
         self.remove_autosave_file(oldFilename)
 
+        if page is not None:
+            self.pageIndex = newIndex
+            self.pageTexts = {}
+
+        if self.journal:
+            self.journal.set_filename(self.loadedBoxFilename, page)
+
         self.boxfileChangedSinceSave = False
+        self.pageChanged = False
 
 
     def do_undo(self, action):
@@ -883,6 +1220,22 @@ class MoshPyTT:
     def do_redo(self, action):
         self.redo_change()
 
+
+    def do_previous_page(self, action):
+        self.step_page(-1)
+
+
+    def do_next_page(self, action):
+        self.step_page(1)
+
+
+    def do_undo_many(self, action):
+        self.undo_change(self.undoJumpSize)
+
+
+    def do_redo_many(self, action):
+        self.redo_change(self.undoJumpSize)
+
     # HELP ACTIONS ###########
     def do_help_about(self, action):
         """Show the About dialog"""
@@ -930,6 +1283,26 @@ Ctrl-2: Split selected boxes
 
 Ctrl-Z: Undo change
 Ctrl-Y: Redo change
+Ctrl-Shift-Z: Undo many changes
+Ctrl-Shift-Y: Redo many changes
+
+Ctrl-Page Up/Down: Previous/next page of a multi-page image and boxfile
+
+Ctrl-plus/minus: Zoom in/out, halving or doubling the size of the image
+Ctrl-=: Show the image at its actual size
+Ctrl-scroll wheel: Zoom in or out around the mouse
+
+Click a box in the image to select it, or drag a rectangle to select
+all the boxes it touches.
+
+Find lists every box matching all the words typed: a glyph, a
+/regular expression/, bold, italic or uline (!bold for not bold), or a
+comparison of width, height, left, right, top, bottom or page with a
+number, such as width>30. Next and Previous step through the matches.
+
+Ctrl-L (Edit > Check Boxes) lists the problems with the boxes on the
+page instead, such as duplicates or boxes with no area, and keeps the
+list up to date as they are fixed (see lintboxes.py).
 
 ''')
         label.set_line_wrap(True)
@@ -951,6 +1324,25 @@ Ctrl-Y: Redo change
         self.split_boxes()
 
 
+    def do_zoom_in(self, action):
+        self.set_zoom(self.zoomLevel - 1)
+
+
+    def do_zoom_out(self, action):
+        self.set_zoom(self.zoomLevel + 1)
+
+
+    def do_zoom_normal(self, action):
+        self.set_zoom(0)
+
+
+    def do_check_boxes(self, action):
+        self.checkingBoxes = True
+        self.show_find_error(None)
+        self.findScroll.show()
+        self.update_find_results()
+
+
     def do_quit(self, mi=None, action=None):
 
         if not self.confirm_close():
@@ -960,160 +1352,94 @@ Ctrl-Y: Redo change
 
 
     def get_all_text(self):
-        bounds = self.textBuffer.get_bounds()
-        return self.textBuffer.get_text(bounds[0], bounds[1])
+        return self.document.get_text().encode('utf-8') # as the text buffer gives it
 
 
     ### UNDO/REDO HANDLING ###
 
-    def apply_change(self, change):
+    def apply_changes(self, move):
+        """Apply the (text, changes) given by the undo/redo stack"""
 
-        if not change:
+        if not move:
             return
 
-        # invert the action
-        if change['action'] == 'INS':
-            change['action'] = 'DEL'
-        elif change['action'] == 'DEL':
-            change['action'] = 'INS'
-
-        if change['action'] == 'DEL':
-            self.blockUndoRedo = True
-
-            offset = change['offset']
-            startIter = self.textBuffer.get_iter_at_offset(offset)
-            endIter = self.textBuffer.get_iter_at_offset(offset + len(change['text']) )
-            self.textBuffer.delete(startIter, endIter)
-        elif change['action'] == 'INS':
-            self.blockUndoRedo = True
+        (text, changes) = move
 
-            startIter = self.textBuffer.get_iter_at_offset(change['offset'])
-            self.textBuffer.insert(startIter, change['text'])
+        self.blockUpdates = True # read the selection once, at the end
 
+        if text is not None: # start from a checkpoint
+            (startIter, endIter) = self.textBuffer.get_bounds()
+            if not startIter.equal(endIter):
+                self.blockUndoRedo = True
+                self.textBuffer.delete(startIter, endIter)
 
-    def undo_change(self):
-        change = self.undoRedoStack.undo()
-        self.apply_change(change)
+            if text:
+                self.blockUndoRedo = True
+                self.textBuffer.insert(self.textBuffer.get_start_iter(), text)
 
+        for (action, offset, string) in changes:
 
-    def redo_change(self):
-        change = self.undoRedoStack.redo()
-        self.apply_change(change)
+            self.blockUndoRedo = True
 
+            startIter = self.textBuffer.get_iter_at_offset(offset)
 
-    ### BOX ACTIONS ###
-    def delete_boxes(self):
-        self.deleteBoxes = True
-        self.update_boxes()
+            if action == 'DEL':
+                endIter = self.textBuffer.get_iter_at_offset(offset + char_length(string))
+                self.textBuffer.delete(startIter, endIter)
+            else:
+                self.textBuffer.insert(startIter, string)
 
+        self.blockUpdates = False
 
-    def split_boxes(self):
+        self.get_current_box()
 
-        self.newBoxList = []
 
-        for box in self.boxList:
+    def undo_change(self, count=1):
+        self.apply_changes(self.undoRedoStack.undo(count))
 
-            leftBox = box
-            rightBox = copy.deepcopy(box)
 
-            center = int((box.right + box.left) / 2)
+    def redo_change(self, count=1):
+        self.apply_changes(self.undoRedoStack.redo(count))
 
-            print center
 
-            leftBox.right = center
-            rightBox.left = center
+    ### BOX ACTIONS ###
+    def delete_boxes(self):
+        self.edit_boxes(self.document.delete_boxes)
 
-            self.newBoxList.append(leftBox)
-            self.newBoxList.append(rightBox)
 
-        self.update_boxes()
+    def split_boxes(self):
+        # cut at the gaps between the glyphs in the image
+        self.edit_boxes(self.document.split_boxes, 2, self.image)
 
 
     def merge_boxes(self):
         """Merge two or more boxes into a larger box. The resultant box will be
         the minimum box enclosing all selected boxes."""
 
-        newBox = TesseractBox()
-
-        newBox.page = self.boxList[0].page
+        self.edit_boxes(self.document.merge_boxes)
 
-        for box in self.boxList:
 
-            if newBox.left != None:
-                newBox.left = min (newBox.left, box.left)
-            else:
-                newBox.left = box.left
-
-            if newBox.right != None:
-                newBox.right = max (newBox.right, box.right)
-            else:
-                newBox.right = box.right
-
-            if newBox.top != None:
-                newBox.top = max (newBox.top, box.top)
-            else:
-                newBox.top = box.top
-
-            if newBox.bottom != None:
-                newBox.bottom = min (newBox.bottom, box.bottom)
-            else:
-                newBox.bottom = box.bottom
-
-            if newBox.page != None:
-                newBox.page = min (newBox.page, box.page)
-            else:
-                newBox.page = box.page
-
-            newBox.text = newBox.text + box.text #concentenate the strings into the new box
-
-            newBox.check_numbers() #check for flipped l/r, t/b
-
-        self.newBoxList = [ newBox ] #replace the boxlist
-        self.update_boxes()
-
-
-    def update_boxes(self):
-        """Updates the text buffer with the boxes in newBoxList, done after
-        operations like merging, deleting and splitting."""
+    @timed
+    def edit_boxes(self, operation, *args):
+        """Run one of the box operations of the document, like merging,
+        deleting and splitting, on the selected lines, and select the boxes
+        it leaves"""
 
         self.blockUpdates = True
 
-        self.textBuffer.delete(self.topIter, self.btmIter)
-
-        topLine = self.topIter.get_line()
-
-        if not self.deleteBoxes: # we want to insert new ones after deleting old ones
-
-            if self.newBoxList:
-                self.boxList = self.newBoxList
-
-            boxString = ''
-            for box in self.boxList:
-                boxString += box.make_string()+'\n'
-
-            self.textBuffer.insert(self.topIter, boxString)
-
-            self.newBoxList = None #clear this variable
-
-        if self.deleteBoxes: #reset this flag
-            self.deleteBoxes = False
-        else:#place cursor on the top line
-
-            self.topIter = self.textBuffer.get_iter_at_line(topLine)
+        # undo the whole operation in one go
+        self.undoRedoStack.begin_group()
 
-            self.btmIter = self.textBuffer.get_iter_at_line(topLine+len(self.boxList))
-            self.btmIter.backward_char()
-
-            if len(self.boxList) < 2:
-                self.textBuffer.place_cursor(self.topIter)
-            else:
+        try:
+            lines = operation(self.topLine, self.btmLine, *args)
+        finally:
+            self.undoRedoStack.end_group()
+            self.blockUpdates = False
 
-                self.textBuffer.select_range(self.topIter, self.btmIter)
-
-        self.blockUpdates = False
+        if lines:
+            self.select_lines(*lines)
 
         self.get_current_box()
-        self.redraw_drawing_area()
 
 
     def confirm_close(self):
@@ -1166,9 +1492,19 @@ Ctrl-Y: Redo change
              ('Edit', None, '_Edit'),
              ('Undo', gtk.STOCK_UNDO, '_Undo', '<Control>Z', None, self.do_undo),
              ('Redo', gtk.STOCK_REDO, '_Redo', '<Control>Y', None, self.do_redo),
+             ('UndoMany', None, 'Undo _Many Changes', '<Shift><Control>Z', None, self.do_undo_many),
+             ('RedoMany', None, 'Redo M_any Changes', '<Shift><Control>Y', None, self.do_redo_many),
              ('MergeBoxes', None, '_Merge Selected Boxes', '<Control>1', None, self.do_merge_boxes),
              ('SplitBoxes', None, '_Split Selected Boxes', '<Control>3', None, self.do_split_boxes),
              ('DeleteBoxes', gtk.STOCK_DELETE, '_Delete Selected Boxes', '<Control>0', None, self.do_delete_boxes),
+             ('CheckBoxes', None, '_Check Boxes', '<Control>L', None, self.do_check_boxes),
+             ('View', None, '_View'),
+             ('ZoomIn', gtk.STOCK_ZOOM_IN, 'Zoom _In', '<Control>plus', None, self.do_zoom_in),
+             ('ZoomOut', gtk.STOCK_ZOOM_OUT, 'Zoom _Out', '<Control>minus', None, self.do_zoom_out),
+             ('ZoomNormal', gtk.STOCK_ZOOM_100, '_Normal Size', '<Control>equal', None, self.do_zoom_normal),
+             ('Page', None, '_Page'),
+             ('PreviousPage', gtk.STOCK_GO_BACK, '_Previous Page', '<Control>Page_Up', None, self.do_previous_page),
+             ('NextPage', gtk.STOCK_GO_FORWARD, '_Next Page', '<Control>Page_Down', None, self.do_next_page),
              ('Help', None, '_Help'),
              ('About', gtk.STOCK_ABOUT, '_About', None, None, self.do_help_about),
              ('Shortcuts', None, '_Keyboard Shortcuts', None, None,
@@ -1181,25 +1517,45 @@ Ctrl-Y: Redo change
 
     def update_filename(self):
 
-        self.window.set_title('%s - v%s: %s' % \
-                (NAME, VERSION, self.loadedBoxFilename))
+        pages = self.page_list()
+
+        if len(pages) > 1:
+            self.window.set_title('%s - v%s: %s (page %d of %d)' % \
+                    (NAME, VERSION, self.loadedBoxFilename,
+                     pages.index(self.currentPage) + 1, len(pages)))
+        else:
+            self.window.set_title('%s - v%s: %s' % \
+                    (NAME, VERSION, self.loadedBoxFilename))
 
         self.currentPath = os.path.dirname(self.loadedBoxFilename)
 
 
+    @timed
     def load_image(self):
 
-        self.pixbuf = gtk.gdk.pixbuf_new_from_file(self.loadedImageFilename)
+        # only the frame of the current page is decoded
+        frame = min(self.currentPage, self.imageFrameCount - 1)
+
+        if self.image:
+            self.image.close() # stop decoding the last page
+
+        # only the size is read here: the tiles are decoded in the background
+        self.image = TiledImage(self.loadedImageFilename, self.tileSize,
+                                self.tileCacheSize, frame, self.savePyramid,
+                                self.on_tile_ready)
 
         if self.DEBUG:
             print datetime.now(), 'File %s is opened.' % self.loadedImageFilename
 
-        if self.DEBUG:
-            print datetime.now(), 'Displaying image...'
-        self.drawingArea.set_size_request(self.pixbuf.get_width(),
-                self.pixbuf.get_height())
+        # a smaller image may not shrink as far
+        self.zoomLevel = min(self.zoomLevel, self.image.levelCount - 1)
+
+        self.drawingArea.set_size_request(*self.image.level_size(self.zoomLevel))
 
+        self.boxGrid.imageHeight = self.image.height
 
+
+    @timed
     def load_image_and_boxes(self):
 
         (name, extension) = self.loadedImageFilename.rsplit('.', 1)
@@ -1209,31 +1565,169 @@ Ctrl-Y: Redo change
         if not filesOK:
             return False
 
+        self.currentPage = 0
+        self.imageFrameCount = count_frames(self.loadedImageFilename)
+
         self.load_image()
         self.load_boxfile()
         self.update_filename()
 
-        if self.DEBUG:
-            print datetime.now(), \
-                'Function load_image_and_boxes is finished.'
-
         return True
 
 
+    @timed
     def load_boxfile(self):
 
-        boxFile = codecs.open(self.loadedBoxFilename, 'r', 'utf-8')
-
         if self.DEBUG:
             print datetime.now(), 'Boxfile %s is opened.' % self.loadedBoxFilename
 
-        self.blockUndoRedo = True #we don't want to allow the user to undo the boxfile load
+        if self.journal: # finish with the previous boxfile
+            self.journal.close()
+            self.journal = None
+
+        # one pass to find the pages, so that only one needs to be read
+        self.pageIndex = PageIndex.from_file(self.loadedBoxFilename)
+        self.pageTexts = {}
+        self.pageUndoStacks = {}
+
+        self.journal = EditJournal(self.loadedBoxFilename, self.journal_page())
+
+        self.load_page_text()
+
+
+    def page_list(self):
+        """The pages of the boxfile and image, in order"""
+
+        return sorted(set(self.pageIndex.pages) | set(range(self.imageFrameCount)))
+
+
+    def journal_page(self):
+        """The page being edited, or None if the boxfile only has one page
+        and is edited whole"""
+
+        if len(self.page_list()) > 1:
+            return self.currentPage
+        return None
+
+
+    def load_page_text(self):
+        """Put the text of the current page in the buffer, or of the whole
+        boxfile if it only has one page"""
+
+        page = self.journal_page()
+
+        recovered = False
+
+        if page in self.pageTexts: # edited before, and not saved yet
+            text = self.pageTexts.pop(page)
+            changed = True
+
+        else:
+            boxFile = open(self.loadedBoxFilename, 'rb')
+            if page is None:
+                text = boxFile.read().decode('utf-8')
+            else:
+                text = self.pageIndex.read_page(boxFile, page)
+            boxFile.close()
+
+            recoveredText = recover_text(self.loadedBoxFilename, page, text)
+            recovered = recoveredText not in (None, text) and self.confirm_recover()
 
+            if recovered:
+                text = recoveredText
+
+            changed = recovered
+
+        # loading isn't an edit: don't journal it or let it be undone
+        journal = self.journal
+        self.journal = None
+
+        (startIter, endIter) = self.textBuffer.get_bounds()
+        if not startIter.equal(endIter):
+            self.blockUndoRedo = True
+            self.textBuffer.delete(startIter, endIter)
+
+        if text: #read in the file
+            self.blockUndoRedo = True
+            self.textBuffer.insert(self.textBuffer.get_start_iter(), text)
+
+        self.journal = journal
+
+        # each page has its own history
+        if page in self.pageUndoStacks:
+            self.undoRedoStack = self.pageUndoStacks.pop(page)
+        elif self.undoRedoStack in self.pageUndoStacks.values(): # kept for the page left
+            self.undoRedoStack = UndoRedoStack(self.undoMemoryLimit)
+        else:
+            self.undoRedoStack.clear()
 
-        self.textBuffer.set_text(boxFile.read()) #read in the file
         self.textBuffer.place_cursor(self.textBuffer.get_iter_at_offset(0)) #place cursor at the start
 
-        self.boxfileChangedSinceSave = False # nothing has been changed yet
+        if recovered:
+            self.journal.snapshot(text) #start the journal again from the recovered text
+        elif not changed:
+            self.journal.discard() #nothing to recover, or the user didn't want it
+
+        self.pageChanged = changed
+
+        if changed:
+            self.boxfileChangedSinceSave = True
+        elif not self.pageTexts:
+            self.boxfileChangedSinceSave = False # nothing has been changed yet
+
+
+    @timed
+    def go_to_page(self, page):
+        """Show another page of the image and its boxes. Only that page is
+        decoded and read: the others are left alone."""
+
+        if page == self.currentPage or page not in self.page_list():
+            return
+
+        # keep the changes to this page until the boxfile is saved
+        if self.pageChanged:
+            self.pageTexts[self.currentPage] = self.get_all_text()
+
+        self.pageUndoStacks[self.currentPage] = self.undoRedoStack
+
+        self.currentPage = page
+
+        self.load_image()
+
+        self.journal.set_filename(self.loadedBoxFilename, self.journal_page())
+        self.load_page_text()
+
+        self.update_filename()
+
+
+    def step_page(self, step):
+        """Move step pages forwards or backwards"""
+
+        pages = self.page_list()
+        index = pages.index(self.currentPage) + step
+
+        if 0 <= index < len(pages):
+            self.go_to_page(pages[index])
+
+
+    def confirm_recover(self):
+        """Ask whether to recover unsaved changes from a previous session"""
+
+        dir, filename = os.path.split(self.loadedBoxFilename)
+
+        dialog = gtk.MessageDialog(self.window, gtk.DIALOG_DESTROY_WITH_PARENT,
+                                type=gtk.MESSAGE_QUESTION,
+                                buttons=gtk.BUTTONS_YES_NO,
+                                message_format="The file %s has unsaved changes from a previous session."%filename)
+
+        dialog.format_secondary_text("Do you want to recover them?")
+
+        dialog.set_default_response(gtk.RESPONSE_YES)
+
+        response = dialog.run()
+        dialog.destroy()
+
+        return response == gtk.RESPONSE_YES
 
 
     def setup_icons(self):
@@ -1298,17 +1792,24 @@ Ctrl-Y: Redo change
 
         #set the pango context for the box labels
 
-        pangoContext = self.drawingArea.create_pango_context()
-        self.pangoLayout = pango.Layout(pangoContext)
+        self.pangoContext = self.drawingArea.create_pango_context()
 
-        self.pangoAttrList = pango.AttrList()
-        self.pangoLayout.set_attributes(self.pangoAttrList)
+        self.boxLabelFontDesc = pango.FontDescription("monospace")
+        self.boxLabelFontDesc.set_size(pango.SCALE * self.boxLabelFontSize)
 
-        boxLabelFontDesc = pango.FontDescription("monospace")
-        boxLabelFontDesc.set_size(pango.SCALE * self.boxLabelFontSize)
-        self.pangoLayout.set_font_description(boxLabelFontDesc)
+        self.labelCache = {} # (text, bold, italic, uline) -> prepared label, see get_label
 
         self.redrawHandlerID = self.drawingArea.connect('expose-event', self.on_redraw)
+
+        #clicking or dragging in the image selects boxes
+        self.drawingArea.add_events(gtk.gdk.BUTTON_PRESS_MASK
+                                    | gtk.gdk.BUTTON_RELEASE_MASK
+                                    | gtk.gdk.BUTTON1_MOTION_MASK
+                                    | gtk.gdk.SCROLL_MASK)
+        self.drawingArea.connect('button-press-event', self.on_image_button_press)
+        self.drawingArea.connect('motion-notify-event', self.on_image_motion)
+        self.drawingArea.connect('button-release-event', self.on_image_button_release)
+        self.drawingArea.connect('scroll-event', self.on_image_scroll)
         self.scrolledWindow.add_with_viewport(self.drawingArea)
 
         #connect the scrollbar widgets
@@ -1334,9 +1835,29 @@ Ctrl-Y: Redo change
         self.textScroll.add_with_viewport(self.textBox)
         self.textScroll.set_policy(gtk.POLICY_AUTOMATIC,
                                    gtk.POLICY_AUTOMATIC)
-        hpaned.pack2(self.textScroll, False, True)
+        # the text shares the right pane with the search results
+        rightPane = gtk.VPaned()
+        hpaned.pack2(rightPane, False, True)
+        rightPane.show()
+
+        rightPane.pack1(self.textScroll, True, True)
         self.textScroll.show()
 
+        self.findStore = gtk.ListStore(int, str) # line number, box
+        self.findResults = gtk.TreeView(self.findStore)
+
+        self.findResults.append_column(gtk.TreeViewColumn('Line', gtk.CellRendererText(), text=0))
+        self.findBoxColumn = gtk.TreeViewColumn('Box', gtk.CellRendererText(), text=1)
+        self.findResults.append_column(self.findBoxColumn)
+
+        self.findResults.get_selection().connect('changed', self.on_find_result_selected)
+        self.findResults.show()
+
+        self.findScroll = gtk.ScrolledWindow()
+        self.findScroll.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        self.findScroll.add(self.findResults)
+        rightPane.pack2(self.findScroll, False, True) # shown when there is a search
+
         self.textBox.show()
 
         #connect the text signals
@@ -1385,8 +1906,18 @@ Ctrl-Y: Redo change
         self.findNextButton.connect('clicked', self.on_find_clicked, True)
         self.findNextButton.show()
 
+        # why the search is invalid, shown only when it is
+        self.findErrorLabel = gtk.Label()
+        self.findErrorLabel.set_ellipsize(pango.ELLIPSIZE_END)
+        self.findErrorLabel.set_width_chars(30)
+        self.buttonBox.pack_end(self.findErrorLabel, False, False, 5)
+
         self.findEntry = gtk.Entry()
-        self.findEntry.set_width_chars(8)
+        self.findEntry.set_width_chars(16)
+        self.findEntry.set_tooltip_text('A glyph, /regular expression/, bold, italic, uline, '
+                                        '!bold... or a comparison like width>30 or height<5')
+        self.findEntry.connect('changed', self.on_find_changed)
+        self.findEntry.connect('activate', self.on_find_clicked, True)
         self.buttonBox.pack_end(self.findEntry, False, False)
         self.findEntry.show()
 
@@ -1403,7 +1934,9 @@ Ctrl-Y: Redo change
     def set_options(self):
         """Set display parameters"""
 
-        self.autosaveChangeLimit = 10 #number of changes to autosave after
+        self.autosaveChangeLimit = 200 #number of journalled changes between autosave snapshots
+        self.undoMemoryLimit = 16 << 20 #bytes of undo history to keep
+        self.undoJumpSize = 100 #number of changes undone or redone by Ctrl-Shift-Z/Y
         self.panePosition = 650 #position of divider between image and text
         self.boxLabelOffset = 2 # gap between the box and the label
         self.boxLabelFontSize = 20
@@ -1411,6 +1944,12 @@ Ctrl-Y: Redo change
         self.textBufferMargin = 20
         self.lowercaseColour = 'red'
         self.uppercaseColour = 'blue'
+        self.rubberBandColour = 'green'
+        self.clickTolerance = 3 #pixels the mouse can move and still count as a click
+        self.findResultLimit = 1000 #number of search results to list
+        self.tileSize = 256 #size in pixels of the tiles the image is decoded in
+        self.tileCacheSize = 64 << 20 #bytes of decoded tiles to keep
+        self.labelCacheSize = 4096 #box labels to keep laid out
 
 
     def set_options_from_arguments(self, opts):
@@ -1421,20 +1960,31 @@ Ctrl-Y: Redo change
             self.loadedImageFilename = os.path.join(sys.path[0],
                                             'example-data', 'eng.arial.tif')
         self.DEBUG = opts.debug
+        self.savePyramid = opts.savePyramid
 
 
     def __init__(self, opts):
 
         self.set_options_from_arguments(opts)
 
-        # initialise the undo/redo stack
-        self.undoRedoStack = UndoRedoStack()
+        # spatial index of the boxes, for selecting them in the image
+        self.boxGrid = BoxGrid()
+
+        # the boxes themselves, which the text buffer shows and edits
+        self.document = BoxDocument()
+        self.document.connect(self.on_document_changed)
 
         self.set_options()
 
+        # initialise the undo/redo stack
+        self.undoRedoStack = UndoRedoStack(self.undoMemoryLimit)
+
         # set up the window
         self.setup_widgets()
 
+        # for the startup timing, with -d
+        self.firstExposeHandlerID = self.window.connect_after('expose-event', self.on_first_expose)
+
         # load the image and boxfile
         self.load_image_and_boxes()
 
@@ -1444,6 +1994,11 @@ Ctrl-Y: Redo change
     def main(self):
         gtk.main()
 
+        if self.journal:
+            self.journal.close() # finish writing the autosave files
+
+        timing.finish() # write out the timings, with -d
+
 
 # If the program is run directly or passed as an argument to the python
 # interpreter then create a MoshPyTT instance and show it
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Tests for the BoxGrid spatial index. Run with
+#
+#           python -m unittest test_boxgrid
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import unittest
+
+from boxgrid import BoxGrid, MAX_GRID_CELLS
+
+HUGE_BOX = u'a 0 0 2000000 3000 0'
+
+
+class HugeBoxTest(unittest.TestCase):
+    """A hand-edited box far too big for the grid"""
+
+    def setUp(self):
+
+        self.grid = BoxGrid()
+        self.grid.imageHeight = 1000
+
+        self.grid.set_text(u'\n'.join([u'b 10 10 20 20 0', HUGE_BOX, u'c 500 500 520 530 0']))
+
+    def test_add(self):
+
+        self.assertEqual(self.grid.oversized, set([self.grid.lineIds[1]]))
+        self.assertTrue(len(self.grid.cells) <= 2 * MAX_GRID_CELLS)
+
+        # found anywhere it covers, with the boxes filed in the grid
+        self.assertEqual(self.grid.lines_at(15, 985), [0, 1])
+        self.assertEqual(self.grid.lines_at(900000, 900), [1])
+        self.assertEqual(self.grid.lines_in_rect(490, 460, 530, 510), [1, 2])
+
+        # but not outside it
+        self.assertEqual(self.grid.lines_at(2000001, 900), [])
+
+    def test_edit(self):
+
+        # shrink it, as a user fixing it would
+        self.grid.replace_lines(1, 1, [u'a 100 100 120 130 0'])
+
+        self.assertEqual(self.grid.oversized, set())
+        self.assertEqual(self.grid.lines_at(900000, 900), [])
+        self.assertEqual(self.grid.lines_at(110, 885), [1])
+
+        # break it again, then delete it
+        self.grid.replace_lines(1, 1, [HUGE_BOX])
+        self.assertEqual(self.grid.lines_at(900000, 900), [1])
+
+        self.grid.replace_lines(1, 1, [])
+        self.assertEqual(self.grid.oversized, set())
+        self.assertEqual(sorted(self.grid.boxes), sorted(self.grid.lineIds))
+        self.assertEqual(self.grid.lines_at(510, 480), [1])
+
+    def test_edit_other_lines(self):
+
+        # editing the other lines leaves it alone
+        self.grid.replace_lines(0, 1, [u'b 11 10 20 20 0'])
+        self.grid.replace_lines(2, 0, [u'd 600 600 610 610 0'])
+
+        self.assertEqual(self.grid.lines_at(900000, 900), [1])
+        self.assertEqual(self.grid.lines_at(605, 395), [1, 2]) # it covers d too
+
+
+if __name__ == '__main__':
+    unittest.main()
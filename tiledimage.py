@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       A tiled, lazily decoded image for displaying very large scans in
+#       moshPyTT.
+#
+#       The image is cut into square tiles which are only decoded when they
+#       are first drawn, and kept in a least-recently-used cache with a
+#       memory cap. If PIL is installed it is used to read the image, so
+#       that the header can be read without decoding anything and, for files
+#       stored in strips or tiles, only the parts which are on screen are
+#       decoded. Otherwise the image is decoded by gdk-pixbuf as a whole,
+#       as it always has been.
+#
+#       Given an onTileReady callback, tiles are decoded by a background
+#       thread instead of while the image is being drawn. Opening the image
+#       then only reads its size, so the editor can start at once: a missing
+#       tile is left blank and asked for, and the callback is run in the GUI
+#       thread when it arrives, so that the image fills in a tile at a time.
+#       The tiles asked for last, which are the ones on screen, are decoded
+#       first.
+#
+#       To zoom out, the image is kept as a pyramid of levels, each half the
+#       width and height of the one before. A level is only made when it is
+#       first shown, by shrinking the level above it, and is then tiled and
+#       cached like the image itself. With savePyramid the levels are also
+#       written as PNGs into a directory next to the image, foo.pyramid for
+#       foo.tif, and read from there next time, as long as they are newer
+#       than the image.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import pygtk
+pygtk.require('2.0')
+
+import gobject
+import gtk
+from collections import OrderedDict
+import os
+import threading
+
+import timing
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# PIL modes which are shrunk to grey rather than RGB
+GREY_MODES = ('1', 'L', 'LA', 'I', 'I;16', 'F')
+
+PYRAMID_EXTENSION = '.pyramid'
+
+# rows of the image shrunk at a time, so that a level can be made without
+# decoding the whole of a tiled or striped image at once
+BAND_HEIGHT = 512
+
+# tiles waiting to be decoded: the oldest are forgotten, as they have
+# probably been scrolled past
+MAX_REQUESTS = 256
+
+
+def overlaps(extents, box):
+    """True if two (left, top, right, bottom) rectangles overlap"""
+
+    return (extents[0] < box[2] and extents[2] > box[0]
+            and extents[1] < box[3] and extents[3] > box[1])
+
+
+def image_bytes(image):
+    """The pixels of a PIL image as a string"""
+
+    if hasattr(image, 'tobytes'):
+        return image.tobytes()
+    return image.tostring() # older versions of PIL
+
+
+def half_size(width, height):
+    """The size of the next level of a pyramid, rounding up"""
+
+    return ((width + 1) // 2, (height + 1) // 2)
+
+
+def pyramid_filename(imageFilename, frame, level):
+    """Where a level of the pyramid of a frame of an image is saved"""
+
+    return os.path.join(os.path.splitext(imageFilename)[0] + PYRAMID_EXTENSION,
+                        '%d-%d.png' % (frame, level))
+
+
+class PixbufSource:
+    """Image source which decodes the whole file with gdk-pixbuf"""
+
+    def __init__(self, pixbuf):
+
+        self.pixbuf = pixbuf
+
+        self.width = self.pixbuf.get_width()
+        self.height = self.pixbuf.get_height()
+
+    def get_region(self, x, y, width, height):
+
+        # shares the pixels of the whole image, so there is nothing to decode
+        return self.pixbuf.subpixbuf(x, y, width, height)
+
+    def read_gray(self, left, top, right, bottom):
+
+        # copied, so that the rows are packed from the corner of the region
+        region = self.pixbuf.subpixbuf(left, top, right - left, bottom - top).copy()
+
+        pixels = region.get_pixels()
+        stride = region.get_rowstride()
+        channels = region.get_n_channels()
+
+        # the green channel is near enough for black text on white
+        return (''.join(pixels[row * stride + 1:row * stride + (right - left) * channels:channels]
+                        for row in xrange(bottom - top)), right - left, bottom - top)
+
+    def half(self):
+        """The image at half the size, for the next level of the pyramid"""
+
+        (width, height) = half_size(self.width, self.height)
+        return PixbufSource(self.pixbuf.scale_simple(width, height, gtk.gdk.INTERP_BILINEAR))
+
+    def save(self, filename):
+        self.pixbuf.save(filename, 'png')
+
+
+class PixbufFileSource(PixbufSource):
+    """A PixbufSource which only reads the size of the file until a region
+    is first asked for"""
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.pixbuf = None
+
+        info = gtk.gdk.pixbuf_get_file_info(filename)
+
+        if info is None: # not a format gdk-pixbuf knows, so decode it for the error
+            self.load()
+            PixbufSource.__init__(self, self.pixbuf)
+        else:
+            (format, self.width, self.height) = info
+
+    def load(self):
+
+        if self.pixbuf is None:
+            self.pixbuf = gtk.gdk.pixbuf_new_from_file(self.filename)
+
+    def get_region(self, x, y, width, height):
+
+        self.load()
+        return PixbufSource.get_region(self, x, y, width, height)
+
+    def read_gray(self, left, top, right, bottom):
+
+        self.load()
+        return PixbufSource.read_gray(self, left, top, right, bottom)
+
+    def half(self):
+
+        self.load()
+        return PixbufSource.half(self)
+
+
+class PILSource:
+    """Image source which uses PIL to decode only what is asked for.
+
+    Opening the source only reads the header. If the file is stored in
+    several strips or tiles, a region only decodes the ones it overlaps.
+    Otherwise the image is decoded once, on the first request, and kept in
+    its own mode - one bit per pixel for a bi-level scan - rather than as
+    RGB."""
+
+    def __init__(self, filename, frame=0):
+
+        self.filename = filename
+        self.frame = frame
+
+        image = self.open_frame()
+        (self.width, self.height) = image.size
+        self.mode = image.mode
+
+        self.chunked = len(image.tile) > 1
+        self.image = None
+
+    def open_frame(self):
+        """Open the file at our frame, reading only the headers"""
+
+        image = Image.open(self.filename)
+        if self.frame:
+            image.seek(self.frame)
+        return image
+
+    def decode_region(self, box, mode='RGB'):
+        """Decode a (left, top, right, bottom) region into a PIL image"""
+
+        if self.chunked:
+            image = self.open_frame()
+            image.tile = [tile for tile in image.tile if overlaps(tile[1], box)]
+        else:
+            if self.image is None:
+                self.image = self.open_frame()
+                self.image.load()
+            image = self.image
+
+        return image.crop(box).convert(mode)
+
+    def get_region(self, x, y, width, height):
+
+        data = image_bytes(self.decode_region((x, y, x + width, y + height)))
+
+        return gtk.gdk.pixbuf_new_from_data(data, gtk.gdk.COLORSPACE_RGB,
+                                            False, 8, width, height, width * 3)
+
+    def read_gray(self, left, top, right, bottom):
+
+        region = self.decode_region((left, top, right, bottom), 'L')
+        return (image_bytes(region), right - left, bottom - top)
+
+    def half(self):
+        """The image at half the size, for the next level of the pyramid.
+        Scans in black and white or grey are shrunk to grey, everything else
+        to RGB."""
+
+        mode = 'L' if self.mode in GREY_MODES else 'RGB'
+        resample = getattr(Image, 'BOX', Image.ANTIALIAS) # BOX is new in Pillow 3.4
+
+        shrunk = Image.new(mode, half_size(self.width, self.height))
+
+        # the bands are an even number of rows high, so they meet exactly
+        for top in xrange(0, self.height, BAND_HEIGHT):
+            bottom = min(top + BAND_HEIGHT, self.height)
+            band = self.decode_region((0, top, self.width, bottom), mode)
+            shrunk.paste(band.resize(half_size(self.width, bottom - top), resample), (0, top // 2))
+
+        return ReducedSource(shrunk)
+
+
+class ReducedSource(PILSource):
+    """A level of the pyramid, shrunk by PIL and held in memory"""
+
+    def __init__(self, image):
+
+        self.image = image
+        self.mode = image.mode
+        (self.width, self.height) = image.size
+
+        self.chunked = False
+
+    def save(self, filename):
+        self.image.save(filename, 'PNG')
+
+
+def open_source(filename, frame=0):
+    """Open a frame of an image with PIL if possible, falling back to
+    gdk-pixbuf, which can only show the first frame"""
+
+    if Image is not None:
+        try:
+            return PILSource(filename, frame)
+        except (IOError, EOFError): # PIL can't read this format or frame
+            pass
+
+    if frame:
+        print 'Cannot show frame %d of %s: showing the first' % (frame, filename)
+
+    return PixbufFileSource(filename)
+
+
+def count_frames(filename):
+    """The number of frames (pages) in an image file"""
+
+    if Image is None:
+        return 1
+
+    try:
+        image = Image.open(filename)
+    except IOError:
+        return 1
+
+    # only the frame headers are read
+    frames = 1
+    while True:
+        try:
+            image.seek(frames)
+        except EOFError:
+            return frames
+        frames += 1
+
+
+class TiledImage:
+    """An image drawn from a cache of tiles which are decoded on demand.
+
+    At most maxBytes of decoded tiles are kept. When there are more, the
+    least recently drawn tiles which are not on screen are dropped. The
+    levels of the pyramid are kept as long as the image is; together they
+    are at most a third of its size."""
+
+    def __init__(self, filename, tileSize=256, maxBytes=64 << 20, frame=0, savePyramid=False,
+                 onTileReady=None):
+
+        self.filename = filename
+        self.frame = frame
+        self.savePyramid = savePyramid
+
+        self.source = open_source(filename, frame)
+
+        self.width = self.source.width
+        self.height = self.source.height
+
+        self.tileSize = tileSize
+        self.maxBytes = maxBytes
+
+        self.tiles = OrderedDict() # (level, column, row) -> pixbuf, least recently used first
+        self.tileBytes = 0
+
+        # called with (level, x, y, width, height) when a tile from the
+        # background thread is ready; without it tiles are decoded in draw
+        self.onTileReady = onTileReady
+
+        self.lock = threading.Lock() # held while the source is read, as it isn't thread-safe
+        self.requested = threading.Condition() # guards requests and closed
+        self.requests = OrderedDict() # tiles for the thread to decode, most wanted last
+        self.pending = set() # tiles requested or being decoded
+        self.failed = set() # tiles which couldn't be decoded
+        self.visible = set() # tiles drawn last time
+        self.worker = None
+        self.closed = False
+
+        self.levels = {0: self.source} # level -> source, for the levels made so far
+
+        # shrink until the image is no bigger than a tile
+        self.levelCount = 1
+        while max(self.width, self.height) >> self.levelCount >= tileSize:
+            self.levelCount += 1
+
+    def level_size(self, level):
+        """The (width, height) of a level of the pyramid, where level 0 is the
+        image itself and each level is half the size of the one before"""
+
+        rounding = (1 << level) - 1
+        return ((self.width + rounding) >> level, (self.height + rounding) >> level)
+
+    def get_level(self, level):
+        """The source of a level of the pyramid, read from disk or made from
+        the level above it the first time it is asked for"""
+
+        source = self.levels.get(level)
+
+        if source is None:
+            source = self.load_level(level)
+
+            if source is None:
+                source = self.get_level(level - 1).half()
+
+                if self.savePyramid:
+                    self.save_level(level, source)
+
+            self.levels[level] = source
+
+        return source
+
+    def load_level(self, level):
+        """The saved level of the pyramid, or None if there isn't one or it is
+        older than the image"""
+
+        if not self.savePyramid:
+            return None
+
+        filename = pyramid_filename(self.filename, self.frame, level)
+
+        try:
+            if os.path.getmtime(filename) < os.path.getmtime(self.filename):
+                return None
+
+            source = open_source(filename)
+        except (IOError, OSError, gobject.GError):
+            return None
+
+        if (source.width, source.height) != self.level_size(level):
+            return None
+
+        return source
+
+    def save_level(self, level, source):
+        """Save a level of the pyramid next to the image, for next time"""
+
+        filename = pyramid_filename(self.filename, self.frame, level)
+        tempFilename = '%s.%d.tmp' % (filename, os.getpid())
+
+        try:
+            directory = os.path.dirname(filename)
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+
+            source.save(tempFilename)
+            os.rename(tempFilename, filename)
+        except (IOError, OSError, gobject.GError), e:
+            print 'Cannot save %s: %s' % (filename, e)
+
+    def read_gray(self, left, top, right, bottom):
+        """The pixels of a region as 8-bit grey, for boxsplit. Reads the
+        source directly rather than going through the tile cache."""
+
+        with self.lock:
+            return self.source.read_gray(left, top, right, bottom)
+
+    def decode_tile(self, level, column, row):
+        """Decode a tile of a level. The caller holds the lock."""
+
+        source = self.get_level(level)
+
+        x = column * self.tileSize
+        y = row * self.tileSize
+        width = min(self.tileSize, source.width - x)
+        height = min(self.tileSize, source.height - y)
+
+        return source.get_region(x, y, width, height)
+
+    def cached_tile(self, key):
+        """A decoded tile, now the most recently used, or None"""
+
+        pixbuf = self.tiles.pop(key, None)
+        if pixbuf is not None:
+            self.tiles[key] = pixbuf
+
+        return pixbuf
+
+    def store_tile(self, key, pixbuf):
+
+        self.tiles[key] = pixbuf
+        self.tileBytes += pixbuf.get_rowstride() * pixbuf.get_height()
+
+    def get_tile(self, level, column, row):
+        """A tile, decoded now if it isn't cached"""
+
+        key = (level, column, row)
+
+        pixbuf = self.cached_tile(key)
+
+        if pixbuf is None:
+            with self.lock:
+                pixbuf = self.decode_tile(level, column, row)
+            self.store_tile(key, pixbuf)
+
+        return pixbuf
+
+    def request_tile(self, key):
+        """Ask the background thread to decode a tile before the ones asked
+        for earlier"""
+
+        with self.requested:
+            if key in self.pending and key not in self.requests:
+                return # being decoded now
+
+            self.requests.pop(key, None)
+            self.requests[key] = True
+            self.pending.add(key)
+
+            while len(self.requests) > MAX_REQUESTS:
+                (oldKey, wanted) = self.requests.popitem(last=False)
+                self.pending.discard(oldKey)
+
+            self.requested.notify()
+
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def run(self):
+        """Decode the requested tiles in the background, newest first, until
+        the image is closed"""
+
+        while True:
+            with self.requested:
+                while not (self.requests or self.closed):
+                    self.requested.wait()
+
+                if self.closed:
+                    return
+
+                (key, wanted) = self.requests.popitem()
+
+            try:
+                with timing.span('decode tile', level=key[0]):
+                    with self.lock:
+                        pixbuf = self.decode_tile(*key)
+            except (IOError, EOFError, gobject.GError), e:
+                print 'Cannot decode part of %s: %s' % (self.filename, e)
+                pixbuf = None
+
+            gobject.idle_add(self.add_tile, key, pixbuf)
+
+    def add_tile(self, key, pixbuf):
+        """Cache a tile from the background thread, in the GUI thread, and
+        tell onTileReady"""
+
+        with self.requested:
+            self.pending.discard(key)
+
+        if self.closed:
+            return False
+
+        if pixbuf is None:
+            self.failed.add(key) # don't ask again
+            return False
+
+        self.store_tile(key, pixbuf)
+        self.evict(self.visible)
+
+        (level, column, row) = key
+        self.onTileReady(level, column * self.tileSize, row * self.tileSize,
+                         pixbuf.get_width(), pixbuf.get_height())
+
+        return False
+
+    def close(self):
+        """Stop the background thread. Tiles it is decoding are thrown away."""
+
+        with self.requested:
+            self.closed = True
+            self.requests.clear()
+            self.requested.notify()
+
+    def evict(self, visible):
+        """Drop the oldest tiles that aren't in visible until the cache fits"""
+
+        for key in list(self.tiles):
+            if self.tileBytes <= self.maxBytes:
+                break
+
+            if key in visible:
+                continue
+
+            pixbuf = self.tiles.pop(key)
+            self.tileBytes -= pixbuf.get_rowstride() * pixbuf.get_height()
+
+    def draw(self, drawable, gc, x, y, width, height, level=0):
+        """Draw the given region of a level of the image at the same place in
+        drawable"""
+
+        (levelWidth, levelHeight) = self.level_size(level)
+
+        right = min(x + width, levelWidth)
+        bottom = min(y + height, levelHeight)
+        x = max(x, 0)
+        y = max(y, 0)
+
+        if right <= x or bottom <= y:
+            return
+
+        size = self.tileSize
+        visible = set()
+
+        for row in xrange(y // size, (bottom - 1) // size + 1):
+            for column in xrange(x // size, (right - 1) // size + 1):
+
+                key = (level, column, row)
+                visible.add(key)
+
+                if self.onTileReady is None:
+                    tile = self.get_tile(level, column, row)
+                else:
+                    tile = self.cached_tile(key)
+
+                    if tile is None: # left blank until it arrives
+                        if key not in self.failed:
+                            self.request_tile(key)
+                        continue
+
+                tileX = column * size
+                tileY = row * size
+
+                # the part of this tile inside the region
+                left = max(x, tileX)
+                top = max(y, tileY)
+                width = min(right, tileX + tile.get_width()) - left
+                height = min(bottom, tileY + tile.get_height()) - top
+
+                drawable.draw_pixbuf(gc, tile, left - tileX, top - tileY,
+                                     left, top, width, height)
+
+        self.visible = visible
+        self.evict(visible)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Timing of the hot paths of moshPyTT and autotrain, switched on by
+#       their -d flag.
+#
+#       Functions are wrapped with the timed decorator, and blocks of code
+#       with "with span(name):". Moments such as the end of startup are
+#       recorded with milestone(name), timed from when timing was enabled.
+#       While timing is off, which it is unless enable is called, a timed
+#       function costs one extra call and a flag test, and span hands back
+#       a shared object that does nothing. When it is on, every call is
+#       recorded, and finish writes them as a Chrome trace (load it in
+#       chrome://tracing or Perfetto) and prints the latency percentiles of
+#       each name.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import json
+import os
+import thread
+from timeit import default_timer as clock
+
+
+PERCENTILES = (50, 90, 99)
+
+
+class Tracer:
+    """Collects (name, start, duration, thread, args) events"""
+
+    def __init__(self):
+
+        self.enabled = False
+        self.filename = None
+        self.origin = clock()
+        self.events = [] # appending is atomic, so threads can share it
+
+    def add(self, name, start, duration, args=None):
+
+        self.events.append((name, start, duration, thread.get_ident(), args))
+
+    def write_trace(self, filename):
+        """Write the events in the Chrome trace event format, through a
+        temporary file"""
+
+        pid = os.getpid()
+
+        events = []
+        for (name, start, duration, threadId, args) in self.events:
+            event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': threadId,
+                     'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6}
+            if args:
+                event['args'] = args
+            events.append(event)
+
+        tempFilename = filename + '.tmp'
+        traceFile = open(tempFilename, 'w')
+        try:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, traceFile)
+        finally:
+            traceFile.close()
+
+        os.rename(tempFilename, filename)
+
+    def summary(self):
+        """Return lines of a table of the calls and latency percentiles of
+        each name, slowest total first"""
+
+        durations = {}
+        for (name, start, duration, threadId, args) in self.events:
+            durations.setdefault(name, []).append(duration)
+
+        lines = ['%-28s %7s %10s ' % ('span', 'calls', 'total ms') +
+                 ' '.join('%9s' % ('p%d ms' % p) for p in PERCENTILES) + ' %9s' % 'max ms']
+
+        for (name, times) in sorted(durations.items(), key=lambda item: -sum(item[1])):
+            times.sort()
+            # nearest rank
+            percentiles = [times[max(0, -(-p * len(times) // 100) - 1)] for p in PERCENTILES]
+
+            lines.append('%-28s %7d %10.1f ' % (name, len(times), sum(times) * 1000) +
+                         ' '.join('%9.2f' % (t * 1000) for t in percentiles) +
+                         ' %9.2f' % (times[-1] * 1000))
+
+        return lines
+
+
+class Span:
+    """Times a block of code"""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        TRACER.add(self.name, self.start, clock() - self.start, self.args)
+
+
+class NullSpan:
+    """Stands in for a Span while timing is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        pass
+
+
+TRACER = Tracer()
+NULL_SPAN = NullSpan()
+
+
+def enable(filename):
+    """Start timing, to write the trace to filename on finish"""
+
+    TRACER.enabled = True
+    TRACER.filename = filename
+    TRACER.origin = clock()
+
+
+def span(name, **args):
+    """Time a block of code: "with span('name'):". Any keyword arguments
+    are shown with the span in the trace."""
+
+    if not TRACER.enabled:
+        return NULL_SPAN
+    return Span(name, args or None)
+
+
+def milestone(name, **args):
+    """Record that something has happened, such as the window becoming
+    usable, as a span from when timing was enabled until now"""
+
+    if TRACER.enabled:
+        now = clock()
+        TRACER.add(name, TRACER.origin, now - TRACER.origin, args or None)
+
+
+def timed(function):
+    """Decorator which times every call of a function or method"""
+
+    name = function.__name__
+
+    def wrapper(*args, **kwargs):
+
+        if not TRACER.enabled:
+            return function(*args, **kwargs)
+
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            TRACER.add(name, start, clock() - start)
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+
+    return wrapper
+
+
+def finish():
+    """Write the trace and print the summary, if timing is on"""
+
+    if not TRACER.enabled:
+        return
+
+    TRACER.enabled = False
+
+    try:
+        TRACER.write_trace(TRACER.filename)
+        print 'Wrote a trace of %d spans to %s' % (len(TRACER.events), TRACER.filename)
+    except (IOError, OSError), e:
+        print 'Could not write the trace: %s' % e
+
+    print '\n'.join(TRACER.summary())
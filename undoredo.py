@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       The undo/redo history of moshPyTT: edits are coalesced, grouped into
+#       one entry per box operation, capped by a memory budget, and
+#       checkpointed so that long jumps through the history are cheap.
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+ENTRY_OVERHEAD = 120 # rough bytes taken by an entry besides its text
+
+CHECKPOINT_COST = 20 # number of replayed changes worth one whole-text restore
+
+
+def char_length(text):
+    """The length in characters of unicode or UTF-8 text, as used for
+    offsets in a gtk.TextBuffer"""
+
+    if isinstance(text, str):
+        return len(text.decode('utf-8'))
+    return len(text)
+
+
+def invert(change):
+
+    (action, offset, text) = change
+
+    if action == 'INS':
+        return ('DEL', offset, text)
+    else:
+        return ('INS', offset, text)
+
+
+def entry_size(entry):
+
+    return ENTRY_OVERHEAD + sum(len(text) for (action, offset, text) in entry)
+
+
+class UndoRedoStack:
+    """The history of changes to a text, for undo and redo.
+
+    Changes are (action, offset, text) tuples, where action is 'INS' or
+    'DEL'. Each entry on the stacks is a tuple of the changes that are
+    undone together: consecutive typing or deleting is merged into one
+    change, and everything between begin_group and end_group is one entry.
+
+    Positions in the history are numbered from the start of the session.
+    A checkpoint holds the whole text at some position, so that undoing or
+    redoing many entries can restore the nearest checkpoint and replay a
+    few changes, instead of replaying every one.
+
+    Checkpoints may use a quarter of maxBytes, and the oldest are dropped
+    to make room for new ones. When the entries and checkpoints together
+    take more than maxBytes, checkpoints and then the oldest entries are
+    dropped."""
+
+    def __init__(self, maxBytes=16 << 20):
+
+        self.maxBytes = maxBytes
+
+        self.clear()
+
+    def clear(self):
+        """Forget the whole history"""
+
+        self.undoStack = [] # oldest first
+        self.redoStack = [] # the next entry to redo is last
+        self.base = 0 # the position before the oldest entry on the undo stack
+
+        self.checkpoints = {} # position -> text
+        self.checkpointSize = 0 # bytes used by the checkpoints
+        self.size = 0 # bytes used by the entries and checkpoints
+
+        self.group = None # changes collected since begin_group
+        self.mergeable = False # true if the next change may merge with the last entry
+
+    def position(self):
+        """The position of the text in the history"""
+
+        return self.base + len(self.undoStack)
+
+    # RECORDING
+
+    def add_item(self, item):
+        """Record an {'action', 'offset', 'text'} item of the undo stack"""
+
+        change = (item['action'], item['offset'], item['text'])
+
+        if self.redoStack:
+            self.drop_redo()
+
+        if self.group is not None:
+            self.group.append(change)
+            return
+
+        if self.mergeable and self.position() not in self.checkpoints:
+            merged = self.merge(self.undoStack[-1], change)
+            if merged:
+                self.size += entry_size(merged) - entry_size(self.undoStack[-1])
+                self.undoStack[-1] = merged
+                self.trim()
+                return
+
+        self.push((change,))
+        self.mergeable = True
+
+    def merge(self, entry, change):
+        """Return entry with change merged into it, or None if they are not
+        part of the same run of typing or deleting"""
+
+        if len(entry) != 1:
+            return None
+
+        (lastAction, lastOffset, lastText) = entry[0]
+        (action, offset, text) = change
+
+        if action != lastAction or '\n' in text or '\n' in lastText:
+            return None
+
+        if action == 'INS' and offset == lastOffset + char_length(lastText):
+            return (('INS', lastOffset, lastText + text),)
+
+        if action == 'DEL':
+            if offset + char_length(text) == lastOffset: # backspace
+                return (('DEL', offset, text + lastText),)
+            if offset == lastOffset: # delete key
+                return (('DEL', offset, lastText + text),)
+
+        return None
+
+    def begin_group(self):
+        """Make the changes until end_group a single entry"""
+
+        if self.group is None:
+            self.group = []
+
+    def end_group(self):
+
+        group = self.group
+        self.group = None
+
+        if group:
+            self.push(tuple(group))
+
+        self.mergeable = False
+
+    def push(self, entry):
+
+        self.undoStack.append(entry)
+        self.size += entry_size(entry)
+        self.trim()
+
+    def drop_redo(self):
+        """Forget the redo stack, and the checkpoints only it could reach"""
+
+        for entry in self.redoStack:
+            self.size -= entry_size(entry)
+        self.redoStack = []
+
+        position = self.position()
+        for checkpoint in [p for p in self.checkpoints if p > position]:
+            self.drop_checkpoint(checkpoint)
+
+    def drop_checkpoint(self, position):
+
+        text = self.checkpoints.pop(position)
+        self.checkpointSize -= len(text)
+        self.size -= len(text)
+
+    def add_checkpoint(self, text):
+        """Remember the whole text at the current position"""
+
+        position = self.position()
+
+        if position in self.checkpoints or len(text) > self.maxBytes / 4:
+            return
+
+        while self.checkpoints and self.checkpointSize + len(text) > self.maxBytes / 4:
+            self.drop_checkpoint(min(self.checkpoints))
+
+        self.checkpoints[position] = text
+        self.checkpointSize += len(text)
+        self.size += len(text)
+        self.mergeable = False # the checkpoint is of the text as it is now
+
+        self.trim()
+
+    def trim(self):
+        """Drop checkpoints, oldest first, then the oldest entries until
+        the history fits in maxBytes"""
+
+        while self.size > self.maxBytes and self.checkpoints:
+            self.drop_checkpoint(min(self.checkpoints))
+
+        # always keep the latest entry
+        dropped = 0
+        while self.size > self.maxBytes and dropped < len(self.undoStack) - 1:
+            self.size -= entry_size(self.undoStack[dropped])
+            dropped += 1
+
+        if dropped:
+            del self.undoStack[:dropped]
+            self.base += dropped
+
+            for checkpoint in [p for p in self.checkpoints if p < self.base]:
+                self.drop_checkpoint(checkpoint)
+
+    # UNDOING AND REDOING
+
+    def nearest_checkpoint(self, target, replays):
+        """Return the position of a checkpoint which reaches target in fewer
+        than replays changes, or None"""
+
+        best = None
+        for position in self.checkpoints:
+            cost = abs(position - target) + CHECKPOINT_COST
+            if cost < replays and (best is None or cost < abs(best - target) + CHECKPOINT_COST):
+                best = position
+
+        return best
+
+    def entry_at(self, position):
+        """The entry which takes the text from position - 1 to position"""
+
+        top = self.position()
+
+        if position <= top:
+            return self.undoStack[position - self.base - 1]
+        else:
+            return self.redoStack[top - position]
+
+    def changes_between(self, start, end):
+        """Return the changes that take the text from position start to
+        position end, both of which are in the history"""
+
+        changes = []
+
+        if end >= start:
+            for position in xrange(start + 1, end + 1):
+                changes.extend(self.entry_at(position))
+        else:
+            for position in xrange(start, end, -1):
+                changes.extend(invert(change) for change in reversed(self.entry_at(position)))
+
+        return changes
+
+    def move_to(self, target):
+        """Move to another position in the history. Returns (text, changes):
+        if text is not None the whole text should be replaced by it, then
+        the changes applied in order."""
+
+        start = self.position()
+
+        checkpoint = self.nearest_checkpoint(target, abs(target - start))
+
+        if checkpoint is None:
+            (text, changes) = (None, self.changes_between(start, target))
+        else:
+            (text, changes) = (self.checkpoints[checkpoint], self.changes_between(checkpoint, target))
+
+        # shift the entries between the stacks
+        if target < start:
+            moved = self.undoStack[target - self.base:]
+            del self.undoStack[target - self.base:]
+            self.redoStack.extend(reversed(moved))
+        else:
+            count = target - start
+            moved = self.redoStack[len(self.redoStack) - count:]
+            del self.redoStack[len(self.redoStack) - count:]
+            self.undoStack.extend(reversed(moved))
+
+        self.mergeable = False
+
+        return (text, changes)
+
+    def undo(self, count=1):
+        """Undo up to count entries. Returns (text, changes) as move_to, or
+        None if there is nothing to undo."""
+
+        if not self.undoStack:
+            return None
+
+        return self.move_to(max(self.base, self.position() - count))
+
+    def redo(self, count=1):
+        """Redo up to count entries. Returns (text, changes) as move_to, or
+        None if there is nothing to redo."""
+
+        if not self.redoStack:
+            return None
+
+        return self.move_to(self.position() + min(count, len(self.redoStack)))